@@ -0,0 +1,223 @@
+"""
+Structured, non-blocking logging.
+
+Every record is written to stderr as one JSON object that carries the ID of
+the request it was logged in (RequestIDMiddleware, RequestIDFilter). The
+request thread only puts records on a bounded queue; QueueLogHandler's
+listener thread formats and writes them, and records arriving while the
+queue is full are dropped rather than making the request wait.
+
+Request payloads go through log_payload(), which logs only a sample of
+them and logs a redacted, size-capped copy.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import uuid
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# IDs passed in by a proxy are kept only if they look like one
+VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class RequestIDMiddleware:
+    """
+    Gives each request an ID, taken from the X-Request-ID header or
+    generated, and returns it in the same header.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def request_id_for(request):
+        value = request.headers.get(REQUEST_ID_HEADER, '')
+        return value if VALID_REQUEST_ID.match(value) else uuid.uuid4().hex
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        value = request.request_id = self.request_id_for(request)
+        token = request_id.set(value)
+        try:
+            response = self.get_response(request)
+        finally:
+            request_id.reset(token)
+        response[REQUEST_ID_HEADER] = value
+        return response
+
+    async def __acall__(self, request):
+        value = request.request_id = self.request_id_for(request)
+        token = request_id.set(value)
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_id.reset(token)
+        response[REQUEST_ID_HEADER] = value
+        return response
+
+
+class RequestIDFilter(logging.Filter):
+    """
+    Adds the current request's ID to records. Attach it to the handler the
+    request thread logs through, not to the listener's handlers, which run
+    in another thread.
+    """
+
+    def filter(self, record):
+        # django.request logs after the middleware returned, but passes the request
+        record.request_id = request_id.get() or getattr(getattr(record, 'request', None), 'request_id', None)
+        return True
+
+
+# Attributes every LogRecord has; anything else was passed in `extra`
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Puts records on a bounded in-memory queue that a QueueListener thread
+    writes to stderr as JSON. The listener is started again in a forked
+    child (Celery's prefork pool), which does not inherit its thread.
+    """
+
+    def __init__(self, max_size=10000):
+        super().__init__(queue.Queue(max_size))
+        self.max_size = max_size
+        self.dropped = 0
+        target = logging.StreamHandler()
+        target.setFormatter(JSONFormatter())
+        self.target = target
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        # Resolve the message now, while its arguments still hold the values
+        # they had when it was logged; the JSON is rendered by the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self.queue = queue.Queue(self.max_size)
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Called by both atexit and logging.shutdown()
+        if self.listener is not None and self._pid == os.getpid():
+            try:
+                self.listener.stop()
+            except queue.Full:
+                pass
+            self.listener = None
+        super().close()
+
+
+def redact(value, depth=0):
+    """
+    A copy of a request payload that is safe and cheap to log: values of
+    keys matching LOG_REDACTED_KEYS are masked, strings are cut to
+    LOG_PAYLOAD_MAX_STRING characters, collections to LOG_PAYLOAD_MAX_ITEMS
+    items and uploads are replaced by their name and size.
+    """
+    max_items = settings.LOG_PAYLOAD_MAX_ITEMS
+    if isinstance(value, UploadedFile):
+        return {'file': value.name, 'size': value.size}
+    if isinstance(value, (str, bytes)):
+        limit = settings.LOG_PAYLOAD_MAX_STRING
+        if isinstance(value, bytes):
+            return f"<{len(value)} bytes>"
+        return value if len(value) <= limit else f"{value[:limit]}...<{len(value)} chars>"
+    if depth >= 5 and isinstance(value, (Mapping, list, tuple)):
+        return '<nested>'
+    if isinstance(value, Mapping):
+        # Multipart and form data: keep repeated keys as lists
+        items = (
+            ((key, values[0] if len(values) == 1 else values) for key, values in value.lists())
+            if hasattr(value, 'lists') else value.items()
+        )
+        redacted = {}
+        for i, (key, item) in enumerate(items):
+            if i == max_items:
+                redacted['...'] = f"{len(value) - max_items} more keys"
+                break
+            lowered = str(key).lower()
+            if any(part in lowered for part in settings.LOG_REDACTED_KEYS):
+                redacted[key] = '[redacted]'
+            else:
+                redacted[key] = redact(item, depth + 1)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        redacted = [redact(item, depth + 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            redacted.append(f"... {len(value) - max_items} more items")
+        return redacted
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return redact(str(value), depth)
+
+
+def log_payload(logger, message, payload):
+    """
+    Log a redacted copy of payload under `payload` for a
+    LOG_PAYLOAD_SAMPLE_RATE fraction of calls.
+    """
+    if not logger.isEnabledFor(logging.INFO) or random.random() >= settings.LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.info(message, extra={'payload': redact(payload)})
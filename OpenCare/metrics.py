@@ -0,0 +1,299 @@
+"""
+Per-request performance metrics.
+
+RequestMetricsMiddleware times every request and, through a contextvar,
+collects what the request spent in the database (a connection execute
+wrapper), serializing (timed() around DRF renderers and serializers) and
+waiting on outbound HTTP (timed() in places.py). The totals are
+
+- added to in-process histograms that /metrics renders in the Prometheus
+  text format for requests bearing METRICS_TOKEN,
+- sent back in a Server-Timing header,
+- logged with the request's SQL when the request took longer than
+  SLOW_REQUEST_THRESHOLD_MS.
+
+Histograms live in the memory of each worker process, so scrape every
+worker rather than a load balancer in front of them. Work done while a
+StreamingHttpResponse is iterated (the export action) happens after the
+middleware returns and is not counted.
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from rest_framework.renderers import JSONRenderer
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+PHASES = ('db', 'serialize', 'http')
+
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+class RequestTimings:
+    """What one request has spent so far, by phase."""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        # (seconds, sql) of the first SLOW_REQUEST_MAX_QUERIES queries, for the slow request log
+        self.statements = []
+        self.open = set()
+
+    def add_query(self, sql, seconds):
+        self.queries += 1
+        self.seconds['db'] += seconds
+        if len(self.statements) < settings.SLOW_REQUEST_MAX_QUERIES:
+            self.statements.append((seconds, sql))
+
+
+current = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Add the time spent in the block to `phase` of the current request. Does
+    nothing outside a request, and nested blocks of the same phase are only
+    counted once.
+    """
+    timings = current.get()
+    if timings is None or phase in timings.open:
+        yield
+        return
+    timings.open.add(phase)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.open.discard(phase)
+        timings.seconds[phase] += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    """Connection execute wrapper counting the queries of the current request."""
+    timings = current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_wrapper(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        # First, so connection.execute_wrapper() blocks still pop their own wrapper
+        connection.execute_wrappers.insert(0, record_query)
+
+
+# Covers the connections of other threads too, e.g. those sync_to_async runs on
+connection_created.connect(install_query_wrapper)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # {label values: [bucket counts..., sum, count]}
+        self.series = {}
+
+    def observe(self, label_values, value):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            labels = format_labels(self.labels, label_values)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def format_labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+class Registry:
+    """The request metrics of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.requests = Counter('opencare_requests_total', 'Requests handled.', ('method', 'view', 'status'))
+        self.duration = Histogram(
+            'opencare_request_duration_seconds', 'Time to produce the response.', ('method', 'view'), LATENCY_BUCKETS
+        )
+        self.queries = Histogram(
+            'opencare_request_db_queries', 'Database queries per request.', ('method', 'view'), QUERY_COUNT_BUCKETS
+        )
+        self.phases = {
+            phase: Histogram(
+                f'opencare_request_{phase}_seconds', documentation, ('method', 'view'), LATENCY_BUCKETS
+            )
+            for phase, documentation in (
+                ('db', 'Time per request spent in database queries.'),
+                ('serialize', 'Time per request spent serializing and rendering.'),
+                ('http', 'Time per request spent waiting on outbound HTTP calls.'),
+            )
+        }
+
+    def observe(self, method, view, status, duration, timings):
+        with self._lock:
+            self.requests.inc((method, view, str(status)))
+            self.duration.observe((method, view), duration)
+            self.queries.observe((method, view), timings.queries)
+            for phase, histogram in self.phases.items():
+                histogram.observe((method, view), timings.seconds[phase])
+
+    def exposition(self):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.duration, self.queries, *self.phases.values()):
+                lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Unmatched URLs share one label, so 404 scans don't add series
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+class RequestMetricsMiddleware:
+    """Records the metrics of each request; should come first in MIDDLEWARE."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        for connection in connections.all():
+            install_query_wrapper(connection)
+        timings = RequestTimings()
+        token = current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, time.perf_counter() - start, timings)
+
+    def finish(self, request, response, duration, timings):
+        view = view_label(request)
+        method = request.method if request.method in METHODS else 'other'
+        registry.observe(method, view, response.status_code, duration, timings)
+
+        seconds = timings.seconds
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={seconds["db"] * 1000:.1f};desc="{timings.queries} queries"',
+            f'serialize;dur={seconds["serialize"] * 1000:.1f}',
+            f'http;dur={seconds["http"] * 1000:.1f}',
+            f'total;dur={duration * 1000:.1f}',
+        ])
+
+        if duration * 1000 >= settings.SLOW_REQUEST_THRESHOLD_MS:
+            statements = '\n'.join(f"  {query_seconds * 1000:.1f}ms {sql}" for query_seconds, sql in timings.statements)
+            logger.warning(
+                "Slow request %s %s (%s): %.0fms, %d queries in %.0fms, serialize %.0fms, http %.0fms\n%s",
+                request.method, request.path, view, duration * 1000, timings.queries,
+                seconds['db'] * 1000, seconds['serialize'] * 1000, seconds['http'] * 1000, statements,
+            )
+        return response
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with timed('serialize'):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+class TimedRepresentationMixin:
+    """Counts a serializer's to_representation() as serialization time."""
+
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super().to_representation(instance)
+
+
+def metrics_view(request):
+    """
+    The request metrics of this process in the Prometheus text format, for
+    requests bearing METRICS_TOKEN. Without a token configured the endpoint
+    does not exist.
+    """
+    if not settings.METRICS_TOKEN:
+        raise Http404
+    authorization = request.headers.get('Authorization', '')
+    if not constant_time_compare(authorization, f"Bearer {settings.METRICS_TOKEN}"):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
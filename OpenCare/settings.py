@@ -30,6 +30,51 @@ ALLOWED_HOSTS = ['127.0.0.1', 'localhost', '3.82.36.170', 'show.dentistnearme.ai
 AUTH_USER_MODEL = 'authentication.User'
 
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
+GOOGLE_PLACE_DETAILS_URL = os.getenv(
+    'GOOGLE_PLACE_DETAILS_URL', 'https://maps.googleapis.com/maps/api/place/details/json'
+)
+# Place Details proxy: in-process cache lifetime (seconds) and size, and the
+# (connect, read) timeout for upstream calls
+PLACE_DETAILS_CACHE_TTL = 3600
+PLACE_DETAILS_CACHE_SIZE = 1000
+PLACE_DETAILS_TIMEOUT = (3.05, 10)
+
+# Nearby clinic search backend: 'sql' (bounding box + Haversine in the database),
+# 'grid' (in-process lat/lng grid) or 'numpy' (in-process vectorized distances).
+# Grid cell size is in degrees (~11 km at the equator); the in-process backends
+# reload every NEARBY_INDEX_MAX_AGE seconds to pick up writes made elsewhere
+NEARBY_SEARCH_BACKEND = os.getenv('NEARBY_SEARCH_BACKEND', 'sql')
+NEARBY_GRID_CELL_SIZE = 0.1
+NEARBY_INDEX_MAX_AGE = 300
+# Largest page the nearby `limit` parameter may ask for, and the largest radius in km
+NEARBY_MAX_PAGE_SIZE = 100
+NEARBY_MAX_RADIUS = 500
+# Nearby response cache: entry lifetime in seconds (0 disables caching), the
+# geohash precision queries are bucketed by (7 is a ~150 m cell) and the most
+# clinics one bucket may hold; larger buckets are not cached
+NEARBY_CACHE_TIMEOUT = 300
+NEARBY_CACHE_GEOHASH_PRECISION = 7
+NEARBY_CACHE_MAX_ROWS = 200
+# Zone the nearby open_now / open_at filters read the hours of clinics without
+# a timezone in; when unset, TIME_ZONE
+OPEN_HOURS_DEFAULT_TIMEZONE = os.getenv('OPEN_HOURS_DEFAULT_TIMEZONE', '')
+
+# Clinic text search (see admin_app/search.py): the PostgreSQL text search
+# configuration, the default page size, the deepest offset a page may start
+# at, the distance in kilometers at which a result's relevance is halved when
+# searching near a point, and the default number of autocomplete suggestions
+CLINIC_SEARCH_CONFIG = 'english'
+CLINIC_SEARCH_PAGE_SIZE = 20
+CLINIC_SEARCH_MAX_OFFSET = 1000
+CLINIC_SEARCH_DISTANCE_SCALE = 10
+CLINIC_AUTOCOMPLETE_LIMIT = 10
+
+# Clinics loaded per query (with their hours, images and reviews) while
+# streaming a directory export
+CLINIC_EXPORT_CHUNK_SIZE = 500
+# Seconds the incremental export watermark trails the export; longer than any
+# transaction that writes clinics
+CLINIC_EXPORT_WATERMARK_LAG = 300
 
 # Application definition
 
@@ -40,6 +85,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'rest_framework_simplejwt',
@@ -50,6 +96,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so everything after it, including the slow request log, has the request ID
+    'OpenCare.log.RequestIDMiddleware',
+    # Next, so the timings cover the other middleware too
+    'OpenCare.metrics.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -67,6 +117,17 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    # Counted as serialization time in the request metrics
+    'DEFAULT_RENDERER_CLASSES': (
+        'OpenCare.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'admin_app.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
+    # Login attempts per client IP
+    'DEFAULT_THROTTLE_RATES': {
+        'login': os.getenv('LOGIN_THROTTLE_RATE', '20/min'),
+    },
 }
 
 
@@ -138,8 +199,21 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
+
+    # Answers the blacklist check from the cache, see authentication/tokens.py
+    'TOKEN_REFRESH_SERIALIZER': 'authentication.tokens.CachedTokenRefreshSerializer',
 }
 
+# In-process cache of User rows behind authentication.StatelessJWTAuthentication
+JWT_USER_CACHE_TTL = 30
+JWT_USER_CACHE_SIZE = 1000
+
+# Seconds a refresh token found not blacklisted is trusted from the cache
+TOKEN_BLACKLIST_CACHE_TIMEOUT = 300
+# Expired outstanding/blacklisted tokens deleted per statement by
+# authentication.tasks.purge_expired_tokens
+TOKEN_PURGE_BATCH_SIZE = 1000
+
 
 ROOT_URLCONF = 'OpenCare.urls'
 
@@ -183,9 +257,35 @@ DATABASES = {
 }
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://localhost:6379/1'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
+# Argon2id first; existing PBKDF2 hashes still verify and are rehashed at
+# the next login. Measured with `manage.py benchmark_login` on one core:
+# PBKDF2 (1,000,000 iterations) ~1.9 logins/s, Argon2 with Django's defaults
+# ~3.5/s, Argon2 with the parameters below (19 MiB, 2 passes, 1 lane, the
+# OWASP baseline) ~30/s
+PASSWORD_HASHERS = [
+    'authentication.hashers.TunedArgon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 19 * 1024))
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 1))
+
+# Seconds a login for an email without an account skips the user lookup
+LOGIN_UNKNOWN_EMAIL_CACHE_TIMEOUT = 300
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -224,6 +324,20 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Write every upload to a temporary file instead of holding small ones in memory
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+
+# Clinic image variants (admin_app.images): name -> longest side in pixels,
+# the variant nearby summaries link to, and uploads processed per sweep
+CLINIC_IMAGE_VARIANTS = {
+    'thumb': 160,
+    'small': 480,
+    'medium': 960,
+    'large': 1600,
+}
+CLINIC_IMAGE_SUMMARY_VARIANT = 'small'
+CLINIC_IMAGE_BATCH_SIZE = 50
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -241,8 +355,86 @@ CELERY_TIMEZONE = 'UTC'
 from celery.schedules import crontab
 
 CELERY_BEAT_SCHEDULE = {
-    'make-api-call-every-minute': {
-        'task': 'admin_app.tasks.make_api_call',
-        'schedule': 60.0,
+    'refresh-clinics': {
+        'task': 'admin_app.tasks.refresh_clinics',
+        'schedule': 300.0,
+    },
+    # Picks up webhook retries whose backoff has expired and any delivery
+    # whose on-commit schedule was lost
+    'drain-webhook-outbox': {
+        'task': 'admin_app.tasks.drain_webhook_outbox',
+        'schedule': 30.0,
+    },
+    'process-clinic-images': {
+        'task': 'admin_app.tasks.process_pending_images',
+        'schedule': 300.0,
     },
-}
\ No newline at end of file
+    'purge-expired-tokens': {
+        'task': 'authentication.tasks.purge_expired_tokens',
+        'schedule': crontab(minute=0, hour=3),
+    },
+}
+
+# Clinic refresh from Place Details (admin_app.refresh): each run fetches up to
+# CLINIC_REFRESH_BATCH_SIZE clinics not refreshed for CLINIC_REFRESH_MIN_AGE seconds
+CLINIC_REFRESH_BATCH_SIZE = 100
+CLINIC_REFRESH_CONCURRENCY = 5
+CLINIC_REFRESH_MIN_AGE = 24 * 60 * 60
+# Longer than a run can take; an expired lock lets the next run start
+CLINIC_REFRESH_LOCK_TIMEOUT = 600
+
+# Lead webhook outbox (admin_app.outbox)
+LEADCONNECTOR_WEBHOOK_URL = os.getenv(
+    'LEADCONNECTOR_WEBHOOK_URL',
+    'https://services.leadconnectorhq.com/hooks/4y5GUDosyK73YqjbTlg1/webhook-trigger/a9182ada-9332-440d-92a9-4dfd675ddb0a',
+)
+WEBHOOK_TIMEOUT = (3.05, 10)
+WEBHOOK_OUTBOX_BATCH_SIZE = 200
+# Parallel requests per drain and the request rate each worker process may send
+WEBHOOK_CONCURRENCY = 10
+WEBHOOK_RATE_LIMIT = 50
+WEBHOOK_OUTBOX_MAX_ATTEMPTS = 8
+# Retry n waits WEBHOOK_OUTBOX_BACKOFF * 2**(n-1) seconds, up to the maximum
+WEBHOOK_OUTBOX_BACKOFF = 30
+WEBHOOK_OUTBOX_MAX_BACKOFF = 3600
+# A row claimed longer ago than this is assumed lost with its worker
+WEBHOOK_OUTBOX_CLAIM_TIMEOUT = 300
+
+# Request metrics (OpenCare.metrics). /metrics requires an
+# "Authorization: Bearer <METRICS_TOKEN>" header, and returns 404 while unset
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Requests slower than this are logged with their SQL, up to SLOW_REQUEST_MAX_QUERIES statements
+SLOW_REQUEST_THRESHOLD_MS = int(os.getenv('SLOW_REQUEST_THRESHOLD_MS', 500))
+SLOW_REQUEST_MAX_QUERIES = 50
+
+# JSON lines on stderr, written by a background thread (OpenCare.log)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'request_id': {'()': 'OpenCare.log.RequestIDFilter'},
+    },
+    'handlers': {
+        'queue': {
+            'class': 'OpenCare.log.QueueLogHandler',
+            'filters': ['request_id'],
+        },
+    },
+    'root': {
+        'handlers': ['queue'],
+        'level': os.getenv('LOG_LEVEL', 'INFO'),
+    },
+    'loggers': {
+        # Their INFO lines include request URLs, and so the Google API key
+        'httpx': {'level': 'WARNING'},
+        'httpcore': {'level': 'WARNING'},
+    },
+}
+# Fraction of request payloads logged by OpenCare.log.log_payload, and their size limits
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+LOG_PAYLOAD_MAX_ITEMS = 10
+LOG_PAYLOAD_MAX_STRING = 200
+# Payload keys containing any of these are masked
+LOG_REDACTED_KEYS = (
+    'password', 'token', 'secret', 'authorization', 'cookie', 'email', 'phone', 'first_name', 'last_name', 'full_name',
+)
@@ -19,12 +19,14 @@ from django.urls import path, include
 from authentication.views import CustomTokenRefreshView
 from django.conf import settings
 from django.conf.urls.static import static
+from OpenCare.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/auth/', include('authentication.urls')),
     path('api/admin/', include('admin_app.urls')),
     path('api/token/refresh/',CustomTokenRefreshView.as_view() ,name=''),
+    path('metrics', metrics_view, name='metrics'),
 
 ]
 
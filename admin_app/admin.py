@@ -1,8 +1,9 @@
 from django.contrib import admin
-from admin_app.models import DentalClinic, ClinicImage, Review
+from admin_app.models import DentalClinic, ClinicImage, Review, WebhookOutbox
 
 admin.site.register(DentalClinic)
 admin.site.register(ClinicImage)
 admin.site.register(Review)
+admin.site.register(WebhookOutbox)
 
 # Register your models here.
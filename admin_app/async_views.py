@@ -0,0 +1,126 @@
+"""
+Async variants of the public nearby, add-email and place-details endpoints.
+
+These are plain Django async views rather than DRF views, which are
+synchronous, so under an ASGI server a request waiting on the database or on
+Google does not hold a worker thread. Responses match their DRF
+counterparts in views.py.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.exceptions import AuthenticationFailed
+
+from authentication.authentication import StatelessJWTAuthentication
+
+from . import nearby, nearby_cache, outbox
+from .models import DentalClinic
+from .places import PlaceDetailsError, place_details
+from .serializers import ClinicSummarySerializer, DentalClinicSerializer
+from .spatial import get_nearby_backend
+from .views import NearbySearchMixin
+
+
+async def authenticate(request):
+    """Return the user authenticated by the request's JWT, or None."""
+    try:
+        # Only tokens without the user claims need the database
+        result = await sync_to_async(StatelessJWTAuthentication().authenticate)(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+async def render_nearby(request, query, hits):
+    """Async NearbySearchMixin.render_nearby."""
+    if query.view == 'summary':
+        clinics, images, hours = nearby.summary_querysets(hits, query.fields)
+        rows = nearby.summary_rows(
+            hits,
+            [row async for row in clinics],
+            [row async for row in images] if images is not None else None,
+            [row async for row in hours] if hours is not None else None,
+            request.build_absolute_uri,
+        )
+        points = [(row['id'], row['latitude'], row['longitude']) for row in rows]
+        return points, ClinicSummarySerializer(rows, many=True, fields=query.fields).data
+    queryset = DentalClinic.objects.with_details().filter(pk__in=[clinic_id for _, clinic_id in hits])
+    clinics = nearby.order_clinics(hits, {clinic.pk: clinic async for clinic in queryset})
+    points = [(clinic.pk, clinic.latitude, clinic.longitude) for clinic in clinics]
+    return points, DentalClinicSerializer(clinics, many=True, context={'request': request}).data
+
+
+@require_GET
+async def nearby_clinics(request):
+    """Async DentalClinicViewSet.nearby; see nearby.NearbyQuery for the query parameters."""
+    try:
+        query = nearby.NearbyQuery(request.GET, NearbySearchMixin.nearby_default_radius)
+    except nearby.NearbyQueryError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    # cache_key reads the cache generation, a blocking cache call
+    cache_key = await sync_to_async(query.cache_key)(request.build_absolute_uri(request.path))
+    entry = headers = None
+    if cache_key is not None:
+        entry = await sync_to_async(nearby_cache.lookup)(cache_key)
+        headers = {'X-Cache': 'HIT' if entry is not None else 'MISS'}
+        if entry is None:
+            args, kwargs = query.bucket_search_args(await sync_to_async(query.open_candidates)())
+            bucket_hits = await get_nearby_backend().asearch(*args, **kwargs)
+            rows = None
+            if query.fits_cache(bucket_hits):
+                rows = query.cache_rows(*await render_nearby(request, query, bucket_hits))
+            entry = {'rows': rows}
+            await sync_to_async(nearby_cache.store)(cache_key, entry)
+
+    if entry is not None and entry['rows'] is not None:
+        hits, data, has_next = query.select(entry['rows'])
+    else:
+        if entry is not None:
+            headers['X-Cache'] = 'BYPASS'
+        args, kwargs = query.search_args(await sync_to_async(query.open_candidates)())
+        hits, has_next = query.paginate(await get_nearby_backend().asearch(*args, **kwargs))
+        data = (await render_nearby(request, query, hits))[1]
+    return JsonResponse(query.payload(data, hits, has_next, request.build_absolute_uri()), safe=False, headers=headers)
+
+
+@csrf_exempt
+@require_POST
+async def add_email(request):
+    """Async VisitedEmailView."""
+    try:
+        answers = json.loads(request.body).get("answers")
+    except (ValueError, AttributeError):
+        answers = None
+
+    if not answers or "email" not in answers:
+        return JsonResponse({"error": "Email is required"}, status=400)
+
+    # The async ORM has no transactions, so the save and the outbox row are
+    # written together in a thread
+    await sync_to_async(outbox.record_submission)(answers)
+    return JsonResponse({"message": "Data saved and queued for forwarding"})
+
+
+@require_GET
+async def get_place_details(request):
+    """Async views.get_place_details, for admins."""
+    user = await authenticate(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+    if not user.is_staff:
+        return JsonResponse({"detail": "You do not have permission to perform this action."}, status=403)
+
+    place_id = request.GET.get("place_id")
+    if not place_id:
+        return JsonResponse({"error": "Missing place_id"}, status=400)
+
+    try:
+        data = await place_details.aget(place_id)
+    except PlaceDetailsError as e:
+        return JsonResponse({"error": "Failed to fetch place details", "details": str(e)}, status=502)
+
+    return JsonResponse(data)
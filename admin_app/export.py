@@ -0,0 +1,125 @@
+"""
+Streaming export of the clinic directory as NDJSON or CSV.
+
+Clinics are read with iterator(chunk_size=...), so only one chunk of
+clinics and their prefetched children is in memory at a time, and each
+record is written to the response as soon as it is rendered.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import DentalClinic
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_FIELDS = (
+    'id', 'name', 'description', 'address', 'latitude', 'longitude', 'rating', 'phone_number',
+    'website', 'place_id', 'timezone', 'review_count', 'average_rating', 'business_hours',
+    'primary_image', 'created_at', 'updated_at',
+)
+
+
+def clinics_changed(since, until):
+    """The clinics with since < updated_at <= until, oldest change first."""
+    queryset = DentalClinic.objects.filter(updated_at__lte=until).order_by('updated_at', 'id')
+    if since is not None:
+        queryset = queryset.filter(updated_at__gt=since)
+    return queryset
+
+
+def image_url(image, build_absolute_uri):
+    if image.image_file:
+        return build_absolute_uri(image.image_file.url)
+    return image.image_url
+
+
+def clinic_record(clinic, build_absolute_uri):
+    """A clinic and its prefetched hours, images and reviews as a JSON-ready dict."""
+    return {
+        'id': clinic.pk,
+        'name': clinic.name,
+        'description': clinic.description,
+        'address': clinic.address,
+        'latitude': clinic.latitude,
+        'longitude': clinic.longitude,
+        'rating': clinic.rating,
+        'phone_number': clinic.phone_number,
+        'website': clinic.website,
+        'place_id': clinic.place_id,
+        'timezone': clinic.timezone,
+        'review_count': clinic.review_count,
+        'average_rating': clinic.average_rating,
+        'business_hours': [
+            {
+                'day': hours.day,
+                'opening_time': hours.opening_time,
+                'closing_time': hours.closing_time,
+                'is_closed': hours.is_closed,
+            }
+            for hours in clinic.business_hours.all()
+        ],
+        'images': [
+            {'url': image_url(image, build_absolute_uri), 'caption': image.caption, 'is_primary': image.is_primary}
+            for image in clinic.images.all()
+        ],
+        'reviews': [
+            {
+                'author_name': review.author_name,
+                'rating': review.rating,
+                'text': review.text,
+                'created_at': review.created_at,
+            }
+            for review in clinic.reviews.all()
+        ],
+        'created_at': clinic.created_at,
+        'updated_at': clinic.updated_at,
+    }
+
+
+def clinic_row(clinic, build_absolute_uri):
+    """A clinic as one flat CSV row: hours as text, only the primary image and no reviews."""
+    hours = '; '.join(
+        f"{row.get_day_display()[:3]} closed"
+        if row.is_closed or row.opening_time is None or row.closing_time is None
+        else f"{row.get_day_display()[:3]} {row.opening_time:%H:%M}-{row.closing_time:%H:%M}"
+        for row in clinic.business_hours.all()
+    )
+    images = sorted(clinic.images.all(), key=lambda image: (not image.is_primary, image.pk))
+    return [
+        clinic.pk, clinic.name, clinic.description, clinic.address, clinic.latitude, clinic.longitude,
+        clinic.rating, clinic.phone_number, clinic.website, clinic.place_id, clinic.timezone,
+        clinic.review_count, clinic.average_rating, hours,
+        image_url(images[0], build_absolute_uri) if images else None,
+        clinic.created_at.isoformat(), clinic.updated_at.isoformat(),
+    ]
+
+
+class Echo:
+    """A file-like object csv.writer can write to that hands each line back."""
+
+    def write(self, value):
+        return value
+
+
+def stream(output, since, until, build_absolute_uri, chunk_size=None):
+    """Yield the NDJSON lines or CSV rows of the clinics changed in (since, until]."""
+    chunk_size = chunk_size or settings.CLINIC_EXPORT_CHUNK_SIZE
+    queryset = clinics_changed(since, until)
+
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(CSV_FIELDS)
+        # Reviews are not part of a CSV row
+        for clinic in queryset.prefetch_related('business_hours', 'images').iterator(chunk_size=chunk_size):
+            yield writer.writerow(clinic_row(clinic, build_absolute_uri))
+        return
+
+    queryset = queryset.prefetch_related('business_hours', 'images', 'reviews')
+    for clinic in queryset.iterator(chunk_size=chunk_size):
+        yield json.dumps(clinic_record(clinic, build_absolute_uri), cls=DjangoJSONEncoder) + '\n'
@@ -0,0 +1,169 @@
+"""
+Resized variants of uploaded clinic images.
+
+An uploaded ClinicImage.image_file is kept as the original. A worker then
+renders every size in CLINIC_IMAGE_VARIANTS as WebP and JPEG, without the
+EXIF/XMP metadata of the upload, and records them in ClinicImage.variants.
+Files are named by the SHA-256 of the original, so uploading the same photo
+again reuses the stored original and variants instead of rendering them a
+second time.
+"""
+import hashlib
+import io
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import ClinicImage
+from .nearby_cache import bump_generation
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def storage():
+    return ClinicImage._meta.get_field('image_file').storage
+
+
+def content_hash(field_file):
+    """SHA-256 of a stored file, read in chunks."""
+    digest = hashlib.sha256()
+    with field_file.open('rb') as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def variant_path(digest, name, extension):
+    return f"clinic_images/variants/{digest[:2]}/{digest}/{name}.{extension}"
+
+
+def encode(image, image_format, icc_profile):
+    pillow_format, options = FORMATS[image_format]
+    if image_format == 'jpeg' and image.mode != 'RGB':
+        # JPEG has no alpha channel; flatten onto white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    # Only the color profile is carried over, so EXIF (camera, GPS) and XMP are dropped
+    image.save(buffer, pillow_format, icc_profile=icc_profile, **options)
+    return buffer.getvalue()
+
+
+def render_variants(field_file, digest):
+    """
+    Write the variants of an original image and return the
+    {name: {"width", "height", <format>: path}} mapping for
+    ClinicImage.variants. Variants that are already stored are not
+    rendered again.
+    """
+    sizes = sorted(settings.CLINIC_IMAGE_VARIANTS.items(), key=lambda item: -item[1])
+    variants = {}
+    with field_file.open('rb') as f, Image.open(f) as original:
+        # Let the JPEG decoder scale down while decoding, for a fraction of the work
+        original.draft('RGB', (sizes[0][1], sizes[0][1]))
+        icc_profile = original.info.get('icc_profile')
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.getbands() else 'RGB')
+
+        # Largest first, each variant scaled down from the previous one
+        for name, size in sizes:
+            image = image.copy()
+            image.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            variants[name] = {'width': image.width, 'height': image.height}
+            for image_format in FORMATS:
+                path = variant_path(digest, name, image_format)
+                if not storage().exists(path):
+                    path = storage().save(path, ContentFile(encode(image, image_format, icc_profile)))
+                variants[name][image_format] = path
+    return variants
+
+
+def process_image(image_id):
+    """
+    Hash a ClinicImage's upload and attach its variants, reusing the original
+    file and variants of an already processed image with the same content.
+    """
+    image = ClinicImage.objects.filter(pk=image_id).only('image_file', 'content_hash').first()
+    if image is None or not image.image_file:
+        return
+
+    digest = content_hash(image.image_file)
+    duplicate = (
+        ClinicImage.objects.filter(content_hash=digest).exclude(pk=image.pk).exclude(variants={})
+        .only('image_file', 'variants').first()
+    )
+    image_file = image.image_file.name
+    if duplicate is not None:
+        variants = duplicate.variants
+        if duplicate.image_file and duplicate.image_file.name != image_file:
+            # Keep one copy of the original
+            if not ClinicImage.objects.filter(image_file=image_file).exclude(pk=image.pk).exists():
+                storage().delete(image_file)
+            image_file = duplicate.image_file.name
+    else:
+        try:
+            variants = render_variants(image.image_file, digest)
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+            # Recorded with no variants, so the sweep does not retry it forever
+            logger.warning("Could not render variants of clinic image %s: %s", image.pk, e)
+            variants = {}
+
+    with transaction.atomic():
+        # An update rather than save() so concurrent caption edits are kept
+        ClinicImage.objects.filter(pk=image.pk).update(
+            image_file=image_file, content_hash=digest, variants=variants
+        )
+        transaction.on_commit(bump_generation)
+
+
+def process_pending(batch_size=None):
+    """Process up to batch_size uploads that have not been hashed yet. Returns how many."""
+    batch_size = batch_size or settings.CLINIC_IMAGE_BATCH_SIZE
+    ids = list(
+        ClinicImage.objects.exclude(image_file='').exclude(image_file__isnull=True)
+        .filter(content_hash='').order_by('pk').values_list('pk', flat=True)[:batch_size]
+    )
+    for image_id in ids:
+        process_image(image_id)
+    return len(ids)
+
+
+def schedule(image_ids):
+    """Queue variant rendering for these images once the current transaction commits."""
+    image_ids = list(image_ids)
+    if image_ids:
+        transaction.on_commit(lambda: _enqueue(image_ids))
+
+
+def _enqueue(image_ids):
+    from .tasks import process_clinic_image
+
+    for image_id in image_ids:
+        try:
+            process_clinic_image.delay(image_id)
+        except Exception:
+            # The periodic sweep picks the image up once the broker is back
+            logger.warning("Could not queue clinic image %s", image_id, exc_info=True)
+            return
+
+
+def variant_urls(variants, build_absolute_uri=None):
+    """ClinicImage.variants with each stored path replaced by its URL."""
+    urls = {}
+    for name, variant in variants.items():
+        urls[name] = dict(variant)
+        for image_format in FORMATS:
+            if image_format in variant:
+                url = storage().url(variant[image_format])
+                urls[name][image_format] = build_absolute_uri(url) if build_absolute_uri else url
+    return urls
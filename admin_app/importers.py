@@ -0,0 +1,164 @@
+import csv
+import json
+from itertools import islice
+
+from django.db import DataError, IntegrityError, transaction
+
+from . import images as clinic_images
+from .models import BusinessHours, ClinicImage, DentalClinic, Review
+from .serializers import DentalClinicSerializer
+from .nearby_cache import bump_generation
+from .spatial import index_clinics
+
+# Per-row errors kept in the report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+def read_rows(lines, file_format):
+    """
+    Yield (row_number, row) pairs from an iterable of text lines in 'jsonl' or
+    'csv' format. Row numbers start at 1 and do not count the CSV header.
+    A JSONL line that cannot be parsed is yielded with a None row.
+    """
+    if file_format == 'csv':
+        for row_number, row in enumerate(csv.DictReader(lines), start=1):
+            # Nested fields arrive as JSON strings, which to_internal_value decodes
+            yield row_number, {key: value for key, value in row.items() if value not in ('', None)}
+        return
+
+    row_number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            row = None
+        yield row_number, row if isinstance(row, dict) else None
+
+
+class ImportReport:
+    def __init__(self, start_after=0):
+        self.imported = 0
+        self.failed = 0
+        self.last_row = start_after
+        self.errors = []
+
+    def add_error(self, row_number, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'last_row': self.last_row,
+            'errors': self.errors,
+        }
+
+
+class ClinicImporter:
+    """
+    Bulk clinic import.
+
+    Rows are validated with DentalClinicSerializer, so they accept exactly what
+    the clinic API accepts, including the {"Monday": {"open", "close"}}
+    business hours format. Valid rows are written `chunk_size` at a time with
+    one bulk_create per table inside a transaction. A chunk the database
+    rejects is retried one row at a time, so only the offending rows fail.
+    `on_chunk(report)` is called after each committed chunk, so callers can
+    report progress and checkpoint `report.last_row`.
+    """
+
+    def __init__(self, chunk_size=500, on_chunk=None):
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+
+    def run(self, lines, file_format, start_after=0):
+        """Import every row after row number `start_after` and return an ImportReport."""
+        report = ImportReport(start_after)
+        rows = ((number, row) for number, row in read_rows(lines, file_format) if number > start_after)
+
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return report
+
+            valid = []
+            place_ids = set()
+            for row_number, row in chunk:
+                if row is None:
+                    report.add_error(row_number, {'non_field_errors': ['Row is not a JSON object.']})
+                    continue
+                serializer = DentalClinicSerializer(data=row)
+                if not serializer.is_valid():
+                    report.add_error(row_number, serializer.errors)
+                    continue
+                # The serializer only checks place_id against clinics already saved
+                place_id = serializer.validated_data.get('place_id')
+                if place_id and place_id in place_ids:
+                    report.add_error(row_number, {'place_id': ['Another row of this chunk has this place_id.']})
+                    continue
+                place_ids.add(place_id)
+                valid.append((row_number, serializer.validated_data))
+
+            self.write_rows(valid, report)
+            report.last_row = chunk[-1][0]
+            if self.on_chunk:
+                self.on_chunk(report)
+
+    def write_rows(self, rows, report):
+        """
+        Write (row_number, validated_data) pairs. If the database rejects the
+        batch, write each row in its own transaction and report the ones that
+        fail, e.g. a place_id saved by someone else since validation.
+        """
+        try:
+            self.write([data for _, data in rows])
+        except (IntegrityError, DataError):
+            for row_number, data in rows:
+                try:
+                    self.write([data])
+                except (IntegrityError, DataError) as e:
+                    report.add_error(row_number, {'non_field_errors': [f"Rejected by the database: {e}"]})
+                else:
+                    report.imported += 1
+        else:
+            report.imported += len(rows)
+
+    @staticmethod
+    def write(validated_rows):
+        nested = []
+        clinics = []
+        for data in validated_rows:
+            data = dict(data)
+            nested.append((
+                data.pop('business_hours', []),
+                data.pop('images', []),
+                data.pop('reviews', []),
+            ))
+            data.pop('business_types', None)
+            clinics.append(DentalClinic(**data))
+
+        with transaction.atomic():
+            DentalClinic.objects.bulk_create(clinics)
+
+            hours, images, reviews = [], [], []
+            for clinic, (hours_data, images_data, reviews_data) in zip(clinics, nested):
+                hours.extend(BusinessHours(clinic=clinic, **item) for item in hours_data)
+                images.extend(DentalClinicSerializer.build_images(clinic, images_data))
+                reviews.extend(Review(clinic=clinic, **item) for item in reviews_data)
+
+            BusinessHours.objects.bulk_create(hours)
+            ClinicImage.objects.bulk_create(images)
+            clinic_images.schedule(image.pk for image in images if image.image_file)
+            Review.objects.bulk_create(reviews)
+            imported = DentalClinic.objects.filter(pk__in=[clinic.pk for clinic in clinics])
+            imported.refresh_open_intervals()
+            imported.refresh_search_vectors()
+
+            coordinates = [(clinic.pk, clinic.latitude, clinic.longitude) for clinic in clinics]
+            transaction.on_commit(lambda: index_clinics(coordinates))
+            transaction.on_commit(bump_generation)
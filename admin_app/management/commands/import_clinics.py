@@ -0,0 +1,61 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from admin_app.importers import ClinicImporter
+
+
+class Command(BaseCommand):
+    help = (
+        "Import clinics from a JSONL or CSV file (one clinic per line/row, same fields as the "
+        "clinic API). Writes are batched and progress is checkpointed so an interrupted import "
+        "can be resumed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSONL or CSV file to import.")
+        parser.add_argument(
+            '--format', choices=['jsonl', 'csv'], dest='file_format',
+            help="File format (default: guessed from the file extension).",
+        )
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows per transaction (default: 500).")
+        parser.add_argument(
+            '--checkpoint',
+            help="File recording the last imported row. An existing checkpoint is resumed from.",
+        )
+        parser.add_argument('--start-after', type=int, default=0, help="Skip rows up to and including this row number.")
+
+    def handle(self, *args, path, file_format, chunk_size, checkpoint, start_after, **options):
+        file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                start_after = json.load(f)['last_row']
+            self.stdout.write(f"Resuming after row {start_after} from {checkpoint}")
+
+        def on_chunk(report):
+            if checkpoint:
+                # Write-then-rename so a crash never leaves a truncated checkpoint
+                with open(f"{checkpoint}.tmp", 'w') as f:
+                    json.dump({'last_row': report.last_row}, f)
+                os.replace(f"{checkpoint}.tmp", checkpoint)
+            self.stdout.write(
+                f"Row {report.last_row}: {report.imported} imported, {report.failed} failed"
+            )
+
+        try:
+            lines = open(path, encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(str(e))
+
+        with lines:
+            report = ClinicImporter(chunk_size=chunk_size, on_chunk=on_chunk).run(lines, file_format, start_after)
+
+        for error in report.errors:
+            self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+        if report.failed > len(report.errors):
+            self.stderr.write(f"... and {report.failed - len(report.errors)} more failed rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {report.imported} imported, {report.failed} failed, last row {report.last_row}."
+        ))
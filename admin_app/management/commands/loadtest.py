@@ -0,0 +1,88 @@
+import asyncio
+import statistics
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+# Path of each endpoint under /api/admin/, sync and async
+ENDPOINTS = {
+    'nearby': ('clinics/nearby/', 'async/clinics/nearby/'),
+    'add-email': ('add-email/', 'async/add-email/'),
+    'place-details': ('place-details/', 'async/place-details/'),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the nearby, add-email and place-details endpoints of a running server and "
+        "report throughput and latency. Run it once against a WSGI server and once against an "
+        "ASGI server (with --async) to compare them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help="Server root, e.g. http://127.0.0.1:8000")
+        parser.add_argument(
+            '--endpoint', action='append', choices=sorted(ENDPOINTS), dest='endpoints',
+            help="Endpoint to test; repeat for several (default: all).",
+        )
+        parser.add_argument('--async', action='store_true', dest='use_async', help="Hit the async/ variants.")
+        parser.add_argument('--requests', type=int, default=500, help="Requests per endpoint (default: 500).")
+        parser.add_argument('--concurrency', type=int, default=50, help="Requests in flight (default: 50).")
+        parser.add_argument('--token', default='', help="Admin access token, needed for place-details.")
+        parser.add_argument('--lat', type=float, default=40.7128)
+        parser.add_argument('--lng', type=float, default=-74.0060)
+
+    def handle(self, *args, base_url, endpoints, use_async, **options):
+        for name in endpoints or sorted(ENDPOINTS):
+            path = ENDPOINTS[name][1 if use_async else 0]
+            url = f"{base_url.rstrip('/')}/api/admin/{path}"
+            result = asyncio.run(self.run(name, url, **options))
+            self.stdout.write(
+                f"{name:<14} {result['requests']} requests in {result['seconds']:.2f}s: "
+                f"{result['per_second']:.1f} req/s, p50 {result['p50']:.0f} ms, "
+                f"p99 {result['p99']:.0f} ms, {result['errors']} errors"
+            )
+
+    async def run(self, name, url, requests, concurrency, token, lat, lng, **options):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+        headers = {'Authorization': f"Bearer {token}"} if token else {}
+
+        async def one(client, number):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if name == 'nearby':
+                        # Spread the queries so the response cache does not serve them all
+                        params = {'lat': lat + (number % 100) / 100, 'lng': lng, 'radius': 10}
+                        response = await client.get(url, params=params)
+                    elif name == 'add-email':
+                        answers = {'email': f"loadtest-{number}@example.com", 'anxiety': 'low'}
+                        response = await client.post(url, json={'answers': answers})
+                    else:
+                        # Distinct ids, so every request reaches the upstream API
+                        params = {'place_id': f"loadtest-{number}"}
+                        response = await client.get(url, params=params, headers=headers)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(client, number) for number in range(requests)))
+            seconds = time.perf_counter() - started
+
+        percentiles = statistics.quantiles(latencies, n=100)
+        return {
+            'requests': requests,
+            'seconds': seconds,
+            'per_second': requests / seconds,
+            'p50': percentiles[49],
+            'p99': percentiles[98],
+            'errors': errors,
+        }
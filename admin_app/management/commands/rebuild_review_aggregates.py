@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from admin_app.models import DentalClinic
+
+
+class Command(BaseCommand):
+    help = "Recompute DentalClinic.review_count and review_rating_sum from the Review table."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of clinics updated per statement (default: 1000).",
+        )
+
+    def handle(self, *args, batch_size, **options):
+        ids = list(DentalClinic.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), batch_size):
+            DentalClinic.objects.filter(pk__in=ids[start:start + batch_size]).refresh_review_aggregates()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt review aggregates for {len(ids)} clinics."))
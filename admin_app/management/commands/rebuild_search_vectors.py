@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from admin_app.models import DentalClinic
+
+
+class Command(BaseCommand):
+    help = "Recompute DentalClinic.search_vector from the clinics and their reviews (PostgreSQL only)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of clinics recomputed per batch (default: 1000).",
+        )
+
+    def handle(self, *args, batch_size, **options):
+        ids = list(DentalClinic.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), batch_size):
+            DentalClinic.objects.filter(pk__in=ids[start:start + batch_size]).refresh_search_vectors()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt search vectors for {len(ids)} clinics."))
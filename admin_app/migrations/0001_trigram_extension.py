@@ -0,0 +1,15 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Install pg_trgm ahead of the generated migrations, which create the
+    gin_trgm_ops index on DentalClinic.name. A no-op on other databases.
+    """
+
+    dependencies = []
+
+    operations = [
+        TrigramExtension(),
+    ]
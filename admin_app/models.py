@@ -1,6 +1,84 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.db.models import Case, Count, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.core.exceptions import ValidationError
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+
+def validate_timezone(value):
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValidationError(f"{value} is not a known time zone.")
+
+
+class DentalClinicQuerySet(models.QuerySet):
+    def with_details(self):
+        """Load everything DentalClinicSerializer renders in a fixed number of queries."""
+        return self.prefetch_related('business_hours', 'images')
+
+    def add_review_totals(self, totals):
+        """
+        Add {clinic_id: (review_count_delta, rating_sum_delta)} to the stored
+        review aggregates in a single UPDATE.
+        """
+        if not totals:
+            return
+        count_deltas = [When(pk=pk, then=Value(count)) for pk, (count, _) in totals.items()]
+        sum_deltas = [When(pk=pk, then=Value(float(rating_sum))) for pk, (_, rating_sum) in totals.items()]
+        self.filter(pk__in=totals).update(
+            review_count=F('review_count') + Case(*count_deltas, output_field=IntegerField()),
+            review_rating_sum=F('review_rating_sum') + Case(*sum_deltas, output_field=FloatField()),
+        )
+
+    def refresh_open_intervals(self):
+        """
+        Recompute open_intervals of these clinics from their business hours.
+        Writes that bypass the BusinessHours signals (bulk_create, bulk_update)
+        must call this.
+        """
+        from .open_hours import open_hours_index, weekly_intervals
+
+        ids = list(self.values_list('pk', flat=True))
+        hours = defaultdict(list)
+        rows = BusinessHours.objects.filter(clinic_id__in=ids).values_list(
+            'clinic_id', 'day', 'opening_time', 'closing_time', 'is_closed'
+        )
+        for clinic_id, *row in rows:
+            hours[clinic_id].append(row)
+        DentalClinic.objects.bulk_update(
+            [DentalClinic(pk=pk, open_intervals=weekly_intervals(hours[pk])) for pk in ids],
+            ['open_intervals'],
+            batch_size=1000,
+        )
+        transaction.on_commit(lambda: open_hours_index.reload(ids))
+
+    def refresh_search_vectors(self):
+        """
+        Recompute search_vector of these clinics from their text and reviews.
+        Writes that bypass the DentalClinic and Review signals must call this.
+        Does nothing off PostgreSQL, where search does not use the column.
+        """
+        from .search import search_document, uses_full_text_search
+
+        if not uses_full_text_search():
+            return 0
+        return self.update(search_vector=search_document())
+
+    def refresh_review_aggregates(self):
+        """Recompute the stored review aggregates of these clinics from their reviews."""
+        reviews = Review.objects.filter(clinic=OuterRef('pk')).order_by().values('clinic')
+        return self.update(
+            review_count=Coalesce(Subquery(reviews.annotate(total=Count('pk')).values('total')), 0),
+            review_rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0.0),
+        )
+
 
 class DentalClinic(models.Model):
     name = models.CharField(max_length=255)
@@ -15,15 +93,56 @@ class DentalClinic(models.Model):
     )
     phone_number = models.CharField(max_length=50, blank=True, null=True)
     website = models.URLField(blank=True, null=True)
+    # IANA name the business hours are in; blank means OPEN_HOURS_DEFAULT_TIMEZONE,
+    # or TIME_ZONE when that is unset
+    timezone = models.CharField(max_length=64, blank=True, validators=[validate_timezone])
+    # Google place id; clinics that have one are kept up to date by tasks.refresh_clinics
+    place_id = models.CharField(max_length=255, unique=True, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Last Place Details lookup by refresh.refresh_stale_clinics, whether or not it changed anything
+    refreshed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Maintained incrementally from Review writes, see DentalClinicQuerySet.add_review_totals
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    review_rating_sum = models.FloatField(default=0.0, editable=False)
+    # Weekly [start, end) minutes since Monday 00:00 local time, derived from
+    # business_hours by refresh_open_intervals (see open_hours.py)
+    open_intervals = models.JSONField(default=list, editable=False)
+    # Weighted tsvector of name, address, description and review texts,
+    # maintained by refresh_search_vectors (see search.py)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = DentalClinicQuerySet.as_manager()
     
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        # The review aggregates are only ever written with relative UPDATEs, and
+        # open_intervals and search_vector are derived from other rows; saving
+        # a stale in-memory copy would overwrite concurrent changes
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            skipped = {'review_count', 'review_rating_sum', 'open_intervals', 'search_vector'} | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def average_rating(self):
+        if not self.review_count:
+            return None
+        return self.review_rating_sum / self.review_count
     
     class Meta:
         indexes = [
             models.Index(fields=['latitude', 'longitude']),
+            models.Index(fields=['updated_at']),
+            models.Index(fields=['refreshed_at']),
+            GinIndex(fields=['search_vector'], name='clinic_search_vector_gin'),
+            # Needs the pg_trgm extension
+            GinIndex(fields=['name'], name='clinic_name_trgm', opclasses=['gin_trgm_ops']),
         ]
 
 
@@ -61,11 +180,28 @@ class ClinicImage(models.Model):
     caption = models.CharField(max_length=255, blank=True, null=True)
     is_primary = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # SHA-256 of image_file and its resized copies, both filled in by a worker
+    # (see images.py); {name: {"width", "height", "webp", "jpeg"}} with storage paths
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
     
     def __str__(self):
         return f"Image for {self.clinic.name}"
 
 
+class ReviewQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """bulk_create() skips the post_save signal, so update the clinic aggregates here."""
+        objs = super().bulk_create(objs, *args, **kwargs)
+        totals = {}
+        for review in objs:
+            count, rating_sum = totals.get(review.clinic_id, (0, 0.0))
+            totals[review.clinic_id] = (count + 1, rating_sum + review.rating)
+        DentalClinic.objects.add_review_totals(totals)
+        DentalClinic.objects.filter(pk__in=totals).refresh_search_vectors()
+        return objs
+
+
 class Review(models.Model):
     clinic = models.ForeignKey(DentalClinic, on_delete=models.CASCADE, related_name='reviews')
     author_name = models.CharField(max_length=255)
@@ -73,6 +209,58 @@ class Review(models.Model):
     rating = models.FloatField(validators=[MinValueValidator(0.0), MaxValueValidator(5.0)])
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ReviewQuerySet.as_manager()
     
     def __str__(self):
-        return f"Review by {self.author_name} for {self.clinic.name}"
\ No newline at end of file
+        return f"Review by {self.author_name} for {self.clinic.name}"
+
+class WebhookOutboxQuerySet(models.QuerySet):
+    def due(self, now, claim_timeout):
+        """Pending rows whose next attempt is due, plus claims abandoned by a dead worker."""
+        return self.filter(
+            models.Q(status=WebhookOutbox.PENDING, next_attempt_at__lte=now)
+            | models.Q(status=WebhookOutbox.SENDING, claimed_at__lt=now - claim_timeout)
+        )
+
+
+class WebhookOutbox(models.Model):
+    """
+    Lead webhook deliveries waiting to be forwarded, one row per email.
+
+    A new submission for an email that is still queued replaces the queued
+    payload instead of adding a second delivery. `version` is bumped on every
+    enqueue so a worker that was sending an older payload does not mark the
+    newer one as delivered.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (DELIVERED, 'Delivered'),
+        (FAILED, 'Failed'),
+    ]
+
+    email = models.EmailField(unique=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    version = models.PositiveIntegerField(default=1)
+    attempts = models.PositiveIntegerField(default=0)
+    enqueued_at = models.DateTimeField()
+    next_attempt_at = models.DateTimeField()
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    objects = WebhookOutboxQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.email} ({self.status})"
@@ -0,0 +1,306 @@
+"""
+Request handling shared by the sync (DRF) and async nearby endpoints: query
+parsing, cursors, cache keys and assembling the results. The callers only
+differ in how they run the queries built here.
+"""
+import base64
+import binascii
+import math
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.urls import replace_query_param
+
+from . import nearby_cache
+from .models import BusinessHours, ClinicImage, DentalClinic
+from .open_hours import open_hours_index
+from .serializers import CLINIC_SUMMARY_FIELDS
+from .spatial import haversine_distance
+
+
+class NearbyQueryError(ValueError):
+    pass
+
+
+def encode_cursor(distance, clinic_id):
+    return base64.urlsafe_b64encode(f"{distance!r}:{clinic_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (distance, clinic_id) pair of a cursor, raising ValueError if it is malformed."""
+    try:
+        distance, clinic_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    except (binascii.Error, UnicodeError):
+        raise ValueError(cursor)
+    distance = float(distance)
+    if not math.isfinite(distance):
+        raise ValueError(cursor)
+    return distance, int(clinic_id)
+
+
+def parse_location(latitude, longitude, radius):
+    """
+    Return the latitude, longitude and radius parameters as floats (radius
+    None when not given), raising NearbyQueryError unless they are in range
+    and the radius is at most NEARBY_MAX_RADIUS. NaN and infinities fail
+    the range checks.
+    """
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+        radius = float(radius) if radius is not None else None
+    except ValueError:
+        raise NearbyQueryError("Invalid latitude, longitude, or radius value")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise NearbyQueryError("Latitude or longitude out of range")
+    if radius is not None and not 0 < radius <= settings.NEARBY_MAX_RADIUS:
+        raise NearbyQueryError(f"radius must be greater than 0 and at most {settings.NEARBY_MAX_RADIUS} km")
+    return latitude, longitude, radius
+
+
+class NearbyQuery:
+    """
+    The validated parameters of a nearby request. Raises NearbyQueryError
+    with a message for the client when they are invalid.
+
+    Query parameters:
+    - lat: user's latitude (required)
+    - lng: user's longitude (required)
+    - radius: search radius in kilometers, up to NEARBY_MAX_RADIUS (optional,
+      default: default_radius)
+    - limit (or k): return only the `limit` closest clinics as a page of
+      {"next", "results"}; without an explicit radius the search is unbounded
+    - cursor: the cursor from the previous page's `next` link
+    - view: 'full' (default, DentalClinicSerializer) or 'summary'
+      (ClinicSummarySerializer)
+    - fields: comma separated summary fields to return; implies view=summary
+    - open_now: 'true' to return only the clinics open right now
+    - open_at: ISO 8601 datetime; return only the clinics open at that time
+      (a datetime without an offset is read in settings.TIME_ZONE); the hours
+      of clinics without a timezone are read in OPEN_HOURS_DEFAULT_TIMEZONE,
+      or settings.TIME_ZONE when that is unset
+    """
+
+    def __init__(self, params, default_radius):
+        latitude = params.get('lat')
+        longitude = params.get('lng')
+        radius = params.get('radius')
+        limit = params.get('limit') or params.get('k')
+        cursor = params.get('cursor')
+        view = params.get('view', 'full')
+        fields = params.get('fields')
+
+        if not latitude or not longitude:
+            raise NearbyQueryError("Latitude and longitude parameters are required")
+
+        if radius is None and limit is None:
+            radius = default_radius
+
+        self.latitude, self.longitude, self.radius = parse_location(latitude, longitude, radius)
+
+        if fields:
+            view = 'summary'
+            fields = [name.strip() for name in fields.split(',') if name.strip()]
+            unknown = set(fields) - set(CLINIC_SUMMARY_FIELDS)
+            if unknown:
+                raise NearbyQueryError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        else:
+            fields = CLINIC_SUMMARY_FIELDS
+        if view not in ('full', 'summary'):
+            raise NearbyQueryError("view must be 'full' or 'summary'")
+        self.view = view
+        self.fields = fields
+
+        self.after = None
+        if limit is not None:
+            try:
+                limit = int(limit)
+                self.after = decode_cursor(cursor) if cursor else None
+            except ValueError:
+                raise NearbyQueryError("Invalid limit or cursor value")
+            if not 1 <= limit <= settings.NEARBY_MAX_PAGE_SIZE:
+                raise NearbyQueryError(f"limit must be between 1 and {settings.NEARBY_MAX_PAGE_SIZE}")
+        self.limit = limit
+
+        open_at = params.get('open_at')
+        if open_at:
+            try:
+                open_at = parse_datetime(open_at)
+            except ValueError:
+                open_at = None
+            if open_at is None:
+                raise NearbyQueryError("Invalid open_at value")
+            if timezone.is_naive(open_at):
+                open_at = timezone.make_aware(open_at)
+        elif params.get('open_now', '').lower() in ('1', 'true', 'yes'):
+            open_at = timezone.now()
+        else:
+            open_at = None
+        # The open set only changes on the minute
+        self.open_at = open_at.replace(second=0, microsecond=0) if open_at else None
+
+    def cache_key(self, location):
+        """
+        Return the cache key of the bucket this query falls in (see
+        nearby_cache.quantize), or None when it is not cached: while
+        NEARBY_CACHE_TIMEOUT is unset and for searches without a radius.
+        `location` is the endpoint's absolute URL without the query string,
+        as the rendered rows hold absolute URLs.
+        """
+        if not settings.NEARBY_CACHE_TIMEOUT or self.radius is None:
+            return None
+        geohash, *self.bucket = nearby_cache.quantize(self.latitude, self.longitude, self.radius)
+        return nearby_cache.make_key({
+            'location': location,
+            'geohash': geohash,
+            'radius': self.bucket[2],
+            'view': self.view,
+            'fields': list(self.fields),
+            'open_at': self.open_at.timestamp() if self.open_at else None,
+        })
+
+    def bucket_search_args(self, candidates=None):
+        # One more than an entry may hold, to tell whether the bucket fits
+        return tuple(self.bucket), {
+            'limit': settings.NEARBY_CACHE_MAX_ROWS + 1,
+            'after': None,
+            'candidates': candidates,
+        }
+
+    @staticmethod
+    def fits_cache(bucket_hits):
+        return len(bucket_hits) <= settings.NEARBY_CACHE_MAX_ROWS
+
+    @staticmethod
+    def cache_rows(points, data):
+        """
+        The cached rows of a rendered bucket: [id, latitude, longitude, row]
+        for each (id, latitude, longitude) point and its serialized row.
+        """
+        return [[clinic_id, latitude, longitude, row] for (clinic_id, latitude, longitude), row in zip(points, data)]
+
+    def select(self, rows):
+        """
+        This query's page of a bucket's cached rows as (hits, data, has_next),
+        with the radius, distances and cursor measured from its own point.
+        """
+        selected = []
+        for clinic_id, latitude, longitude, row in rows:
+            distance = haversine_distance(self.latitude, self.longitude, latitude, longitude)
+            if distance > self.radius or (self.after is not None and (distance, clinic_id) <= self.after):
+                continue
+            selected.append((distance, clinic_id, row))
+        selected.sort(key=lambda item: item[:2])
+        hits, has_next = self.paginate([(distance, clinic_id) for distance, clinic_id, _ in selected])
+        data = []
+        for distance, _, row in selected[:len(hits)]:
+            if 'distance' in row:
+                row['distance'] = distance
+            data.append(row)
+        return hits, data, has_next
+
+    def open_candidates(self):
+        """The ids of the clinics open at open_at, or None when not filtering on it."""
+        if self.open_at is None:
+            return None
+        return open_hours_index.open_at(self.open_at)
+
+    def search_args(self, candidates=None):
+        # Ask for one extra hit to find out whether there is a next page
+        return (self.latitude, self.longitude, self.radius), {
+            'limit': self.limit + 1 if self.limit is not None else None,
+            'after': self.after,
+            'candidates': candidates,
+        }
+
+    def paginate(self, hits):
+        """Split the backend's hits into this page and whether there is another one."""
+        return hits[:self.limit], self.limit is not None and len(hits) > self.limit
+
+    def payload(self, data, hits, has_next, url):
+        """Wrap a page of results in {"next", "results"} when paginating."""
+        if self.limit is None:
+            return data
+        next_url = None
+        if has_next:
+            next_url = replace_query_param(url, 'cursor', encode_cursor(*hits[-1]))
+        return {"next": next_url, "results": data}
+
+
+def order_clinics(hits, clinics):
+    """Put the {id: clinic} instances in hit order, annotated with their distance."""
+    nearby_clinics = []
+    for distance, clinic_id in hits:
+        clinic = clinics.get(clinic_id)
+        if clinic is None:
+            # Deleted since the search backend saw it
+            continue
+        clinic.distance = distance
+        nearby_clinics.append(clinic)
+    return nearby_clinics
+
+
+def summary_querysets(hits, fields):
+    """
+    The values() querysets ClinicSummarySerializer rows are built from:
+    (clinics, images, hours). Images and hours are None unless those fields
+    are requested.
+    """
+    ids = [clinic_id for _, clinic_id in hits]
+    clinics = DentalClinic.objects.filter(pk__in=ids).values(
+        'id', 'name', 'latitude', 'longitude', 'review_count', 'review_rating_sum'
+    )
+    images = None
+    if 'primary_image' in fields:
+        images = ClinicImage.objects.filter(clinic_id__in=ids).order_by('-is_primary', 'id').values(
+            'clinic_id', 'image_file', 'image_url', 'variants'
+        )
+    hours = None
+    if 'today_hours' in fields:
+        hours = BusinessHours.objects.filter(clinic_id__in=ids, day=timezone.localdate().weekday()).values(
+            'clinic_id', 'opening_time', 'closing_time', 'is_closed'
+        )
+    return clinics, images, hours
+
+
+def summary_rows(hits, clinic_rows, image_rows, hour_rows, build_absolute_uri):
+    """
+    Merge the evaluated summary_querysets() rows into one
+    ClinicSummarySerializer row per clinic, in hit order.
+    """
+    clinics = {row['id']: row for row in clinic_rows}
+
+    primary_images = {}
+    storage = ClinicImage._meta.get_field('image_file').storage
+    variant = settings.CLINIC_IMAGE_SUMMARY_VARIANT
+    for image in image_rows or ():
+        if image['clinic_id'] in primary_images:
+            continue
+        if variant in image['variants']:
+            # A list screen does not need the full size upload
+            primary_images[image['clinic_id']] = build_absolute_uri(storage.url(image['variants'][variant]['webp']))
+        elif image['image_file']:
+            primary_images[image['clinic_id']] = build_absolute_uri(storage.url(image['image_file']))
+        elif image['image_url']:
+            primary_images[image['clinic_id']] = image['image_url']
+
+    today_hours = {}
+    for row in hour_rows or ():
+        today_hours[row.pop('clinic_id')] = row
+
+    summaries = []
+    for distance, clinic_id in hits:
+        row = clinics.get(clinic_id)
+        if row is None:
+            continue
+        review_count = row.pop('review_count')
+        review_rating_sum = row.pop('review_rating_sum')
+        row.update(
+            distance=distance,
+            average_rating=review_rating_sum / review_count if review_count else None,
+            primary_image=primary_images.get(clinic_id),
+            today_hours=today_hours.get(clinic_id),
+        )
+        summaries.append(row)
+    return summaries
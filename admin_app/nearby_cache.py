@@ -0,0 +1,84 @@
+import hashlib
+import json
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .spatial import geohash_cell, haversine_distance
+
+GENERATION_KEY = 'nearby:generation'
+HITS_KEY = 'nearby:hits'
+MISSES_KEY = 'nearby:misses'
+
+
+def quantize(latitude, longitude, radius):
+    """
+    The cache bucket of a nearby query: the geohash cell
+    (NEARBY_CACHE_GEOHASH_PRECISION) holding the point, and a radius around
+    the cell's center that covers the query's circle, rounded up to whole
+    kilometers up to 10 km, 5 km steps up to 100 km and 25 km steps beyond.
+    Queries in the same bucket are all answered from the clinics within it.
+    Returns (geohash, latitude, longitude, radius) of the bucket.
+    """
+    geohash, center_latitude, center_longitude = geohash_cell(
+        latitude, longitude, settings.NEARBY_CACHE_GEOHASH_PRECISION
+    )
+    # A clinic within `radius` of the point is within this of the center
+    reach = radius + haversine_distance(latitude, longitude, center_latitude, center_longitude)
+    step = 1 if reach <= 10 else 5 if reach <= 100 else 25
+    return geohash, center_latitude, center_longitude, float(math.ceil(reach / step) * step)
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never goes back to a
+        # generation that still has entries cached under it
+        cache.add(GENERATION_KEY, time.time_ns() // 1000, timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """Invalidate every cached nearby response."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        get_generation()
+
+
+def make_key(params):
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return f"nearby:{get_generation()}:{digest}"
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def lookup(key):
+    """Return the cached response for key, or None, counting the hit or miss."""
+    value = cache.get(key)
+    _count(MISSES_KEY if value is None else HITS_KEY)
+    return value
+
+
+def store(key, value):
+    cache.set(key, value, timeout=settings.NEARBY_CACHE_TIMEOUT)
+
+
+def stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else None,
+        'generation': get_generation(),
+    }
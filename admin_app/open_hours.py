@@ -0,0 +1,162 @@
+"""
+Opening hours as weekly minute intervals.
+
+Each clinic stores `open_intervals`: the sorted, merged [start, end) ranges
+it is open, in minutes since Monday 00:00 of the clinic's local time.
+Overnight hours run into the next day and Sunday night wraps around to
+Monday morning. OpenHoursIndex answers "which clinics are open at instant T"
+from these intervals without touching BusinessHours.
+"""
+import threading
+import time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from django.conf import settings
+
+from .models import DentalClinic
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def _minutes(value):
+    minutes = value.hour * 60 + value.minute
+    # 23:59 is how "until midnight" is usually entered
+    return MINUTES_PER_DAY if minutes == MINUTES_PER_DAY - 1 else minutes
+
+
+def weekly_intervals(hours):
+    """
+    Return the merged weekly intervals for (day, opening_time, closing_time,
+    is_closed) rows. A closing time at or before the opening time closes the
+    next day, so equal times mean open around the clock.
+    """
+    intervals = []
+    for day, opening_time, closing_time, is_closed in hours:
+        if is_closed or opening_time is None or closing_time is None:
+            continue
+        start = day * MINUTES_PER_DAY + _minutes(opening_time)
+        end = day * MINUTES_PER_DAY + _minutes(closing_time)
+        if end <= start:
+            end += MINUTES_PER_DAY
+        if end > MINUTES_PER_WEEK:
+            intervals.append([start, MINUTES_PER_WEEK])
+            intervals.append([0, end - MINUTES_PER_WEEK])
+        else:
+            intervals.append([start, end])
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def minute_of_week(moment):
+    """Minutes since Monday 00:00 of an aware or local datetime, in its own timezone."""
+    return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+
+def default_timezone():
+    """The zone the hours of clinics without a timezone are read in."""
+    return settings.OPEN_HOURS_DEFAULT_TIMEZONE or settings.TIME_ZONE
+
+
+class OpenHoursIndex:
+    """
+    In-process index of every clinic's open intervals.
+
+    Intervals are grouped by clinic timezone into NumPy arrays, so finding
+    the clinics open at an instant is one vectorized comparison per timezone
+    after converting the instant to that timezone's local minute of the week.
+    Like the nearby indexes it is loaded lazily, kept in sync by the signal
+    handlers and reloaded every `max_age` seconds.
+
+    Clinics without a timezone use OPEN_HOURS_DEFAULT_TIMEZONE, or
+    settings.TIME_ZONE while that is unset, as the index always did before
+    clinics had a timezone of their own.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._clinics = {}
+        self._arrays = None
+        self._last = (None, None)
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return bool(self.max_age) and time.monotonic() - self._loaded_at > self.max_age
+
+    def rebuild(self):
+        """Reload every clinic's intervals from the database."""
+        rows = DentalClinic.objects.values_list('id', 'timezone', 'open_intervals')
+        clinics = {}
+        for clinic_id, tz, intervals in rows:
+            clinics[clinic_id] = (tz or default_timezone(), intervals)
+        with self._lock:
+            self._clinics = clinics
+            self._arrays = None
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.rebuild()
+
+    def reload(self, clinic_ids):
+        """Re-read some clinics after a write. Ignored until the index has been loaded."""
+        if self._loaded_at is None:
+            return
+        rows = DentalClinic.objects.filter(pk__in=clinic_ids).values_list('id', 'timezone', 'open_intervals')
+        with self._lock:
+            for clinic_id, tz, intervals in rows:
+                self._clinics[clinic_id] = (tz or default_timezone(), intervals)
+            self._arrays = None
+
+    def remove(self, clinic_id):
+        with self._lock:
+            if self._clinics.pop(clinic_id, None) is not None:
+                self._arrays = None
+
+    def _build_arrays(self):
+        grouped = {}
+        for clinic_id, (tz, intervals) in self._clinics.items():
+            entries = grouped.setdefault(tz, ([], [], []))
+            for start, end in intervals:
+                entries[0].append(start)
+                entries[1].append(end)
+                entries[2].append(clinic_id)
+        return {
+            ZoneInfo(tz): tuple(np.array(values, dtype=np.int64) for values in entries)
+            for tz, entries in grouped.items()
+        }
+
+    def open_at(self, moment):
+        """Return the frozenset of ids of the clinics open at the aware datetime `moment`."""
+        self.ensure_loaded()
+        moment = moment.replace(second=0, microsecond=0)
+        with self._lock:
+            if self._arrays is None:
+                self._arrays = self._build_arrays()
+                self._last = (None, None)
+            # Consecutive queries mostly ask about the same minute
+            if self._last[0] == moment:
+                return self._last[1]
+
+            open_ids = set()
+            for tz, (starts, ends, ids) in self._arrays.items():
+                minute = minute_of_week(moment.astimezone(tz))
+                open_ids.update(ids[(starts <= minute) & (minute < ends)].tolist())
+            result = frozenset(open_ids)
+            self._last = (moment, result)
+            return result
+
+
+open_hours_index = OpenHoursIndex(max_age=settings.NEARBY_INDEX_MAX_AGE)
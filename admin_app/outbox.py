@@ -0,0 +1,261 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Case, Count, DurationField, ExpressionWrapper, F, Max, Min, Q, Value, When
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from authentication.models import VisitedUserData
+
+from .models import WebhookOutbox
+
+logger = logging.getLogger(__name__)
+
+LAST_BATCH_KEY = 'webhook_outbox:last_batch'
+
+# Shared by the delivery threads, so the pool holds one connection per thread
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=settings.WEBHOOK_CONCURRENCY))
+session.mount('http://', HTTPAdapter(pool_maxsize=settings.WEBHOOK_CONCURRENCY))
+
+
+def record_submission(answers):
+    """Save a questionnaire submission and queue it for the webhook in one transaction."""
+    with transaction.atomic():
+        VisitedUserData.objects.update_or_create(
+            email=answers["email"],
+            defaults={
+                "emergency": answers.get("emergency", ""),
+                "factors": answers.get("factors", []),
+                "lastVisit": answers.get("lastVisit", ""),
+                "anxiety": answers.get("anxiety", ""),
+                "timePreference": answers.get("timePreference", []),
+                "hasInsurance": answers.get("hasInsurance", ""),
+                "insuranceProvider": answers.get("insuranceProvider", ""),
+                "paymentOption": answers.get("paymentOption", ""),
+            }
+        )
+        enqueue(answers["email"], answers)
+
+
+def enqueue(email, payload):
+    """
+    Queue payload for delivery to the lead webhook. Call inside the
+    transaction that saves the submission; the drain task is scheduled once
+    it commits.
+    """
+    now = timezone.now()
+    values = {
+        'payload': payload,
+        'status': WebhookOutbox.PENDING,
+        'version': F('version') + 1,
+        'attempts': 0,
+        'next_attempt_at': now,
+        'last_error': '',
+        # A payload that replaces a queued one keeps the original queue time
+        'enqueued_at': Case(When(status=WebhookOutbox.PENDING, then=F('enqueued_at')), default=Value(now)),
+    }
+    if not WebhookOutbox.objects.filter(email=email).update(**values):
+        try:
+            with transaction.atomic():
+                WebhookOutbox.objects.create(email=email, payload=payload, enqueued_at=now, next_attempt_at=now)
+        except IntegrityError:
+            # A concurrent submission for the same email created the row first
+            WebhookOutbox.objects.filter(email=email).update(**values)
+
+    transaction.on_commit(schedule_drain)
+
+
+def schedule_drain():
+    from .tasks import drain_webhook_outbox
+
+    try:
+        drain_webhook_outbox.delay()
+    except Exception:
+        # The periodic drain picks the row up once the broker is back
+        logger.warning("Could not schedule the webhook outbox drain", exc_info=True)
+
+
+def backoff(attempts):
+    """Seconds to wait before retry number `attempts`, with jitter."""
+    delay = min(settings.WEBHOOK_OUTBOX_BACKOFF * 2 ** (attempts - 1), settings.WEBHOOK_OUTBOX_MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1)
+
+
+def claim_batch(batch_size):
+    """Mark up to batch_size due rows as being sent and return them."""
+    now = timezone.now()
+    claim_timeout = timedelta(seconds=settings.WEBHOOK_OUTBOX_CLAIM_TIMEOUT)
+    with transaction.atomic():
+        rows = list(
+            WebhookOutbox.objects.select_for_update(skip_locked=True)
+            .due(now, claim_timeout)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        WebhookOutbox.objects.filter(pk__in=[row.pk for row in rows]).update(
+            status=WebhookOutbox.SENDING, claimed_at=now
+        )
+    return rows
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(rate, burst):
+    """
+    The process-wide TokenBucket for (rate, burst). Drains run back to back
+    from the beat schedule, so a bucket per drain() call would hand every
+    run a fresh burst and let the process go over `rate`.
+    """
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get((rate, burst))
+        if limiter is None:
+            limiter = _rate_limiters[rate, burst] = TokenBucket(rate, burst=burst)
+        return limiter
+
+
+def send(row, rate_limiter=None):
+    """
+    POST one claimed row to the webhook and return the outbox fields that
+    record the outcome. Touches no database connection, so it is safe to run
+    in a worker thread.
+    """
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    try:
+        response = session.post(settings.LEADCONNECTOR_WEBHOOK_URL, json=row.payload, timeout=settings.WEBHOOK_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        attempts = row.attempts + 1
+        status_code = getattr(e.response, 'status_code', None)
+        # Client errors other than rate limiting will not succeed on a retry
+        permanent = status_code is not None and 400 <= status_code < 500 and status_code != 429
+        if permanent or attempts >= settings.WEBHOOK_OUTBOX_MAX_ATTEMPTS:
+            status = WebhookOutbox.FAILED
+        else:
+            status = WebhookOutbox.PENDING
+        logger.warning("Webhook delivery for %s failed (attempt %s): %s", row.email, attempts, e)
+        return {
+            'status': status,
+            'attempts': attempts,
+            'next_attempt_at': timezone.now() + timedelta(seconds=backoff(attempts)),
+            'claimed_at': None,
+            'last_error': str(e)[:1000],
+        }
+    return {'status': WebhookOutbox.DELIVERED, 'delivered_at': timezone.now(), 'claimed_at': None, 'last_error': ''}
+
+
+def record(rows, outcomes):
+    """
+    Save the outcome of each sent row. Deliveries are marked in a single
+    UPDATE; failures carry their own attempt count and retry time.
+
+    Only rows whose version is unchanged are touched: a newer submission that
+    re-queued a row while it was being sent stays pending so the new payload
+    goes out too.
+    """
+    delivered = Q(pk__in=[])
+    for row, values in zip(rows, outcomes):
+        if values['status'] == WebhookOutbox.DELIVERED:
+            delivered |= Q(pk=row.pk, version=row.version)
+        else:
+            WebhookOutbox.objects.filter(pk=row.pk, version=row.version).update(**values)
+    WebhookOutbox.objects.filter(delivered).update(
+        status=WebhookOutbox.DELIVERED, delivered_at=timezone.now(), claimed_at=None, last_error=''
+    )
+
+
+def drain(batch_size=None, concurrency=None, rate=None):
+    """
+    Deliver every due row, batch_size at a time. Each batch is sent over
+    `concurrency` threads sharing the pooled session, throttled to `rate`
+    requests per second for this process. Returns counts per outcome.
+    """
+    batch_size = batch_size or settings.WEBHOOK_OUTBOX_BATCH_SIZE
+    concurrency = concurrency or settings.WEBHOOK_CONCURRENCY
+    rate = rate if rate is not None else settings.WEBHOOK_RATE_LIMIT
+    rate_limiter = get_rate_limiter(rate, concurrency) if rate else None
+    counts = {WebhookOutbox.DELIVERED: 0, WebhookOutbox.PENDING: 0, WebhookOutbox.FAILED: 0}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            rows = claim_batch(batch_size)
+            if not rows:
+                return counts
+
+            started = time.monotonic()
+            outcomes = list(pool.map(lambda row: send(row, rate_limiter), rows))
+            elapsed = time.monotonic() - started
+            record(rows, outcomes)
+
+            batch = {WebhookOutbox.DELIVERED: 0, WebhookOutbox.PENDING: 0, WebhookOutbox.FAILED: 0}
+            for values in outcomes:
+                batch[values['status']] += 1
+                counts[values['status']] += 1
+            batch.update(size=len(rows), seconds=elapsed, per_second=len(rows) / elapsed if elapsed else None)
+            cache.set(LAST_BATCH_KEY, batch, timeout=None)
+            logger.info(
+                "Webhook batch: %s sent in %.2fs (%.1f/s), %s delivered, %s retrying, %s failed",
+                len(rows), elapsed, batch['per_second'] or 0, batch[WebhookOutbox.DELIVERED],
+                batch[WebhookOutbox.PENDING], batch[WebhookOutbox.FAILED],
+            )
+
+
+def stats():
+    """Queue depth, failures and the delivery latency over the last hour, in seconds."""
+    now = timezone.now()
+    latency = ExpressionWrapper(F('delivered_at') - F('enqueued_at'), output_field=DurationField())
+    totals = WebhookOutbox.objects.aggregate(
+        pending=Count('pk', filter=Q(status=WebhookOutbox.PENDING)),
+        sending=Count('pk', filter=Q(status=WebhookOutbox.SENDING)),
+        failed=Count('pk', filter=Q(status=WebhookOutbox.FAILED)),
+        retrying=Count('pk', filter=Q(status=WebhookOutbox.PENDING, attempts__gt=0)),
+        oldest_pending=Min('enqueued_at', filter=Q(status__in=[WebhookOutbox.PENDING, WebhookOutbox.SENDING])),
+    )
+    delivered = WebhookOutbox.objects.filter(status=WebhookOutbox.DELIVERED, delivered_at__gte=now - timedelta(hours=1))
+    recent = delivered.aggregate(
+        delivered=Count('pk'),
+        average_latency=Avg(latency),
+        max_latency=Max(latency),
+    )
+    oldest_pending = totals.pop('oldest_pending')
+    return {
+        **totals,
+        'oldest_pending_age': (now - oldest_pending).total_seconds() if oldest_pending else None,
+        'delivered_last_hour': recent['delivered'],
+        'average_latency': recent['average_latency'].total_seconds() if recent['average_latency'] else None,
+        'max_latency': recent['max_latency'].total_seconds() if recent['max_latency'] else None,
+        'last_batch': cache.get(LAST_BATCH_KEY),
+    }
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination on the primary key, the default for list endpoints.
+
+    Each page is a `WHERE id > ...` seek on the primary key index rather than
+    an OFFSET, and no COUNT(*) is run, so a deep page costs the same as the
+    first one. Pages hold PAGE_SIZE rows, or `page_size` up to max_page_size.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class ReviewPagination(KeysetPagination):
+    # Newest first
+    ordering = '-id'
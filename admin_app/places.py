@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from OpenCare.metrics import timed
+
+# Upstream statuses worth caching; anything else (quota, auth or transient
+# errors) is returned to the caller but retried on the next lookup
+CACHEABLE_STATUSES = {'OK', 'ZERO_RESULTS', 'NOT_FOUND'}
+
+
+class PlaceDetailsError(Exception):
+    """An upstream Place Details call failed, over either HTTP client."""
+
+
+class PlaceDetailsClient:
+    """
+    Google Place Details lookups through a pooled requests.Session, or an
+    httpx.AsyncClient for async callers.
+
+    Responses are kept in an in-process LRU cache of `max_entries` place ids
+    for `ttl` seconds. Concurrent lookups of the same uncached place id are
+    coalesced: the first caller fetches and the others wait for its result.
+    The upstream URL is read from settings.GOOGLE_PLACE_DETAILS_URL on every
+    fetch so tests can point it at a local fake server.
+    """
+
+    def __init__(self, ttl, max_entries, timeout, pool_size=10):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._in_flight = {}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _cached(self, place_id):
+        entry = self._cache.get(place_id)
+        if entry is None:
+            return None
+        expires_at, data = entry
+        if expires_at <= time.monotonic():
+            del self._cache[place_id]
+            return None
+        self._cache.move_to_end(place_id)
+        return data
+
+    def _store(self, place_id, data):
+        self._cache[place_id] = (time.monotonic() + self.ttl, data)
+        self._cache.move_to_end(place_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def fetch(self, place_id):
+        """Fetch one place from upstream, bypassing the cache. Raises PlaceDetailsError."""
+        try:
+            response = self.session.get(
+                settings.GOOGLE_PLACE_DETAILS_URL,
+                params={"place_id": place_id, "key": settings.GOOGLE_MAPS_API_KEY},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            raise PlaceDetailsError(str(e)) from e
+
+    def _async_client(self):
+        # httpx pools are bound to the event loop that created them
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            connect, read = self.timeout
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.pool_size),
+            )
+        return client
+
+    async def afetch(self, place_id):
+        """fetch() over the async HTTP client."""
+        try:
+            response = await self._async_client().get(
+                settings.GOOGLE_PLACE_DETAILS_URL,
+                params={"place_id": place_id, "key": settings.GOOGLE_MAPS_API_KEY},
+            )
+            response.raise_for_status()
+            return response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            # Both transports fail alike, as lookups in flight are shared by sync and async callers
+            raise PlaceDetailsError(str(e)) from e
+
+    def _join(self, place_id):
+        """
+        Return (data, future, leader): the cached data, or the future of the
+        lookup in flight and whether this caller has to perform it.
+        """
+        with self._lock:
+            data = self._cached(place_id)
+            if data is not None:
+                return data, None, False
+            future = self._in_flight.get(place_id)
+            leader = future is None
+            if leader:
+                future = self._in_flight[place_id] = Future()
+            return None, future, leader
+
+    def _finish(self, place_id, future, data=None, error=None):
+        with self._lock:
+            del self._in_flight[place_id]
+            if error is None and isinstance(data, dict) and data.get('status') in CACHEABLE_STATUSES:
+                self._store(place_id, data)
+        if error is None:
+            future.set_result(data)
+        else:
+            future.set_exception(error)
+
+    def get(self, place_id):
+        """
+        Return the Place Details response for place_id. Raises
+        PlaceDetailsError when the upstream call fails.
+        """
+        data, future, leader = self._join(place_id)
+        if future is None:
+            return data
+        if not leader:
+            with timed('http'):
+                return future.result()
+
+        try:
+            with timed('http'):
+                data = self.fetch(place_id)
+        except BaseException as e:
+            self._finish(place_id, future, error=e)
+            raise
+        self._finish(place_id, future, data)
+        return data
+
+    async def aget(self, place_id):
+        """
+        get() for async callers. Shares the cache and in-flight lookups with
+        get(). Raises PlaceDetailsError when the upstream call fails.
+        """
+        data, future, leader = self._join(place_id)
+        if future is None:
+            return data
+        if not leader:
+            with timed('http'):
+                return await asyncio.wrap_future(future)
+
+        try:
+            with timed('http'):
+                data = await self.afetch(place_id)
+        except BaseException as e:
+            self._finish(place_id, future, error=e)
+            raise
+        self._finish(place_id, future, data)
+        return data
+
+
+place_details = PlaceDetailsClient(
+    ttl=settings.PLACE_DETAILS_CACHE_TTL,
+    max_entries=settings.PLACE_DETAILS_CACHE_SIZE,
+    timeout=settings.PLACE_DETAILS_TIMEOUT,
+)
@@ -0,0 +1,287 @@
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, models, transaction
+from django.db.models import F, Prefetch, Q
+from django.utils import timezone
+
+from .models import BusinessHours, DentalClinic, Review
+from .nearby_cache import bump_generation
+from .places import PlaceDetailsError, place_details
+from .serializers import DentalClinicSerializer
+from .spatial import index_clinics
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'clinic_refresh:lock'
+
+def parse_time(value):
+    return datetime.strptime(value, '%H%M').time()
+
+
+def clean_values(model, values):
+    """
+    The values that fit their `model` field, after running them through the
+    field's validation. Text too long for a plain CharField is cut to its
+    max_length; anything else that does not validate, like a too long URL or
+    an out of range rating, is left out.
+    """
+    cleaned = {}
+    for name, value in values.items():
+        field = model._meta.get_field(name)
+        if isinstance(value, str) and field.max_length and not isinstance(field, models.URLField):
+            value = value[:field.max_length]
+        try:
+            cleaned[name] = field.clean(value, None)
+        except ValidationError as e:
+            logger.warning("Place Details value for %s.%s dropped: %s", model.__name__, name, '; '.join(e.messages))
+    return cleaned
+
+
+def place_fields(result):
+    """The valid DentalClinic field values present in a Place Details result."""
+    values = {
+        'name': result.get('name'),
+        'address': result.get('formatted_address'),
+        'rating': result.get('rating'),
+        'phone_number': result.get('formatted_phone_number'),
+        'website': result.get('website'),
+    }
+    location = result.get('geometry', {}).get('location')
+    if location:
+        values['latitude'] = location['lat']
+        values['longitude'] = location['lng']
+    return clean_values(DentalClinic, {field: value for field, value in values.items() if value is not None})
+
+
+def place_hours(result):
+    """
+    BusinessHours data from the result's opening hours, or None when the
+    result has none. Google numbers days from Sunday.
+
+    A clinic stores one opening and closing time per day, where a closing
+    time at or before the opening time closes the next day. Days with
+    several periods, or with a period longer than that, cannot be stored
+    and are left out of the data, so their current hours are kept.
+    """
+    periods = result.get('opening_hours', {}).get('periods')
+    if periods is None:
+        return None
+
+    by_day = {}
+    for period in periods:
+        if 'close' not in period:
+            # A single open period without a close means open around the clock
+            return [
+                {'day': weekday, 'opening_time': parse_time('0000'), 'closing_time': parse_time('2359'), 'is_closed': False}
+                for weekday in range(7)
+            ]
+        by_day.setdefault((period['open']['day'] + 6) % 7, []).append(period)
+
+    hours = []
+    for day in range(7):
+        day_periods = by_day.get(day)
+        if not day_periods:
+            hours.append({'day': day, 'opening_time': None, 'closing_time': None, 'is_closed': True})
+            continue
+        if len(day_periods) > 1:
+            continue
+        period = day_periods[0]
+        try:
+            opening, closing = parse_time(period['open']['time']), parse_time(period['close']['time'])
+        except ValueError:
+            continue
+        nights = (period['close']['day'] - period['open']['day']) % 7
+        if nights != (1 if closing <= opening else 0):
+            continue
+        hours.append({'day': day, 'opening_time': opening, 'closing_time': closing, 'is_closed': False})
+    return hours
+
+
+def place_reviews(clinic, result):
+    """
+    Reviews in the result the clinic does not have yet, matched on author and
+    text. Reviews without a valid author or rating are skipped.
+    """
+    known = {(review.author_name, review.text) for review in clinic.reviews.all()}
+    reviews = []
+    for review in result.get('reviews', []):
+        values = clean_values(Review, {
+            'author_name': review.get('author_name'),
+            'author_photo_url': review.get('profile_photo_url'),
+            'rating': review.get('rating'),
+        })
+        text = review.get('text', '')
+        if 'author_name' not in values or 'rating' not in values or (values['author_name'], text) in known:
+            continue
+        known.add((values['author_name'], text))
+        reviews.append(Review(clinic=clinic, text=text, **values))
+    return reviews
+
+
+def fetch(clinic):
+    """Return the clinic's Place Details result, or None when it cannot be fetched."""
+    try:
+        data = place_details.fetch(clinic.place_id)
+    except PlaceDetailsError as e:
+        logger.warning("Place Details for clinic %s failed: %s", clinic.pk, e)
+        return None
+    if data.get('status') != 'OK':
+        logger.warning("Place Details for clinic %s returned %s", clinic.pk, data.get('status'))
+        return None
+    return data['result']
+
+
+def write_results(results, now):
+    """
+    Apply {clinic_id: Place Details result} to the clinics with bulk writes,
+    in the current transaction, and return the ids of those that changed.
+
+    The clinics and their hours are re-read under a lock, so only what
+    differs from their current state is written and edits made since the
+    batch was picked are kept.
+    """
+    clinics = (
+        DentalClinic.objects.select_for_update()
+        .prefetch_related(
+            Prefetch('business_hours', queryset=BusinessHours.objects.select_for_update()),
+            'reviews',
+        )
+        .in_bulk(list(results))
+    )
+
+    fields = set()
+    updated = []
+    moved = []
+    hours_to_create, hours_to_update = [], []
+    hours_changed = []
+    reviews = []
+    for clinic_id, clinic in clinics.items():
+        result = results[clinic_id]
+        values = {field: value for field, value in place_fields(result).items() if getattr(clinic, field) != value}
+        if values:
+            for field, value in values.items():
+                setattr(clinic, field, value)
+            fields.update(values)
+            updated.append(clinic)
+            if 'latitude' in values or 'longitude' in values:
+                moved.append((clinic.pk, clinic.latitude, clinic.longitude))
+
+        hours = place_hours(result)
+        if hours is not None:
+            # Days place_hours() leaves out keep their hours, so nothing is deleted
+            to_create, to_update, _ = DentalClinicSerializer.diff_business_hours(clinic, hours)
+            hours_to_create += to_create
+            hours_to_update += to_update
+            if to_create or to_update:
+                hours_changed.append(clinic_id)
+
+        reviews += place_reviews(clinic, result)
+
+    changed = {clinic.pk for clinic in updated} | set(hours_changed) | {review.clinic_id for review in reviews}
+    if not changed:
+        return changed
+
+    # The bulk writes below bypass auto_now and the signal handlers
+    DentalClinic.objects.filter(pk__in=changed).update(updated_at=now)
+    if updated:
+        DentalClinic.objects.bulk_update(updated, sorted(fields))
+        DentalClinic.objects.filter(pk__in=[clinic.pk for clinic in updated]).refresh_search_vectors()
+    BusinessHours.objects.bulk_update(hours_to_update, ['opening_time', 'closing_time', 'is_closed'])
+    BusinessHours.objects.bulk_create(hours_to_create)
+    if hours_changed:
+        # Also reloads the open hours index once committed
+        DentalClinic.objects.filter(pk__in=hours_changed).refresh_open_intervals()
+    Review.objects.bulk_create(reviews)
+
+    if moved:
+        transaction.on_commit(lambda: index_clinics(moved))
+    transaction.on_commit(bump_generation)
+    return changed
+
+
+def refresh_stale_clinics(batch_size=None, concurrency=None, min_age=None):
+    """
+    Refresh the `batch_size` least recently refreshed clinics that have a
+    place_id and were not refreshed in the last `min_age` seconds.
+
+    Place Details are fetched over `concurrency` threads, then only what
+    changed is written (see write_results), in one transaction: the changed
+    fields of the changed clinics, the changed business hours and the new
+    reviews. Values that do not fit their field are left out. Should the
+    database still reject the batch, each clinic is written in its own
+    savepoint and the ones it rejects are counted as failed. Moved clinics
+    are re-indexed for nearby searches once committed.
+
+    Every fetched clinic gets a new refreshed_at, committed before any of
+    that, so it moves to the back of the queue even when nothing changed or
+    its lookup or write failed; updated_at only moves for the clinics that
+    changed, so incremental exports skip the others.
+
+    A cache lock keeps overlapping runs from refreshing the same clinics.
+    Returns a summary of the run, or None if another run holds the lock.
+    """
+    batch_size = batch_size or settings.CLINIC_REFRESH_BATCH_SIZE
+    concurrency = concurrency or settings.CLINIC_REFRESH_CONCURRENCY
+    min_age = min_age if min_age is not None else settings.CLINIC_REFRESH_MIN_AGE
+
+    token = uuid.uuid4().hex
+    if not cache.add(LOCK_KEY, token, timeout=settings.CLINIC_REFRESH_LOCK_TIMEOUT):
+        logger.info("Clinic refresh skipped: another run holds the lock")
+        return None
+    try:
+        return _refresh(batch_size, concurrency, min_age)
+    finally:
+        if cache.get(LOCK_KEY) == token:
+            cache.delete(LOCK_KEY)
+
+
+def _refresh(batch_size, concurrency, min_age):
+    started = time.monotonic()
+    now = timezone.now()
+    clinics = list(
+        DentalClinic.objects.exclude(place_id__isnull=True).exclude(place_id='')
+        .filter(Q(refreshed_at__isnull=True) | Q(refreshed_at__lt=now - timedelta(seconds=min_age)))
+        .order_by(F('refreshed_at').asc(nulls_first=True), 'id')[:batch_size]
+    )
+    if not clinics:
+        return {'refreshed': 0, 'changed': 0, 'failed': 0, 'seconds': time.monotonic() - started}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, clinics))
+
+    # Committed on its own, so clinics whose changes cannot be written still
+    # move to the back of the queue
+    DentalClinic.objects.filter(pk__in=[clinic.pk for clinic in clinics]).update(refreshed_at=now)
+
+    fetched = {clinic.pk: result for clinic, result in zip(clinics, results) if result is not None}
+    rejected = 0
+    try:
+        with transaction.atomic():
+            changed = write_results(fetched, now)
+    except DatabaseError as e:
+        # Find the clinics at fault, writing each one in its own savepoint
+        logger.warning("Clinic refresh batch rejected by the database, retrying clinic by clinic: %s", e)
+        changed = set()
+        for clinic_id, result in fetched.items():
+            try:
+                with transaction.atomic():
+                    changed |= write_results({clinic_id: result}, now)
+            except DatabaseError as e:
+                logger.warning("Refresh of clinic %s rejected by the database: %s", clinic_id, e)
+                rejected += 1
+
+    report = {
+        'refreshed': len(clinics),
+        'changed': len(changed),
+        'failed': results.count(None) + rejected,
+        'seconds': time.monotonic() - started,
+    }
+    logger.info("Clinic refresh: %(refreshed)s fetched, %(changed)s changed, %(failed)s failed in %(seconds).1fs", report)
+    return report
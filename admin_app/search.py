@@ -0,0 +1,143 @@
+"""
+Text search over clinics and their reviews.
+
+On PostgreSQL every clinic stores `search_vector`, a weighted tsvector of its
+name (A), address (B), description (C) and review texts (D) kept current by
+DentalClinicQuerySet.refresh_search_vectors. Searches are GIN index lookups
+on that column ranked with ts_rank, and autocomplete is pg_trgm word
+similarity against the trigram index on name. Other databases fall back to
+case-insensitive substring matching, with every match ranked the same.
+"""
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Exists, F, FloatField, OuterRef, Q, Subquery, Value
+from rest_framework.utils.urls import replace_query_param
+
+from .models import DentalClinic, Review
+from .nearby import NearbyQueryError, parse_location
+from .spatial import within_radius
+
+
+def uses_full_text_search():
+    return connection.vendor == 'postgresql'
+
+
+def search_document():
+    """The expression search_vector is computed from, for an UPDATE of DentalClinic."""
+    config = settings.CLINIC_SEARCH_CONFIG
+    review_texts = (
+        Review.objects.filter(clinic=OuterRef('pk')).order_by().values('clinic')
+        .annotate(texts=StringAgg('text', delimiter=' ')).values('texts')
+    )
+    return (
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('address', weight='B', config=config)
+        + SearchVector('description', weight='C', config=config)
+        + SearchVector(Subquery(review_texts), weight='D', config=config)
+    )
+
+
+def matching(queryset, text):
+    """Narrow a DentalClinic queryset to the clinics matching `text`, annotated with its `rank`."""
+    if uses_full_text_search():
+        # websearch syntax: quoted phrases, "or" and -excluded words
+        query = SearchQuery(text, search_type='websearch', config=settings.CLINIC_SEARCH_CONFIG)
+        return queryset.filter(search_vector=query).annotate(rank=SearchRank(F('search_vector'), query))
+
+    in_reviews = Exists(Review.objects.filter(clinic=OuterRef('pk'), text__icontains=text))
+    return queryset.filter(
+        Q(name__icontains=text) | Q(address__icontains=text) | Q(description__icontains=text) | in_reviews
+    ).annotate(rank=Value(1.0, output_field=FloatField()))
+
+
+def autocomplete(text, limit):
+    """Up to `limit` {id, name, address} rows for the clinics whose name best matches the typed prefix."""
+    queryset = DentalClinic.objects.all()
+    if uses_full_text_search():
+        # %> matches when `text` is similar to some run of whole words in the
+        # name, so partial words like "smi" still find "Bright Smile Dental"
+        queryset = (
+            queryset.filter(name__trigram_word_similar=text)
+            .annotate(similarity=TrigramWordSimilarity(text, 'name'))
+            .order_by('-similarity', 'name', 'id')
+        )
+    else:
+        queryset = queryset.filter(name__icontains=text).order_by('name', 'id')
+    return list(queryset.values('id', 'name', 'address')[:limit])
+
+
+class SearchQueryError(ValueError):
+    pass
+
+
+class ClinicSearch:
+    """
+    The validated parameters of a search request. Raises SearchQueryError
+    with a message for the client when they are invalid.
+
+    Query parameters:
+    - q: the search text (required)
+    - lat, lng: rank nearer clinics higher; must be given together
+    - radius: with lat/lng, only clinics within this many kilometers, up to
+      NEARBY_MAX_RADIUS (default: default_radius)
+    - limit: page size (default: CLINIC_SEARCH_PAGE_SIZE, at most
+      NEARBY_MAX_PAGE_SIZE)
+    - offset: number of results to skip, as set in the previous page's
+      `next`; at most CLINIC_SEARCH_MAX_OFFSET
+    """
+
+    def __init__(self, params, default_radius):
+        self.text = params.get('q', '').strip()
+        if not self.text:
+            raise SearchQueryError("The q parameter is required")
+
+        latitude, longitude, radius = params.get('lat'), params.get('lng'), params.get('radius')
+        if bool(latitude) != bool(longitude):
+            raise SearchQueryError("Latitude and longitude must be given together")
+        self.latitude = self.longitude = self.radius = None
+        if latitude:
+            try:
+                self.latitude, self.longitude, self.radius = parse_location(
+                    latitude, longitude, radius if radius is not None else default_radius
+                )
+            except NearbyQueryError as e:
+                raise SearchQueryError(str(e))
+
+        try:
+            self.limit = int(params.get('limit', settings.CLINIC_SEARCH_PAGE_SIZE))
+            self.offset = int(params.get('offset', 0))
+        except ValueError:
+            raise SearchQueryError("Invalid limit or offset value")
+        if not 1 <= self.limit <= settings.NEARBY_MAX_PAGE_SIZE:
+            raise SearchQueryError(f"limit must be between 1 and {settings.NEARBY_MAX_PAGE_SIZE}")
+        # Every skipped row is still ranked, so deep pages are refused
+        if not 0 <= self.offset <= settings.CLINIC_SEARCH_MAX_OFFSET:
+            raise SearchQueryError(f"offset must be between 0 and {settings.CLINIC_SEARCH_MAX_OFFSET}")
+
+    def hits(self):
+        """
+        Return this page's (distance, clinic_id) pairs, best first, and
+        whether there is another page. Distance is None without lat/lng.
+
+        With coordinates the text rank is divided by 1 + distance /
+        CLINIC_SEARCH_DISTANCE_SCALE, so a clinic that far away needs twice
+        the text relevance to place level with one next door.
+        """
+        queryset = matching(DentalClinic.objects.all(), self.text)
+        if self.latitude is None:
+            queryset = queryset.annotate(distance=Value(None, output_field=FloatField()), score=F('rank'))
+        else:
+            queryset = within_radius(queryset, self.latitude, self.longitude, self.radius).annotate(
+                score=F('rank') / (1 + F('distance') / Value(float(settings.CLINIC_SEARCH_DISTANCE_SCALE)))
+            )
+        # One extra row tells whether there is a next page
+        rows = list(
+            queryset.order_by('-score', 'id').values_list('distance', 'id')[self.offset:self.offset + self.limit + 1]
+        )
+        return rows[:self.limit], len(rows) > self.limit
+
+    def payload(self, data, has_next, url):
+        next_url = replace_query_param(url, 'offset', self.offset + self.limit) if has_next else None
+        return {"next": next_url, "results": data}
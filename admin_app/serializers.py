@@ -1,7 +1,14 @@
 from rest_framework import serializers
 from .models import DentalClinic, BusinessHours, ClinicImage, Review
-from django.db.models import Avg
 import json
+import logging
+from django.db import transaction
+
+from OpenCare.metrics import TimedRepresentationMixin
+
+from . import images as clinic_images
+
+logger = logging.getLogger(__name__)
 
 class BusinessHoursSerializer(serializers.ModelSerializer):
     day_name = serializers.CharField(source='get_day_display', read_only=True)
@@ -12,23 +19,60 @@ class BusinessHoursSerializer(serializers.ModelSerializer):
 
 
 class ClinicImageSerializer(serializers.ModelSerializer):
+    # Resized copies of image_file; empty until a worker has rendered them
+    variants = serializers.SerializerMethodField()
+
     class Meta:
         model = ClinicImage
-        fields = ['id', 'image_file', 'image_url', 'caption', 'is_primary']
+        fields = ['id', 'image_file', 'image_url', 'caption', 'is_primary', 'variants']
         read_only_fields = ['id']
 
+    def get_variants(self, obj):
+        request = self.context.get('request')
+        return clinic_images.variant_urls(obj.variants, request.build_absolute_uri if request else None)
+
 
-class ReviewSerializer(serializers.ModelSerializer):
+class ReviewSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Review
         fields = ['id', 'author_name', 'author_photo_url', 'rating', 'text', 'created_at']
         read_only_fields = ['id', 'created_at']
 
 
-class DentalClinicSerializer(serializers.ModelSerializer):
+CLINIC_SUMMARY_FIELDS = (
+    'id', 'name', 'latitude', 'longitude', 'distance', 'average_rating', 'primary_image', 'today_hours',
+)
+
+
+class ClinicSummarySerializer(TimedRepresentationMixin, serializers.Serializer):
+    """
+    Compact clinic representation for map and list screens. It renders plain
+    dicts built from values() queries rather than model instances.
+
+    Pass `fields` to keep only a subset of CLINIC_SUMMARY_FIELDS.
+    """
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    latitude = serializers.FloatField()
+    longitude = serializers.FloatField()
+    distance = serializers.FloatField(allow_null=True)
+    average_rating = serializers.FloatField(allow_null=True)
+    primary_image = serializers.CharField(allow_null=True)
+    today_hours = serializers.DictField(allow_null=True)
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class DentalClinicSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     business_hours = BusinessHoursSerializer(many=True, required=False)
     images = ClinicImageSerializer(many=True, required=False)
-    reviews = ReviewSerializer(many=True, required=False)
+    # Accepted on writes only; a clinic's reviews are read page by page from
+    # DentalClinicViewSet.reviews
+    reviews = ReviewSerializer(many=True, required=False, write_only=True)
     average_rating = serializers.SerializerMethodField()
     distance = serializers.SerializerMethodField()
     business_types = serializers.ListField(child=serializers.CharField(), required=False)
@@ -37,18 +81,28 @@ class DentalClinicSerializer(serializers.ModelSerializer):
         model = DentalClinic
         fields = [
             'id', 'name', 'description', 'address', 'latitude', 'longitude',
-            'rating', 'phone_number', 'website', 'business_hours', 'images',
-            'reviews', 'average_rating', 'distance', 'created_at', 'updated_at',
+            'rating', 'phone_number', 'website', 'place_id', 'timezone', 'business_hours', 'images',
+            'reviews', 'average_rating', 'review_count', 'distance', 'created_at', 'updated_at',
             'business_types'
         ]
-        read_only_fields = ['id', 'average_rating', 'distance', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'average_rating', 'review_count', 'distance', 'created_at', 'updated_at']
     
     def get_average_rating(self, obj):
-        return obj.reviews.aggregate(Avg('rating'))['rating__avg']
+        return obj.average_rating
     
     def get_distance(self, obj):
         # This field will be populated by the view when needed
         return getattr(obj, 'distance', None)
+
+    def validate_business_hours(self, value):
+        days = [hours['day'] for hours in value]
+        duplicates = sorted({day for day in days if days.count(day) > 1})
+        if duplicates:
+            names = dict(BusinessHours.DAYS_OF_WEEK)
+            raise serializers.ValidationError(
+                f"Each day may be listed once; repeated: {', '.join(names[day] for day in duplicates)}."
+            )
+        return value
     
     def to_internal_value(self, data):
         # Convert QueryDict to proper dict
@@ -117,6 +171,53 @@ class DentalClinicSerializer(serializers.ModelSerializer):
         
         return super().to_internal_value(processed_data)
     
+    @staticmethod
+    def build_images(clinic, images_data):
+        images = []
+        for image_data in images_data:
+            # If image_file is provided as string 'null', convert to None
+            if 'image_file' in image_data and image_data['image_file'] == 'null':
+                image_data['image_file'] = None
+            images.append(ClinicImage(clinic=clinic, **image_data))
+        return images
+
+    @staticmethod
+    def diff_business_hours(clinic, business_hours_data):
+        """
+        Compare the clinic's (prefetched) hours with business_hours_data and
+        return (to_create, to_update, to_delete): new days to insert, changed
+        days to update and the days missing from the data.
+        """
+        existing = {hours.day: hours for hours in clinic.business_hours.all()}
+        to_create = []
+        to_update = []
+        for hours_data in business_hours_data:
+            values = {
+                'opening_time': hours_data.get('opening_time'),
+                'closing_time': hours_data.get('closing_time'),
+                'is_closed': hours_data.get('is_closed', False),
+            }
+            hours = existing.pop(hours_data['day'], None)
+            if hours is None:
+                to_create.append(BusinessHours(clinic=clinic, day=hours_data['day'], **values))
+            elif any(getattr(hours, attr) != value for attr, value in values.items()):
+                for attr, value in values.items():
+                    setattr(hours, attr, value)
+                to_update.append(hours)
+        return to_create, to_update, list(existing.values())
+
+    @classmethod
+    def _sync_business_hours(cls, clinic, business_hours_data):
+        """
+        Make the clinic's hours match business_hours_data, touching only the
+        days that changed.
+        """
+        to_create, to_update, to_delete = cls.diff_business_hours(clinic, business_hours_data)
+        if to_delete:
+            BusinessHours.objects.filter(pk__in=[hours.pk for hours in to_delete]).delete()
+        BusinessHours.objects.bulk_update(to_update, ['opening_time', 'closing_time', 'is_closed'])
+        BusinessHours.objects.bulk_create(to_create)
+
     def create(self, validated_data):
         # Extract nested data
         business_hours_data = validated_data.pop('business_hours', [])
@@ -124,44 +225,27 @@ class DentalClinicSerializer(serializers.ModelSerializer):
         images_data = validated_data.pop('images', [])
         business_types = validated_data.pop('business_types', [])
         
-        print(f"Images data (before create): {images_data}")
-        print(f"Reviews data (before create): {reviews_data}")
-        print(f"Business hours data (before create): {business_hours_data}")
-        
-        # Create the clinic
-        clinic = DentalClinic.objects.create(**validated_data)
+        logger.debug(
+            "Creating clinic with %d business hours, %d images and %d reviews",
+            len(business_hours_data), len(images_data), len(reviews_data),
+        )
         
-        # Save business types
-        if business_types:
-            clinic.business_types = business_types
-            clinic.save()
-        
-        # Create business hours
-        if isinstance(business_hours_data, dict):
-            # Convert dict format to list format
-            hours_list = []
-            for day, hours in business_hours_data.items():
-                hours_list.append({
-                    'day_of_week': day,
-                    'open_time': hours.get('open'),
-                    'close_time': hours.get('close'),
-                    'is_closed': not hours.get('open') or not hours.get('close')
-                })
-            business_hours_data = hours_list
-            
-        for hours_data in business_hours_data:
-            BusinessHours.objects.create(clinic=clinic, **hours_data)
-        
-        # Create images
-        for image_data in images_data:
-            # If image_file is provided as string 'null', convert to None
-            if 'image_file' in image_data and image_data['image_file'] == 'null':
-                image_data['image_file'] = None
-            ClinicImage.objects.create(clinic=clinic, **image_data)
-        
-        # Create reviews
-        for review_data in reviews_data:
-            Review.objects.create(clinic=clinic, **review_data)
+        # Each nested collection is written with a single INSERT
+        with transaction.atomic():
+            clinic = DentalClinic.objects.create(**validated_data)
+            if business_types:
+                clinic.business_types = business_types
+
+            BusinessHours.objects.bulk_create(
+                BusinessHours(clinic=clinic, **hours_data) for hours_data in business_hours_data
+            )
+            created = ClinicImage.objects.bulk_create(self.build_images(clinic, images_data))
+            clinic_images.schedule(image.pk for image in created if image.image_file)
+            Review.objects.bulk_create(Review(clinic=clinic, **review_data) for review_data in reviews_data)
+            DentalClinic.objects.filter(pk=clinic.pk).refresh_open_intervals()
+
+        # The review aggregates were updated in the database, not on this instance
+        clinic.refresh_from_db(fields=['review_count', 'review_rating_sum'])
         
         return clinic
     
@@ -179,43 +263,23 @@ class DentalClinicSerializer(serializers.ModelSerializer):
         # Update business types if provided
         if business_types is not None:
             instance.business_types = business_types
-            
-        instance.save()
-        
-        # Update business hours if provided
-        if business_hours_data is not None:
-            # Remove existing hours
-            instance.business_hours.all().delete()
-            
-            # Handle different formats
-            if isinstance(business_hours_data, dict):
-                hours_list = []
-                for day, hours in business_hours_data.items():
-                    hours_list.append({
-                        'day_of_week': day,
-                        'open_time': hours.get('open'),
-                        'close_time': hours.get('close'),
-                        'is_closed': not hours.get('open') or not hours.get('close')
-                    })
-                business_hours_data = hours_list
-                
-            # Create new hours
-            for hours_data in business_hours_data:
-                BusinessHours.objects.create(clinic=instance, **hours_data)
-        
-        # Update images if provided
-        if images_data is not None:
-            # You might want to decide: delete existing images or just add new ones
-            # For now, let's just add new ones
-            for image_data in images_data:
-                if 'image_file' in image_data and image_data['image_file'] == 'null':
-                    image_data['image_file'] = None
-                ClinicImage.objects.create(clinic=instance, **image_data)
-        
-        # Update reviews if provided
+
+        with transaction.atomic():
+            instance.save()
+
+            # Update business hours if provided
+            if business_hours_data is not None:
+                self._sync_business_hours(instance, business_hours_data)
+                DentalClinic.objects.filter(pk=instance.pk).refresh_open_intervals()
+
+            # Images and reviews are only ever added, never replaced
+            if images_data is not None:
+                created = ClinicImage.objects.bulk_create(self.build_images(instance, images_data))
+                clinic_images.schedule(image.pk for image in created if image.image_file)
+            if reviews_data is not None:
+                Review.objects.bulk_create(Review(clinic=instance, **review_data) for review_data in reviews_data)
+
         if reviews_data is not None:
-            # Add new reviews (we don't update existing reviews)
-            for review_data in reviews_data:
-                Review.objects.create(clinic=instance, **review_data)
+            instance.refresh_from_db(fields=['review_count', 'review_rating_sum'])
         
-        return instance
\ No newline at end of file
+        return instance
@@ -0,0 +1,114 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import images as clinic_images
+from .models import DentalClinic, BusinessHours, ClinicImage, Review
+from .nearby_cache import bump_generation
+from .open_hours import open_hours_index
+from .spatial import IN_PROCESS_INDEXES, index_clinics
+
+
+def _cascading_from_clinic(origin):
+    """Whether a post_delete was caused by deleting a DentalClinic (or queryset of them)."""
+    return isinstance(origin, DentalClinic) or getattr(origin, 'model', None) is DentalClinic
+
+
+def _unindex_clinic(clinic_id):
+    for index in IN_PROCESS_INDEXES:
+        index.remove(clinic_id)
+    open_hours_index.remove(clinic_id)
+
+
+@receiver(post_save, sender=DentalClinic)
+def index_clinic(sender, instance, **kwargs):
+    """Keep the in-process nearby indexes in sync once the write is committed."""
+    clinic_id, latitude, longitude = instance.pk, instance.latitude, instance.longitude
+    transaction.on_commit(lambda: index_clinics([(clinic_id, latitude, longitude)]))
+    # The timezone may have changed
+    transaction.on_commit(lambda: open_hours_index.reload([clinic_id]))
+
+
+@receiver(post_delete, sender=DentalClinic)
+def unindex_clinic(sender, instance, **kwargs):
+    clinic_id = instance.pk
+    transaction.on_commit(lambda: _unindex_clinic(clinic_id))
+
+
+@receiver(post_save, sender=DentalClinic)
+def update_clinic_search_vector(sender, instance, **kwargs):
+    """Keep DentalClinic.search_vector current."""
+    DentalClinic.objects.filter(pk=instance.pk).refresh_search_vectors()
+
+
+@receiver(post_save, sender=BusinessHours)
+@receiver(post_delete, sender=BusinessHours)
+def update_open_intervals(sender, instance, origin=None, **kwargs):
+    """Keep DentalClinic.open_intervals current."""
+    if _cascading_from_clinic(origin):
+        return
+    DentalClinic.objects.filter(pk=instance.clinic_id).refresh_open_intervals()
+
+
+@receiver(post_save, sender=ClinicImage)
+def schedule_image_processing(sender, instance, **kwargs):
+    """Render the variants of a new upload in a worker."""
+    if instance.image_file and not instance.content_hash:
+        clinic_images.schedule([instance.pk])
+
+
+@receiver(post_save, sender=Review)
+def count_review(sender, instance, created, **kwargs):
+    """Keep DentalClinic.review_count / review_rating_sum current."""
+    if created:
+        DentalClinic.objects.add_review_totals({instance.clinic_id: (1, instance.rating)})
+    else:
+        # The rating may have changed and the old value is unknown
+        DentalClinic.objects.filter(pk=instance.clinic_id).refresh_review_aggregates()
+
+
+@receiver(post_delete, sender=Review)
+def uncount_review(sender, instance, origin=None, **kwargs):
+    if _cascading_from_clinic(origin):
+        # Nothing left to keep in sync
+        return
+    DentalClinic.objects.add_review_totals({instance.clinic_id: (-1, -instance.rating)})
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def update_review_search_vector(sender, instance, origin=None, **kwargs):
+    """Review texts are part of the clinic's search_vector."""
+    if _cascading_from_clinic(origin):
+        return
+    DentalClinic.objects.filter(pk=instance.clinic_id).refresh_search_vectors()
+
+
+@receiver(post_save, sender=BusinessHours)
+@receiver(post_save, sender=ClinicImage)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=BusinessHours)
+@receiver(post_delete, sender=ClinicImage)
+@receiver(post_delete, sender=Review)
+def touch_clinic(sender, instance, origin=None, **kwargs):
+    """A change to a clinic's hours, images or reviews moves its updated_at, for incremental exports."""
+    if _cascading_from_clinic(origin):
+        return
+    DentalClinic.objects.filter(pk=instance.clinic_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=DentalClinic)
+@receiver(post_save, sender=BusinessHours)
+@receiver(post_save, sender=ClinicImage)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=DentalClinic)
+@receiver(post_delete, sender=BusinessHours)
+@receiver(post_delete, sender=ClinicImage)
+@receiver(post_delete, sender=Review)
+def invalidate_nearby_cache(sender, instance, origin=None, **kwargs):
+    """Any change to what nearby renders starts a new cache generation."""
+    if sender is not DentalClinic and _cascading_from_clinic(origin):
+        # The clinic's own post_delete already invalidates
+        return
+    transaction.on_commit(bump_generation)
@@ -0,0 +1,573 @@
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+
+from .models import DentalClinic
+
+EARTH_RADIUS_KM = 6371
+
+# No two points on the earth are further apart than this
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    Returns distance in kilometers
+    """
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+
+    return c * EARTH_RADIUS_KM
+
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Return (min_lat, max_lat, min_lng, max_lng) enclosing every point within
+    `radius` km of the given coordinates.
+
+    When the box crosses the antimeridian min_lng is greater than max_lng, and
+    when it reaches a pole the longitude range covers the whole globe.
+    """
+    angular_radius = radius / EARTH_RADIUS_KM
+    lat = math.radians(latitude)
+    min_lat = lat - angular_radius
+    max_lat = lat + angular_radius
+
+    if min_lat <= -math.pi / 2 or max_lat >= math.pi / 2:
+        return (
+            math.degrees(max(min_lat, -math.pi / 2)),
+            math.degrees(min(max_lat, math.pi / 2)),
+            -180.0,
+            180.0,
+        )
+
+    delta_lng = math.degrees(math.asin(min(math.sin(angular_radius) / math.cos(lat), 1.0)))
+    min_lng = longitude - delta_lng
+    max_lng = longitude + delta_lng
+    if delta_lng >= 180:
+        min_lng, max_lng = -180.0, 180.0
+    elif min_lng < -180:
+        min_lng += 360
+    elif max_lng > 180:
+        max_lng -= 360
+
+    return math.degrees(min_lat), math.degrees(max_lat), min_lng, max_lng
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_cell(latitude, longitude, precision):
+    """
+    Return the geohash of the given precision containing the coordinates,
+    together with the latitude and longitude of that cell's center.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value, bounds = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash), (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def distance_expression(latitude, longitude):
+    """
+    Database expression for the Haversine distance in kilometers between the
+    given coordinates and each row's latitude/longitude.
+    """
+    lat = math.radians(latitude)
+    lng = math.radians(longitude)
+    row_lat = Radians(F('latitude'))
+    row_lng = Radians(F('longitude'))
+
+    a = (
+        Power(Sin((row_lat - Value(lat)) / 2), 2)
+        + Value(math.cos(lat)) * Cos(row_lat) * Power(Sin((row_lng - Value(lng)) / 2), 2)
+    )
+    # Rounding can push sqrt(a) just past 1, which ASIN rejects
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Least(Sqrt(a), Value(1.0)), output_field=FloatField())
+
+
+def within_radius(queryset, latitude, longitude, radius):
+    """
+    Narrow a DentalClinic queryset to the clinics within `radius` km, annotated
+    with `distance` and ordered nearest first.
+
+    The bounding box filter runs first so the (latitude, longitude) index can
+    discard most rows before any distance is computed.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, radius)
+    queryset = queryset.filter(latitude__range=(min_lat, max_lat))
+    if min_lng <= max_lng:
+        if (min_lng, max_lng) != (-180, 180):
+            queryset = queryset.filter(longitude__range=(min_lng, max_lng))
+    else:
+        queryset = queryset.filter(Q(longitude__gte=min_lng) | Q(longitude__lte=max_lng))
+
+    return (
+        queryset
+        .annotate(distance=distance_expression(latitude, longitude))
+        .filter(distance__lte=radius)
+        .order_by('distance', 'id')
+    )
+
+
+class DatabaseNearbySearch:
+    """
+    Nearby search evaluated entirely in SQL.
+
+    A search for the `limit` nearest clinics without a radius looks within
+    growing radii first (from first_ring_km, four times wider each time),
+    so the bounding box filter narrows every query; only a search that has
+    to reach around the globe computes and sorts the distance of every
+    clinic.
+
+    Small candidate sets are sent along as an `id IN (...)` filter. Larger
+    ones, like the clinics open right now, would mean thousands of bind
+    parameters, so the nearest clinics are read in growing batches instead
+    and kept if they are candidates.
+    """
+
+    first_ring_km = 10
+    max_bound_candidates = 500
+    batch_size = 200
+    max_batch_size = 5000
+
+    def search(self, latitude, longitude, radius=None, limit=None, after=None, candidates=None):
+        """
+        Return up to `limit` (distance, clinic_id) pairs for the clinics within
+        `radius` km of the given coordinates (anywhere when radius is None),
+        ordered by (distance, id) and starting after the `after` pair.
+        `candidates` restricts the search to a set of clinic ids.
+        """
+        if candidates is None or len(candidates) <= self.max_bound_candidates:
+            return self._nearest(latitude, longitude, radius, limit, after, candidates)
+        hits = []
+        batch_size = self._first_batch_size(limit)
+        while True:
+            rows = self._nearest(latitude, longitude, radius, batch_size, after, None)
+            hits += [row for row in rows if row[1] in candidates]
+            if len(rows) < batch_size or (limit is not None and len(hits) >= limit):
+                return hits[:limit]
+            after = rows[-1]
+            batch_size = min(batch_size * 2, self.max_batch_size)
+
+    async def asearch(self, latitude, longitude, radius=None, limit=None, after=None, candidates=None):
+        if candidates is None or len(candidates) <= self.max_bound_candidates:
+            return await self._anearest(latitude, longitude, radius, limit, after, candidates)
+        hits = []
+        batch_size = self._first_batch_size(limit)
+        while True:
+            rows = await self._anearest(latitude, longitude, radius, batch_size, after, None)
+            hits += [row for row in rows if row[1] in candidates]
+            if len(rows) < batch_size or (limit is not None and len(hits) >= limit):
+                return hits[:limit]
+            after = rows[-1]
+            batch_size = min(batch_size * 2, self.max_batch_size)
+
+    def _first_batch_size(self, limit):
+        return max(self.batch_size, 2 * limit) if limit is not None else self.max_batch_size
+
+    def _rings(self, radius, limit, after):
+        """The radii to search, widest last; None searches everywhere."""
+        if radius is not None or limit is None:
+            yield radius
+            return
+        # Everything up to the cursor has been returned already
+        reach = self.first_ring_km + (after[0] if after is not None else 0)
+        while reach < MAX_DISTANCE_KM:
+            yield reach
+            reach *= 4
+        yield None
+
+    def _nearest(self, latitude, longitude, radius, limit, after, candidates):
+        for reach in self._rings(radius, limit, after):
+            rows = list(self._rows(latitude, longitude, reach, limit, after, candidates))
+            # Clinics beyond this reach are further than every row found
+            if limit is None or len(rows) == limit:
+                return rows
+        return rows
+
+    async def _anearest(self, latitude, longitude, radius, limit, after, candidates):
+        for reach in self._rings(radius, limit, after):
+            rows = [row async for row in self._rows(latitude, longitude, reach, limit, after, candidates)]
+            if limit is None or len(rows) == limit:
+                return rows
+        return rows
+
+    def _rows(self, latitude, longitude, radius, limit, after, candidates):
+        queryset = DentalClinic.objects.all()
+        if candidates is not None:
+            queryset = queryset.filter(pk__in=candidates)
+        if radius is not None:
+            queryset = within_radius(queryset, latitude, longitude, radius)
+        else:
+            queryset = queryset.annotate(distance=distance_expression(latitude, longitude)).order_by('distance', 'id')
+
+        if after is not None:
+            after_distance, after_id = after
+            queryset = queryset.filter(Q(distance__gt=after_distance) | Q(distance=after_distance, id__gt=after_id))
+
+        rows = queryset.values_list('distance', 'id')
+        if limit is not None:
+            rows = rows[:limit]
+        return rows
+
+
+class InProcessIndex:
+    async def asearch(self, latitude, longitude, radius=None, limit=None, after=None, candidates=None):
+        """search() for async callers: only a (re)load touches the database."""
+        await sync_to_async(self.ensure_loaded)()
+        return self.search(latitude, longitude, radius, limit, after, candidates)
+
+
+class ClinicGridIndex(InProcessIndex):
+    """
+    In-process lat/lng grid of clinic coordinates.
+
+    Clinics are bucketed into square cells of `cell_size` degrees so a radius
+    query only computes distances for the clinics in cells overlapping the
+    search circle. The index is loaded lazily, kept in sync by the DentalClinic
+    signal handlers and rebuilt from the database every `max_age` seconds to
+    pick up writes made by other processes.
+    """
+
+    def __init__(self, cell_size, max_age=None):
+        self.cell_size = cell_size
+        self.max_age = max_age
+        self.columns = math.ceil(360 / cell_size)
+        self._lock = threading.RLock()
+        self._cells = defaultdict(dict)
+        self._positions = {}
+        self._loaded_at = None
+
+    def _cell(self, latitude, longitude):
+        row = math.floor((latitude + 90) / self.cell_size)
+        column = math.floor((longitude + 180) / self.cell_size) % self.columns
+        return row, column
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return bool(self.max_age) and time.monotonic() - self._loaded_at > self.max_age
+
+    def rebuild(self):
+        """Reload every clinic's coordinates from the database."""
+        cells = defaultdict(dict)
+        positions = {}
+        for clinic_id, latitude, longitude in DentalClinic.objects.values_list('id', 'latitude', 'longitude'):
+            cell = self._cell(latitude, longitude)
+            cells[cell][clinic_id] = (latitude, longitude)
+            positions[clinic_id] = cell
+
+        with self._lock:
+            self._cells = cells
+            self._positions = positions
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.rebuild()
+
+    def add(self, clinic_id, latitude, longitude):
+        """Insert or move a clinic. Ignored until the index has been loaded."""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._discard(clinic_id)
+            cell = self._cell(latitude, longitude)
+            self._cells[cell][clinic_id] = (latitude, longitude)
+            self._positions[clinic_id] = cell
+
+    def remove(self, clinic_id):
+        with self._lock:
+            self._discard(clinic_id)
+
+    def _discard(self, clinic_id):
+        cell = self._positions.pop(clinic_id, None)
+        if cell is None:
+            return
+        bucket = self._cells[cell]
+        bucket.pop(clinic_id, None)
+        if not bucket:
+            del self._cells[cell]
+
+    def _box(self, latitude, longitude, radius):
+        """The (rows, column ranges) of the cells overlapping the bounding box of the search circle."""
+        min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, radius)
+        min_row, first_column = self._cell(min_lat, min_lng)
+        max_row, last_column = self._cell(max_lat, max_lng)
+
+        if min_lng == -180 and max_lng == 180:
+            columns = (range(self.columns),)
+        elif first_column <= last_column:
+            columns = (range(first_column, last_column + 1),)
+        else:
+            # The box wraps around the antimeridian
+            columns = (range(first_column, self.columns), range(0, last_column + 1))
+        return range(min_row, max_row + 1), columns
+
+    def _box_size(self, latitude, longitude, radius):
+        rows, columns = self._box(latitude, longitude, radius)
+        return len(rows) * sum(map(len, columns))
+
+    def _cells_for(self, latitude, longitude, radius):
+        rows, columns = self._box(latitude, longitude, radius)
+        if len(rows) * sum(map(len, columns)) > len(self._cells):
+            # Cheaper to test the occupied cells than to walk the box
+            return [
+                cell for cell in self._cells
+                if cell[0] in rows and any(cell[1] in column_range for column_range in columns)
+            ]
+        return [(row, column) for row in rows for column in chain.from_iterable(columns)]
+
+    def _scan(self, latitude, longitude, radius, after, candidates):
+        results = []
+        with self._lock:
+            for cell in self._cells_for(latitude, longitude, radius):
+                bucket = self._cells.get(cell)
+                if not bucket:
+                    continue
+                for clinic_id, (clinic_lat, clinic_lng) in bucket.items():
+                    if candidates is not None and clinic_id not in candidates:
+                        continue
+                    distance = haversine_distance(latitude, longitude, clinic_lat, clinic_lng)
+                    if distance <= radius and (after is None or (distance, clinic_id) > after):
+                        results.append((distance, clinic_id))
+        return results
+
+    def search(self, latitude, longitude, radius=None, limit=None, after=None, candidates=None):
+        """
+        Return up to `limit` (distance, clinic_id) pairs for the clinics within
+        `radius` km of the given coordinates (anywhere when radius is None),
+        ordered by (distance, id) and starting after the `after` pair.
+        `candidates` restricts the search to a set of clinic ids.
+
+        Without a radius the scanned area starts at one cell around the point
+        and doubles until it holds `limit` matches, or until it spans more
+        cells than are occupied, when every clinic is checked instead.
+        """
+        self.ensure_loaded()
+
+        if radius is not None:
+            results = self._scan(latitude, longitude, radius, after, candidates)
+        elif limit is None:
+            results = self._scan(latitude, longitude, MAX_DISTANCE_KM, after, candidates)
+        else:
+            reach = math.radians(self.cell_size) * EARTH_RADIUS_KM
+            if after is not None:
+                reach += after[0]
+            while True:
+                if self._box_size(latitude, longitude, reach) >= len(self._cells):
+                    results = self._scan(latitude, longitude, MAX_DISTANCE_KM, after, candidates)
+                    break
+                results = self._scan(latitude, longitude, reach, after, candidates)
+                if len(results) >= limit:
+                    break
+                reach *= 2
+
+        if limit is not None:
+            return heapq.nsmallest(limit, results)
+        return sorted(results)
+
+
+class VectorDistanceEngine(InProcessIndex):
+    """
+    In-process distance engine holding clinic ids and coordinates in
+    contiguous NumPy arrays.
+
+    A search computes the Haversine distance to every clinic in one vectorized
+    pass and selects the nearest matches with a partial sort (np.partition)
+    followed by lexsort. Saves and deletes update the arrays in place (deletes
+    swap the last row into the freed slot), and the whole engine is reloaded
+    every `max_age` seconds.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._lat = np.empty(capacity, dtype=np.float64)
+        self._lng = np.empty(capacity, dtype=np.float64)
+        self._cos_lat = np.empty(capacity, dtype=np.float64)
+        self._slots = {}
+        self._size = 0
+
+    def _grow(self):
+        capacity = max(16, 2 * len(self._ids))
+        for name in ('_ids', '_lat', '_lng', '_cos_lat'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        return bool(self.max_age) and time.monotonic() - self._loaded_at > self.max_age
+
+    def rebuild(self):
+        """Reload every clinic's coordinates from the database."""
+        rows = np.array(
+            DentalClinic.objects.values_list('id', 'latitude', 'longitude'),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+
+        with self._lock:
+            self._allocate(len(rows))
+            self._size = len(rows)
+            self._ids[:] = rows[:, 0]
+            self._lat[:] = np.radians(rows[:, 1])
+            self._lng[:] = np.radians(rows[:, 2])
+            np.cos(self._lat, out=self._cos_lat)
+            self._slots = {clinic_id: slot for slot, clinic_id in enumerate(self._ids.tolist())}
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.rebuild()
+
+    def add(self, clinic_id, latitude, longitude):
+        """Insert or move a clinic. Ignored until the engine has been loaded."""
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            slot = self._slots.get(clinic_id)
+            if slot is None:
+                if self._size == len(self._ids):
+                    self._grow()
+                slot = self._size
+                self._size += 1
+                self._slots[clinic_id] = slot
+                self._ids[slot] = clinic_id
+            self._lat[slot] = math.radians(latitude)
+            self._lng[slot] = math.radians(longitude)
+            self._cos_lat[slot] = math.cos(self._lat[slot])
+
+    def remove(self, clinic_id):
+        with self._lock:
+            slot = self._slots.pop(clinic_id, None)
+            if slot is None:
+                return
+            last = self._size - 1
+            if slot != last:
+                for array in (self._ids, self._lat, self._lng, self._cos_lat):
+                    array[slot] = array[last]
+                self._slots[int(self._ids[slot])] = slot
+            self._size = last
+
+    def search(self, latitude, longitude, radius=None, limit=None, after=None, candidates=None):
+        """
+        Return up to `limit` (distance, clinic_id) pairs for the clinics within
+        `radius` km of the given coordinates (anywhere when radius is None),
+        ordered by (distance, id) and starting after the `after` pair.
+        `candidates` restricts the search to a set of clinic ids.
+        """
+        self.ensure_loaded()
+        lat = math.radians(latitude)
+        lng = math.radians(longitude)
+
+        with self._lock:
+            size = self._size
+            ids = self._ids[:size]
+            a = (
+                np.sin((self._lat[:size] - lat) / 2) ** 2
+                + math.cos(lat) * self._cos_lat[:size] * np.sin((self._lng[:size] - lng) / 2) ** 2
+            )
+            distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+            mask = np.ones(size, dtype=bool) if radius is None else distances <= radius
+            if after is not None:
+                after_distance, after_id = after
+                mask &= (distances > after_distance) | ((distances == after_distance) & (ids > after_id))
+            if candidates is not None:
+                mask &= np.isin(ids, np.fromiter(candidates, dtype=np.int64, count=len(candidates)))
+            matches = np.flatnonzero(mask)
+
+            if limit is not None and limit < len(matches):
+                # Keep everything up to the limit-th distance so ties are
+                # broken by id below rather than arbitrarily by argpartition
+                cutoff = np.partition(distances[matches], limit - 1)[limit - 1]
+                matches = matches[distances[matches] <= cutoff]
+            order = matches[np.lexsort((ids[matches], distances[matches]))][:limit]
+
+            return list(zip(distances[order].tolist(), ids[order].tolist()))
+
+
+clinic_index = ClinicGridIndex(
+    cell_size=settings.NEARBY_GRID_CELL_SIZE,
+    max_age=settings.NEARBY_INDEX_MAX_AGE,
+)
+
+distance_engine = VectorDistanceEngine(max_age=settings.NEARBY_INDEX_MAX_AGE)
+
+# Backends that keep their own copy of the clinic coordinates and need to
+# hear about every save and delete
+IN_PROCESS_INDEXES = (clinic_index, distance_engine)
+
+
+
+def index_clinics(clinics):
+    """
+    Add (clinic_id, latitude, longitude) rows to the in-process indexes.
+    Used for writes that bypass the post_save signal, like bulk_create().
+    """
+    clinics = list(clinics)
+    for index in IN_PROCESS_INDEXES:
+        for clinic_id, latitude, longitude in clinics:
+            index.add(clinic_id, latitude, longitude)
+
+
+NEARBY_BACKENDS = {
+    'sql': DatabaseNearbySearch(),
+    'grid': clinic_index,
+    'numpy': distance_engine,
+}
+
+
+def get_nearby_backend():
+    """Return the search backend selected by settings.NEARBY_SEARCH_BACKEND."""
+    return NEARBY_BACKENDS[settings.NEARBY_SEARCH_BACKEND]
@@ -1,14 +1,27 @@
-import requests
 from celery import shared_task
 
+from . import images, outbox, refresh
+
+
+@shared_task(ignore_result=True)
+def drain_webhook_outbox():
+    """Forward queued lead submissions to the webhook. Retries are scheduled in the outbox rows."""
+    return outbox.drain()
+
+
+@shared_task
+def refresh_clinics():
+    """Refresh the stalest clinics from Google Place Details."""
+    return refresh.refresh_stale_clinics()
+
+
+@shared_task(ignore_result=True)
+def process_clinic_image(image_id):
+    """Render the resized variants of an uploaded clinic image."""
+    images.process_image(image_id)
+
+
 @shared_task
-def make_api_call():
-# Make your API call here
-    try:
-        response = requests.get('https://your-api-endpoint.com/api/')
-# Process response as needed
-        print(f"API call made: Status Code {response.status_code}")
-        return f"API call successful: {response.status_code}"
-    except Exception as e:
-        print(f"API call failed: {str(e)}")
-        return f"API call failed: {str(e)}"
+def process_pending_images():
+    """Process uploads whose on-commit task was lost."""
+    return images.process_pending()
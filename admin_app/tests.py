@@ -1,3 +1,1290 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import tempfile
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from unittest import mock, skipUnless
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import QueryDict
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from OpenCare import log
+from OpenCare.metrics import registry
+from . import images, outbox, refresh
+from .open_hours import open_hours_index, weekly_intervals
+from .importers import ClinicImporter, ImportReport
+from .nearby import encode_cursor
+from .models import BusinessHours, ClinicImage, DentalClinic, Review, WebhookOutbox
+from .serializers import CLINIC_SUMMARY_FIELDS, DentalClinicSerializer
+from .places import PlaceDetailsClient, PlaceDetailsError
+from .spatial import (
+    ClinicGridIndex, DatabaseNearbySearch, VectorDistanceEngine, bounding_box, get_nearby_backend, haversine_distance, within_radius,
+)
+
+User = get_user_model()
+
+
+def create_clinic(latitude, longitude):
+    clinic = DentalClinic.objects.create(
+        name="Clinic", address="1 Main St", latitude=latitude, longitude=longitude
+    )
+    for day in range(7):
+        BusinessHours.objects.create(clinic=clinic, day=day, is_closed=True)
+    ClinicImage.objects.create(clinic=clinic, image_url="https://example.com/a.jpg", is_primary=True)
+    ClinicImage.objects.create(clinic=clinic, image_url="https://example.com/b.jpg")
+    Review.objects.create(clinic=clinic, author_name="A", rating=4, text="Good")
+    Review.objects.create(clinic=clinic, author_name="B", rating=5, text="Great")
+    return clinic
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(NEARBY_SEARCH_BACKEND='sql', CACHES=LOCMEM_CACHES)
+class ClinicQueryCountTests(TestCase):
+    """Rendering N clinics must not cost a query per clinic."""
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        admin = User.objects.create(username="admin", email="admin@example.com", is_staff=True, is_superuser=True)
+        self.client.force_authenticate(admin)
+
+    def test_list_query_count_is_constant(self):
+        create_clinic(10.0, 10.0)
+        # clinics + business hours + images
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/admin/clinics/")
+        self.assertEqual(len(response.json()["results"]), 1)
+
+        for offset in range(5):
+            create_clinic(10.0 + offset / 100, 10.0)
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/admin/clinics/")
+        self.assertEqual(len(response.json()["results"]), 6)
+        self.assertEqual(response.json()["results"][0]["average_rating"], 4.5)
+        self.assertNotIn("reviews", response.json()["results"][0])
+
+    def test_list_and_reviews_are_paginated(self):
+        clinics = [create_clinic(10.0, 10.0) for _ in range(3)]
+        Review.objects.create(clinic=clinics[0], author_name="C", rating=3, text="Fine")
+
+        seen = []
+        url = "/api/admin/clinics/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            seen += [clinic["id"] for clinic in page["results"]]
+            url = page["next"]
+        self.assertEqual(seen, [clinic.pk for clinic in clinics])
+
+        response = APIClient().get(f"/api/admin/clinics/{clinics[0].pk}/reviews/", {"page_size": 2})
+        self.assertEqual([review["author_name"] for review in response.json()["results"]], ["C", "B"])
+        response = APIClient().get(response.json()["next"])
+        self.assertEqual([review["author_name"] for review in response.json()["results"]], ["A"])
+        self.assertIsNone(response.json()["next"])
+
+    def test_nearby_query_count_is_constant(self):
+        for offset in range(6):
+            create_clinic(10.0 + offset / 100, 10.0)
+        # search + clinics + business hours + images
+        with self.assertNumQueries(4):
+            response = self.client.get("/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "radius": 20})
+        self.assertEqual(len(response.json()), 6)
+        self.assertEqual(response.json()[0]["average_rating"], 4.5)
+
+
+@override_settings(NEARBY_SEARCH_BACKEND='sql', CACHES=LOCMEM_CACHES)
+class NearbyCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def nearby(self, latitude, longitude, radius, **params):
+        return self.client.get(
+            "/api/admin/clinics/nearby/", {"lat": latitude, "lng": longitude, "radius": radius, **params}
+        )
+
+    def test_nearby_queries_in_the_same_cell_share_a_cache_entry(self):
+        clinic = create_clinic(10.0, 10.0)
+        first = self.nearby(10.0001, 10.0001, 4.2)
+        self.assertEqual(first["X-Cache"], "MISS")
+
+        with self.assertNumQueries(0):
+            second = self.nearby(10.0002, 10.0, 4.5)
+        self.assertEqual(second["X-Cache"], "HIT")
+        self.assertEqual([row["id"] for row in second.json()], [clinic.pk])
+        # Distances are measured from each caller's own point
+        self.assertAlmostEqual(second.json()[0]["distance"], haversine_distance(10.0002, 10.0, 10.0, 10.0))
+        self.assertAlmostEqual(first.json()[0]["distance"], haversine_distance(10.0001, 10.0001, 10.0, 10.0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(clinic=clinic, author_name="C", rating=1, text="Bad")
+        third = self.nearby(10.0001, 10.0001, 4.2)
+        self.assertEqual(third["X-Cache"], "MISS")
+        self.assertEqual(third.json()[0]["review_count"], 3)
+
+    def test_cached_results_keep_the_requested_radius(self):
+        near = create_clinic(10.0, 10.0)
+        # ~4.45 km north
+        far = create_clinic(10.04, 10.0)
+        self.assertEqual([row["id"] for row in self.nearby(10.0, 10.0, 4.2).json()], [near.pk])
+        response = self.nearby(10.0, 10.0, 4.5)
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual([row["id"] for row in response.json()], [near.pk, far.pk])
+        response = self.nearby(10.0001, 10.0, 4.2)
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual([row["id"] for row in response.json()], [near.pk])
+
+    def test_cached_pages_link_to_the_callers_query(self):
+        clinics = [create_clinic(10.0 - offset / 1000, 10.0) for offset in range(3)]
+        self.nearby(10.0, 10.0, 2, limit=2)
+        response = self.nearby(10.0003, 10.0, 2, limit=2, view="summary")
+        self.assertEqual(response["X-Cache"], "MISS")
+        seen = [row["id"] for row in response.json()["results"]]
+
+        response = self.client.get(response.json()["next"])
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertIsNone(response.json()["next"])
+        seen += [row["id"] for row in response.json()["results"]]
+        self.assertEqual(seen, [clinics[0].pk, clinics[1].pk, clinics[2].pk])
+
+        # Same geohash cell, different order
+        response = self.nearby(9.9992, 10.0, 2, limit=2, view="summary")
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual([row["id"] for row in response.json()["results"]], [clinics[1].pk, clinics[0].pk])
+        self.assertEqual(parse_qs(urlparse(response.json()["next"]).query)["lat"], ["9.9992"])
+
+    @override_settings(NEARBY_CACHE_MAX_ROWS=1)
+    def test_crowded_buckets_are_not_cached(self):
+        clinics = [create_clinic(10.0 + offset / 1000, 10.0) for offset in range(2)]
+        for _ in range(2):
+            response = self.nearby(10.0, 10.0, 5)
+            self.assertEqual(response["X-Cache"], "BYPASS")
+            self.assertEqual([row["id"] for row in response.json()], [clinic.pk for clinic in clinics])
+
+    def test_searches_without_a_radius_are_not_cached(self):
+        create_clinic(10.0, 10.0)
+        response = self.client.get("/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "limit": 1})
+        self.assertNotIn("X-Cache", response)
+        self.assertEqual(len(response.json()["results"]), 1)
+
+
+@override_settings(NEARBY_SEARCH_BACKEND='sql', CACHES=LOCMEM_CACHES, NEARBY_CACHE_TIMEOUT=0)
+class NearbySummaryTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.near = create_clinic(10.0, 10.0)
+        self.far = create_clinic(10.05, 10.0)
+        BusinessHours.objects.filter(clinic=self.near, day=timezone.localdate().weekday()).update(
+            is_closed=False, opening_time=dt_time(9), closing_time=dt_time(17)
+        )
+
+    def nearby(self, **params):
+        return self.client.get("/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "radius": 20, **params})
+
+    def test_summary_view(self):
+        # search + clinics + images + today's hours, however many clinics match
+        with self.assertNumQueries(4):
+            response = self.nearby(view="summary")
+        near, far = response.json()
+        self.assertEqual(list(near), list(CLINIC_SUMMARY_FIELDS))
+        self.assertEqual((near["id"], far["id"]), (self.near.pk, self.far.pk))
+        self.assertEqual(near["distance"], 0)
+        self.assertAlmostEqual(far["distance"], haversine_distance(10.0, 10.0, 10.05, 10.0))
+        self.assertEqual(near["average_rating"], 4.5)
+        self.assertEqual(near["primary_image"], "https://example.com/a.jpg")
+        self.assertEqual(
+            near["today_hours"], {"opening_time": "09:00:00", "closing_time": "17:00:00", "is_closed": False}
+        )
+        self.assertTrue(far["today_hours"]["is_closed"])
+
+    def test_sparse_fields(self):
+        # Images and hours are not queried when they are not asked for
+        with self.assertNumQueries(2):
+            response = self.nearby(fields="id, name")
+        self.assertEqual(response.json(), [
+            {"id": self.near.pk, "name": "Clinic"}, {"id": self.far.pk, "name": "Clinic"},
+        ])
+        with self.assertNumQueries(3):
+            response = self.nearby(fields="id,primary_image")
+        self.assertEqual(response.json()[0], {"id": self.near.pk, "primary_image": "https://example.com/a.jpg"})
+
+    def test_unknown_fields_and_views_are_rejected(self):
+        response = self.nearby(fields="id,reviews")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("reviews", response.json()["error"])
+        self.assertEqual(self.nearby(view="compact").status_code, 400)
+
+    def test_full_view_is_the_default(self):
+        clinic = self.nearby().json()[0]
+        self.assertEqual(len(clinic["business_hours"]), 7)
+        self.assertEqual(len(clinic["images"]), 2)
+        self.assertEqual(clinic["review_count"], 2)
+
+
+class NearbySearchTests(TestCase):
+    # Includes two clinics at the same spot, clinics on both sides of the
+    # antimeridian and one next to the north pole
+    POINTS = [
+        (10.0, 10.0), (10.05, 10.0), (10.05, 10.0), (10.0, 10.3), (11.0, 10.0),
+        (0.0, 179.95), (0.0, -179.95), (89.9, 0.0), (-33.9, 151.2),
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.clinics = [
+            DentalClinic.objects.create(name=f"Clinic {i}", address="1 Main St", latitude=latitude, longitude=longitude)
+            for i, (latitude, longitude) in enumerate(self.POINTS)
+        ]
+
+    def expected(self, latitude, longitude, radius=None):
+        hits = sorted(
+            (haversine_distance(latitude, longitude, clinic.latitude, clinic.longitude), clinic.pk)
+            for clinic in self.clinics
+        )
+        return [hit for hit in hits if radius is None or hit[0] <= radius]
+
+    def assertHits(self, actual, expected):
+        self.assertEqual([clinic_id for _, clinic_id in actual], [clinic_id for _, clinic_id in expected])
+        for (distance, _), (expected_distance, _) in zip(actual, expected):
+            self.assertAlmostEqual(distance, expected_distance, places=6)
+
+    def pages(self, backend, latitude, longitude, limit, radius=None):
+        """Every hit, fetched `limit` at a time with (distance, id) cursors."""
+        hits, after = [], None
+        while True:
+            page = backend.search(latitude, longitude, radius, limit=limit, after=after)
+            hits += page
+            if len(page) < limit:
+                return hits
+            after = page[-1]
+
+    def test_grid_index(self):
+        grid = ClinicGridIndex(cell_size=0.1)
+        grid.rebuild()
+        for radius in (1, 10, 50, 200):
+            self.assertHits(grid.search(10.0, 10.0, radius), self.expected(10.0, 10.0, radius))
+        self.assertHits(grid.search(0.0, 180.0, 20), self.expected(0.0, 180.0, 20))
+        # Far from every clinic, so the scanned area ends up covering all of them
+        self.assertHits(grid.search(-60.0, -100.0, limit=3), self.expected(-60.0, -100.0)[:3])
+        # Pages of 2 split the two clinics at the same distance
+        self.assertHits(self.pages(grid, 10.0, 10.0, 2), self.expected(10.0, 10.0))
+        self.assertHits(self.pages(grid, 10.0, 10.0, 2, radius=50), self.expected(10.0, 10.0, 50))
+
+    def test_database_search_with_many_candidates(self):
+        backend = DatabaseNearbySearch()
+        backend.max_bound_candidates = backend.batch_size = backend.max_batch_size = 2
+        everything = self.expected(10.0, 10.0)
+        candidates = frozenset(clinic_id for i, (_, clinic_id) in enumerate(everything) if i % 2)
+        expected = [hit for hit in everything if hit[1] in candidates]
+
+        # Read in batches instead of binding every candidate id
+        with CaptureQueriesContext(connection) as queries:
+            self.assertHits(backend.search(10.0, 10.0, candidates=candidates), expected)
+        self.assertGreater(len(queries), 1)
+        self.assertFalse(any(" IN (" in query["sql"] for query in queries))
+        self.assertHits(backend.search(10.0, 10.0, 50, candidates=candidates), [hit for hit in expected if hit[0] <= 50])
+        self.assertHits(backend.search(10.0, 10.0, limit=2, candidates=candidates), expected[:2])
+        self.assertHits(backend.search(10.0, 10.0, limit=2, after=expected[1], candidates=candidates), expected[2:4])
+        self.assertHits(async_to_sync(backend.asearch)(10.0, 10.0, limit=3, candidates=candidates), expected[:3])
+
+    def test_bounding_box(self):
+        min_lat, max_lat, min_lng, max_lng = bounding_box(10.0, 10.0, 111.195)
+        self.assertAlmostEqual(min_lat, 9.0, places=3)
+        self.assertAlmostEqual(max_lat, 11.0, places=3)
+        self.assertAlmostEqual(10.0 - min_lng, max_lng - 10.0)
+        self.assertGreater(max_lng - 10.0, 1.0)
+
+        # Crossing the antimeridian: min_lng > max_lng
+        min_lat, max_lat, min_lng, max_lng = bounding_box(0.0, 179.95, 20)
+        self.assertAlmostEqual(min_lng, 179.95 - 0.1799, places=3)
+        self.assertAlmostEqual(max_lng, -180 + (179.95 + 0.1799 - 180), places=3)
+
+        # Reaching a pole: every longitude
+        self.assertEqual(bounding_box(89.9, 0.0, 50)[1:], (90.0, -180.0, 180.0))
+        self.assertEqual(bounding_box(0.0, 0.0, 20000), (-90.0, 90.0, -180.0, 180.0))
+
+    def test_database_search(self):
+        backend = DatabaseNearbySearch()
+        for radius in (1, 10, 50, 200):
+            self.assertHits(backend.search(10.0, 10.0, radius), self.expected(10.0, 10.0, radius))
+        self.assertHits(backend.search(0.0, 180.0, 20), self.expected(0.0, 180.0, 20))
+        self.assertHits(backend.search(90.0, 0.0, 50), self.expected(90.0, 0.0, 50))
+        self.assertHits(backend.search(-60.0, -100.0, limit=3), self.expected(-60.0, -100.0)[:3])
+        self.assertHits(self.pages(backend, 10.0, 10.0, 2), self.expected(10.0, 10.0))
+        self.assertHits(self.pages(backend, 10.0, 10.0, 2, radius=50), self.expected(10.0, 10.0, 50))
+
+    def test_numpy_engine_matches_sql(self):
+        engine = VectorDistanceEngine()
+        engine.rebuild()
+        sql = DatabaseNearbySearch()
+        queries = [
+            ((10.0, 10.0, 50), {}),
+            ((10.0, 10.0, 200), {'limit': 2}),
+            ((10.0, 10.0, None), {'limit': 3}),
+            ((0.0, 180.0, 20), {}),
+            ((90.0, 0.0, 50), {}),
+            ((-60.0, -100.0, None), {'limit': 4}),
+        ]
+        for args, kwargs in queries:
+            with self.subTest(args=args, **kwargs):
+                expected = sql.search(*args, **kwargs)
+                self.assertHits(engine.search(*args, **kwargs), expected)
+                # Resume after each hit, including from inside the tie
+                for after in expected:
+                    self.assertHits(engine.search(*args, after=after, **kwargs), sql.search(*args, after=after, **kwargs))
+        self.assertHits(self.pages(engine, 10.0, 10.0, 2), self.pages(sql, 10.0, 10.0, 2))
+
+    def test_bounding_box_prefilters_in_sql(self):
+        sql = str(within_radius(DentalClinic.objects.all(), 10.0, 10.0, 50).query)
+        self.assertIn('"latitude" BETWEEN', sql)
+        self.assertIn('"longitude" BETWEEN', sql)
+        # Across the antimeridian the longitude range is split in two
+        sql = str(within_radius(DentalClinic.objects.all(), 0.0, 180.0, 20).query)
+        self.assertIn('"longitude" >= 179.8', sql)
+        self.assertIn('OR', sql)
+        # Around a pole only the latitude narrows the search
+        sql = str(within_radius(DentalClinic.objects.all(), 90.0, 0.0, 50).query)
+        self.assertNotIn('"longitude" BETWEEN', sql)
+
+    def test_nearest_clinics_search_growing_rings(self):
+        backend = DatabaseNearbySearch()
+        with CaptureQueriesContext(connection) as queries:
+            hits = backend.search(10.0, 10.0, limit=2)
+        self.assertHits(hits, self.expected(10.0, 10.0)[:2])
+        self.assertEqual(len(queries), 1)
+        self.assertIn('BETWEEN', queries[0]['sql'])
+        # Far from every clinic the rings widen until enough are found
+        with CaptureQueriesContext(connection) as queries:
+            hits = async_to_sync(backend.asearch)(-60.0, -100.0, limit=3)
+        self.assertHits(hits, self.expected(-60.0, -100.0)[:3])
+        self.assertGreater(len(queries), 1)
+        self.assertTrue(all('BETWEEN' in query['sql'] for query in queries))
+        # Past the widest ring every clinic is scanned
+        self.assertHits(backend.search(-60.0, -100.0, limit=len(self.POINTS) + 1), self.expected(-60.0, -100.0))
+
+    @override_settings(NEARBY_CACHE_TIMEOUT=0)
+    def test_nearby_cursor_pages(self):
+        client = APIClient()
+        for params in ({"limit": 2}, {"limit": 2, "radius": 50}, {"k": 1}):
+            with self.subTest(**params):
+                seen = []
+                response = client.get("/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "fields": "id", **params})
+                while True:
+                    page = response.json()
+                    seen += [row["id"] for row in page["results"]]
+                    if page["next"] is None:
+                        break
+                    response = client.get(page["next"])
+                expected = self.expected(10.0, 10.0, params.get("radius"))
+                self.assertEqual(seen, [clinic_id for _, clinic_id in expected])
+
+    def test_malformed_cursors_are_rejected(self):
+        client = APIClient()
+        for cursor in ("!!!", "bm90IGEgY3Vyc29y", encode_cursor(float("nan"), 1), encode_cursor(float("inf"), 1),
+                       base64.urlsafe_b64encode(b"1.5:x").decode(), base64.urlsafe_b64encode(b"1:2:3").decode()):
+            with self.subTest(cursor=cursor):
+                response = client.get("/api/admin/clinics/nearby/", {"lat": 10, "lng": 10, "limit": 2, "cursor": cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": "Invalid limit or cursor value"})
+
+    def test_radius_is_limited(self):
+        client = APIClient()
+        for radius in (20000, 0, -5, "nan"):
+            response = client.get("/api/admin/clinics/nearby/", {"lat": 10, "lng": 10, "radius": radius})
+            self.assertEqual(response.status_code, 400, radius)
+        response = client.get("/api/admin/clinics/nearby/", {"lat": 10, "lng": 10, "radius": 500})
+        self.assertEqual(response.status_code, 200)
+
+
+class ReviewAggregateTests(TestCase):
+    def setUp(self):
+        self.clinic = DentalClinic.objects.create(name="Clinic", address="1 Main St", latitude=10.0, longitude=10.0)
+
+    def assertAggregates(self, clinic, review_count, average_rating):
+        clinic.refresh_from_db()
+        self.assertEqual(clinic.review_count, review_count)
+        if average_rating is None:
+            self.assertIsNone(clinic.average_rating)
+        else:
+            self.assertAlmostEqual(clinic.average_rating, average_rating)
+
+    def test_review_writes_keep_the_aggregates_current(self):
+        first = Review.objects.create(clinic=self.clinic, author_name="A", rating=4, text="Good")
+        second = Review.objects.create(clinic=self.clinic, author_name="B", rating=2, text="Meh")
+        self.assertAggregates(self.clinic, 2, 3.0)
+
+        second.rating = 5
+        second.save()
+        self.assertAggregates(self.clinic, 2, 4.5)
+
+        Review.objects.bulk_create([
+            Review(clinic=self.clinic, author_name="C", rating=3, text="Fine"),
+            Review(clinic=self.clinic, author_name="D", rating=0, text="Bad"),
+        ])
+        self.assertAggregates(self.clinic, 4, 3.0)
+
+        first.delete()
+        self.assertAggregates(self.clinic, 3, 8 / 3)
+        Review.objects.filter(clinic=self.clinic).delete()
+        self.assertAggregates(self.clinic, 0, None)
+
+    def test_rebuild_review_aggregates(self):
+        other = DentalClinic.objects.create(name="Other", address="2 Main St", latitude=10.0, longitude=10.0)
+        Review.objects.create(clinic=self.clinic, author_name="A", rating=4, text="Good")
+        Review.objects.create(clinic=self.clinic, author_name="B", rating=3, text="Fine")
+        DentalClinic.objects.update(review_count=7, review_rating_sum=1.0)
+
+        call_command("rebuild_review_aggregates", batch_size=1, stdout=io.StringIO())
+        self.assertAggregates(self.clinic, 2, 3.5)
+        self.assertAggregates(other, 0, None)
+
+
+class NestedClinicWriteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        admin = User.objects.create(username="admin", email="admin@example.com", is_staff=True, is_superuser=True)
+        self.client.force_authenticate(admin)
+
+    def hours(self, clinic_id):
+        return {
+            hours.day: (hours.pk, hours.opening_time, hours.closing_time, hours.is_closed)
+            for hours in BusinessHours.objects.filter(clinic_id=clinic_id)
+        }
+
+    def test_create_and_update_nested_data(self):
+        response = self.client.post("/api/admin/clinics/", {
+            "name": "Clinic", "address": "1 Main St", "latitude": 10.0, "longitude": 10.0,
+            "business_hours": [
+                {"day": 0, "opening_time": "09:00", "closing_time": "17:00"},
+                {"day": 1, "opening_time": "09:00", "closing_time": "17:00"},
+                {"day": 6, "is_closed": True},
+            ],
+            "images": [{"image_url": "https://example.com/a.jpg", "is_primary": True}],
+            "reviews": [
+                {"author_name": "A", "rating": 4, "text": "Good"},
+                {"author_name": "B", "rating": 5, "text": "Great"},
+            ],
+        }, format="json")
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual((response.json()["review_count"], response.json()["average_rating"]), (2, 4.5))
+        clinic = DentalClinic.objects.get(pk=response.json()["id"])
+        self.assertEqual(clinic.open_intervals, [[540, 1020], [1980, 2460]])
+        self.assertEqual(clinic.images.count(), 1)
+        before = self.hours(clinic.pk)
+
+        # Monday changes, Tuesday stays, Wednesday is added and Sunday removed
+        response = self.client.patch(f"/api/admin/clinics/{clinic.pk}/", {
+            "business_hours": [
+                {"day": 0, "opening_time": "10:00", "closing_time": "18:00"},
+                {"day": 1, "opening_time": "09:00", "closing_time": "17:00"},
+                {"day": 2, "opening_time": "08:00", "closing_time": "12:00"},
+            ],
+            "reviews": [{"author_name": "C", "rating": 3, "text": "Fine"}],
+        }, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual((response.json()["review_count"], response.json()["average_rating"]), (3, 4.0))
+
+        after = self.hours(clinic.pk)
+        self.assertEqual(sorted(after), [0, 1, 2])
+        self.assertEqual(after[0][0], before[0][0])
+        self.assertEqual(after[0][1:3], (dt_time(10), dt_time(18)))
+        self.assertEqual(after[1], before[1])
+        clinic.refresh_from_db()
+        self.assertEqual(clinic.open_intervals, [[600, 1080], [1980, 2460], [3360, 3600]])
+        self.assertEqual((clinic.review_count, clinic.average_rating), (3, 4.0))
+
+        # Leaving out business_hours keeps them
+        response = self.client.patch(f"/api/admin/clinics/{clinic.pk}/", {"name": "Renamed"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.hours(clinic.pk), after)
+
+
+def clinic_row(name, **fields):
+    return json.dumps({"name": name, "address": "1 Main St", "latitude": 10.0, "longitude": 10.0, **fields})
+
+
+class ClinicImportTests(TestCase):
+    def test_bad_rows_are_reported_without_losing_the_chunk(self):
+        DentalClinic.objects.create(name="Taken", address="1 Main St", latitude=10.0, longitude=10.0, place_id="taken")
+        monday = {"day": 0, "opening_time": "09:00", "closing_time": "17:00"}
+        lines = [
+            clinic_row("A", place_id="a", business_hours=[monday], reviews=[{"author_name": "X", "rating": 4, "text": "Ok"}]),
+            "not json",
+            clinic_row("B", business_hours=[monday, monday]),
+            clinic_row("C", place_id="a"),
+            clinic_row("D", place_id="taken"),
+            clinic_row("E"),
+        ]
+        report = ClinicImporter(chunk_size=10).run(lines, "jsonl").as_dict()
+
+        self.assertEqual((report["imported"], report["failed"], report["last_row"]), (2, 4, 6))
+        self.assertEqual([error["row"] for error in report["errors"]], [2, 3, 4, 5])
+        self.assertIn("business_hours", report["errors"][1]["errors"])
+        self.assertIn("place_id", report["errors"][2]["errors"])
+        self.assertIn("place_id", report["errors"][3]["errors"])
+        clinic = DentalClinic.objects.get(place_id="a")
+        self.assertEqual((clinic.review_count, clinic.open_intervals), (1, [[540, 1020]]))
+        self.assertTrue(DentalClinic.objects.filter(name="E").exists())
+
+    def test_rows_rejected_by_the_database_fail_alone(self):
+        importer = ClinicImporter()
+        rows = [
+            (1, {"name": "A", "address": "1 Main St", "latitude": 10.0, "longitude": 10.0, "place_id": "a"}),
+            # Validated before another writer saved the same place_id
+            (2, {"name": "B", "address": "1 Main St", "latitude": 10.0, "longitude": 10.0, "place_id": "a"}),
+            (3, {"name": "C", "address": "1 Main St", "latitude": 10.0, "longitude": 10.0}),
+        ]
+        report = ImportReport()
+        importer.write_rows(rows, report)
+        self.assertEqual((report.imported, report.failed), (2, 1))
+        self.assertEqual(report.errors[0]["row"], 2)
+        self.assertEqual(sorted(DentalClinic.objects.values_list("name", flat=True)), ["A", "C"])
+
+    def test_command_resumes_from_its_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/clinics.jsonl"
+            checkpoint = f"{directory}/checkpoint.json"
+            with open(path, "w") as f:
+                f.write("\n".join(clinic_row(f"Clinic {i}") for i in range(3)) + "\n")
+            call_command("import_clinics", path, chunk_size=2, checkpoint=checkpoint, stdout=io.StringIO())
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f), {"last_row": 3})
+
+            # More rows arrive; only those are imported by the next run
+            with open(path, "a") as f:
+                f.write("\n".join(clinic_row(f"Clinic {i}") for i in range(3, 5)) + "\n")
+            call_command("import_clinics", path, chunk_size=2, checkpoint=checkpoint, stdout=io.StringIO())
+        self.assertEqual(
+            sorted(DentalClinic.objects.values_list("name", flat=True)), [f"Clinic {i}" for i in range(5)]
+        )
+
+    def test_bulk_import_endpoint_starts_after(self):
+        client = APIClient()
+        admin = User.objects.create(username="admin", email="admin@example.com", is_staff=True, is_superuser=True)
+        client.force_authenticate(admin)
+        upload = SimpleUploadedFile(
+            "clinics.csv",
+            b"name,address,latitude,longitude\nA,1 Main St,10,10\nB,1 Main St,10,10\nC,1 Main St,10,10\n",
+        )
+        response = client.post("/api/admin/clinics/bulk-import/", {"file": upload, "start_after": 2})
+        self.assertEqual(response.json(), {"imported": 1, "failed": 0, "last_row": 3, "errors": []})
+        self.assertEqual(list(DentalClinic.objects.values_list("name", flat=True)), ["C"])
+
+
+class FakePlacesHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the Place Details API that counts its requests and
+    answers with the place's entry in `results`, or fails with `status_code`.
+    """
+    requests_seen = []
+    results = {}
+    status_code = 200
+
+    def do_GET(self):
+        place_id = parse_qs(urlparse(self.path).query)["place_id"][0]
+        self.requests_seen.append(place_id)
+        time.sleep(0.2)
+        body = json.dumps({"status": "OK", "result": self.results.get(place_id, {"place_id": place_id})}).encode()
+        self.send_response(self.status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakePlacesMixin:
+    def setUp(self):
+        super().setUp()
+        FakePlacesHandler.requests_seen = []
+        FakePlacesHandler.results = {}
+        FakePlacesHandler.status_code = 200
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakePlacesHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url = f"http://127.0.0.1:{self.server.server_port}/details/json"
+        self.enterContext(override_settings(GOOGLE_PLACE_DETAILS_URL=url))
+
+
+class PlaceDetailsClientTests(FakePlacesMixin, SimpleTestCase):
+    def test_concurrent_lookups_are_coalesced_and_cached(self):
+        client = PlaceDetailsClient(ttl=60, max_entries=10, timeout=5)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(client.get, ["abc"] * 8))
+
+        self.assertEqual(FakePlacesHandler.requests_seen, ["abc"])
+        self.assertTrue(all(result == {"status": "OK", "result": {"place_id": "abc"}} for result in results))
+
+        client.get("abc")
+        self.assertEqual(FakePlacesHandler.requests_seen, ["abc"])
+
+    def test_async_lookups_share_the_cache_and_in_flight_calls(self):
+        client = PlaceDetailsClient(ttl=60, max_entries=10, timeout=(5, 5))
+
+        async def lookups():
+            return await asyncio.gather(*(client.aget("xyz") for _ in range(8)))
+
+        results = asyncio.run(lookups())
+        self.assertEqual(FakePlacesHandler.requests_seen, ["xyz"])
+        self.assertEqual(len({json.dumps(result) for result in results}), 1)
+        self.assertEqual(client.get("xyz"), results[0])
+        self.assertEqual(FakePlacesHandler.requests_seen, ["xyz"])
+
+    def test_sync_and_async_callers_share_upstream_failures(self):
+        FakePlacesHandler.status_code = 503
+        client = PlaceDetailsClient(ttl=60, max_entries=10, timeout=(5, 5))
+
+        def wait_for_request(count):
+            while len(FakePlacesHandler.requests_seen) < count:
+                time.sleep(0.01)
+
+        # A sync leader fails an async follower
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(client.get, "bad")
+            wait_for_request(1)
+            with self.assertRaises(PlaceDetailsError):
+                asyncio.run(client.aget("bad"))
+            self.assertRaises(PlaceDetailsError, leader.result)
+
+        # And an async leader a sync follower
+        async def lookups():
+            leader = asyncio.ensure_future(client.aget("bad"))
+            await asyncio.to_thread(wait_for_request, 2)
+            follower = asyncio.get_running_loop().run_in_executor(None, client.get, "bad")
+            return await asyncio.gather(leader, follower, return_exceptions=True)
+
+        results = asyncio.run(lookups())
+        self.assertTrue(all(isinstance(result, PlaceDetailsError) for result in results), results)
+        self.assertEqual(FakePlacesHandler.requests_seen, ["bad", "bad"])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        client = PlaceDetailsClient(ttl=60, max_entries=2, timeout=5)
+        for place_id in ["a", "b", "a", "c", "a", "b"]:
+            client.get(place_id)
+        self.assertEqual(FakePlacesHandler.requests_seen, ["a", "b", "c", "b"])
+
+
+class FakeWebhookHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the lead webhook that answers with `status_code` after
+    `delay` seconds and tracks how many requests it served at once.
+    """
+    status_code = 200
+    delay = 0
+    payloads = []
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(self.delay)
+        self.payloads.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+        with cls.lock:
+            cls.active -= 1
+        self.send_response(self.status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookOutboxTests(TestCase):
+    def setUp(self):
+        FakeWebhookHandler.status_code = 200
+        FakeWebhookHandler.delay = 0
+        FakeWebhookHandler.payloads = []
+        FakeWebhookHandler.max_active = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeWebhookHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        url = f"http://127.0.0.1:{self.server.server_port}/hook"
+        self.enterContext(override_settings(LEADCONNECTOR_WEBHOOK_URL=url))
+
+    def submit(self, **answers):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = APIClient().post("/api/admin/add-email/", {"answers": answers}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(callbacks, [outbox.schedule_drain])
+
+    def test_submission_is_queued_and_delivered_once_per_email(self):
+        self.submit(email="a@example.com", anxiety="low")
+        self.submit(email="a@example.com", anxiety="high")
+        self.assertEqual(FakeWebhookHandler.payloads, [])
+
+        self.assertEqual(outbox.drain()[WebhookOutbox.DELIVERED], 1)
+        self.assertEqual(FakeWebhookHandler.payloads, [{"email": "a@example.com", "anxiety": "high"}])
+        self.assertEqual(outbox.stats()["delivered_last_hour"], 1)
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        FakeWebhookHandler.status_code = 503
+        self.submit(email="b@example.com")
+
+        self.assertEqual(outbox.drain()[WebhookOutbox.PENDING], 1)
+        row = WebhookOutbox.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.next_attempt_at, row.enqueued_at)
+        # Not due yet
+        self.assertEqual(outbox.drain()[WebhookOutbox.PENDING], 0)
+        self.assertEqual(outbox.stats()["retrying"], 1)
+
+        FakeWebhookHandler.status_code = 200
+        WebhookOutbox.objects.update(next_attempt_at=row.enqueued_at)
+        self.assertEqual(outbox.drain()[WebhookOutbox.DELIVERED], 1)
+        self.assertEqual(len(FakeWebhookHandler.payloads), 2)
+
+    def test_batches_are_sent_concurrently_within_the_limit(self):
+        FakeWebhookHandler.delay = 0.05
+        for number in range(20):
+            self.submit(email=f"c{number}@example.com")
+
+        counts = outbox.drain(batch_size=10, concurrency=4, rate=0)
+        self.assertEqual(counts[WebhookOutbox.DELIVERED], 20)
+        self.assertGreater(FakeWebhookHandler.max_active, 1)
+        self.assertLessEqual(FakeWebhookHandler.max_active, 4)
+        self.assertEqual(WebhookOutbox.objects.filter(status=WebhookOutbox.DELIVERED).count(), 20)
+        self.assertEqual(outbox.stats()["last_batch"]["size"], 10)
+
+    def test_rate_limiter_spaces_out_requests(self):
+        bucket = outbox.TokenBucket(rate=50, burst=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+        # Successive drains share one budget
+        self.assertIs(outbox.get_rate_limiter(50, 4), outbox.get_rate_limiter(50, 4))
+        self.assertIsNot(outbox.get_rate_limiter(50, 4), outbox.get_rate_limiter(50, 8))
+
+
+@override_settings(NEARBY_SEARCH_BACKEND='sql', CACHES=LOCMEM_CACHES)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_async_nearby_matches_the_sync_endpoint(self):
+        for offset in range(3):
+            create_clinic(10.0 + offset / 100, 10.0)
+        for params in (
+            {"lat": 10.0, "lng": 10.0, "radius": 20},
+            {"lat": 10.0, "lng": 10.0, "limit": 2, "view": "summary"},
+            {"lat": 10.0, "lng": 10.0, "radius": 20, "limit": 2, "view": "summary"},
+        ):
+            expected = APIClient().get("/api/admin/clinics/nearby/", params).json()
+            response = self.client.get("/api/admin/async/clinics/nearby/", params)
+            self.assertEqual(response.status_code, 200)
+            if "limit" in params:
+                expected["next"] = expected["next"].replace("/clinics/nearby/", "/async/clinics/nearby/")
+            self.assertEqual(response.json(), expected)
+
+        response = self.client.get("/api/admin/async/clinics/nearby/", {"lat": 10.0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_async_add_email_queues_the_submission(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                "/api/admin/async/add-email/", {"answers": {"email": "d@example.com"}}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookOutbox.objects.get().email, "d@example.com")
+        self.assertEqual(len(callbacks), 1)
+
+    def test_async_place_details_requires_an_admin(self):
+        self.assertEqual(self.client.get("/api/admin/async/place-details/", {"place_id": "x"}).status_code, 401)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ClinicRefreshTests(FakePlacesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.clinic = create_clinic(10.0, 10.0)
+        self.clinic.place_id = "place-1"
+        self.clinic.save()
+        DentalClinic.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        FakePlacesHandler.results["place-1"] = {
+            "name": "Renamed Clinic",
+            "formatted_address": "1 Main St",
+            "geometry": {"location": {"lat": 10.0, "lng": 10.0}},
+            "opening_hours": {"periods": [
+                # Monday 09:00-17:00 and a Sunday shift
+                {"open": {"day": 1, "time": "0900"}, "close": {"day": 1, "time": "1700"}},
+                {"open": {"day": 0, "time": "1000"}, "close": {"day": 0, "time": "1400"}},
+            ]},
+            "reviews": [
+                {"author_name": "A", "rating": 4, "text": "Good"},
+                {"author_name": "D", "rating": 3, "text": "Fine"},
+            ],
+        }
+
+    def test_only_changes_are_applied(self):
+        report = refresh.refresh_stale_clinics()
+        self.assertEqual(report["refreshed"], 1)
+        self.assertEqual(report["changed"], 1)
+
+        self.clinic.refresh_from_db()
+        self.assertEqual(self.clinic.name, "Renamed Clinic")
+        self.assertEqual(self.clinic.review_count, 3)
+        hours = {hours.day: hours for hours in self.clinic.business_hours.all()}
+        self.assertEqual(str(hours[0].opening_time), "09:00:00")
+        self.assertEqual(str(hours[6].closing_time), "14:00:00")
+        self.assertTrue(hours[3].is_closed)
+
+        # Refreshed clinics are not picked again until they are stale
+        self.assertEqual(refresh.refresh_stale_clinics()["refreshed"], 0)
+        self.assertEqual(FakePlacesHandler.requests_seen, ["place-1"])
+
+    def test_only_changed_clinics_get_a_new_updated_at(self):
+        unchanged = create_clinic(10.01, 10.0)
+        DentalClinic.objects.filter(pk=unchanged.pk).update(place_id="place-2", updated_at=self.clinic.updated_at)
+        stale = DentalClinic.objects.get(pk=unchanged.pk).updated_at
+
+        self.assertEqual(refresh.refresh_stale_clinics()["refreshed"], 2)
+        unchanged.refresh_from_db()
+        self.clinic.refresh_from_db()
+        self.assertEqual(unchanged.updated_at, stale)
+        self.assertIsNotNone(unchanged.refreshed_at)
+        self.assertGreater(self.clinic.updated_at, stale)
+        self.assertEqual(self.clinic.refreshed_at, unchanged.refreshed_at)
+
+    def test_edits_made_during_the_run_are_kept(self):
+        place_fields = refresh.place_fields
+
+        def edit_then_compare(result):
+            # An admin saves the clinic after the batch was read
+            DentalClinic.objects.filter(pk=self.clinic.pk).update(phone_number="555-0100")
+            return place_fields(result)
+
+        with mock.patch.object(refresh, "place_fields", edit_then_compare):
+            refresh.refresh_stale_clinics()
+        self.clinic.refresh_from_db()
+        self.assertEqual((self.clinic.name, self.clinic.phone_number), ("Renamed Clinic", "555-0100"))
+
+    def test_moved_clinics_are_reindexed(self):
+        FakePlacesHandler.results["place-1"]["geometry"]["location"] = {"lat": 10.5, "lng": 10.0}
+        with mock.patch.object(refresh, "index_clinics") as index_clinics:
+            with self.captureOnCommitCallbacks(execute=True):
+                refresh.refresh_stale_clinics()
+        index_clinics.assert_called_once_with([(self.clinic.pk, 10.5, 10.0)])
+
+    def test_hours_that_cannot_be_stored_are_kept(self):
+        BusinessHours.objects.filter(clinic=self.clinic, day=1).update(
+            is_closed=False, opening_time=dt_time(8), closing_time=dt_time(16)
+        )
+        FakePlacesHandler.results["place-1"]["opening_hours"]["periods"] = [
+            # Tuesday with a lunch break, overnight on Friday, 26 hours from Saturday
+            {"open": {"day": 2, "time": "0900"}, "close": {"day": 2, "time": "1200"}},
+            {"open": {"day": 2, "time": "1300"}, "close": {"day": 2, "time": "1700"}},
+            {"open": {"day": 5, "time": "1800"}, "close": {"day": 6, "time": "0200"}},
+            {"open": {"day": 6, "time": "1000"}, "close": {"day": 0, "time": "1200"}},
+        ]
+        refresh.refresh_stale_clinics()
+
+        self.clinic.refresh_from_db()
+        hours = {hours.day: hours for hours in self.clinic.business_hours.all()}
+        self.assertEqual((hours[1].opening_time, hours[1].closing_time), (dt_time(8), dt_time(16)))
+        self.assertEqual((hours[4].opening_time, hours[4].closing_time), (dt_time(18), dt_time(2)))
+        self.assertTrue(hours[5].is_closed)
+        self.assertEqual(len(hours), 7)
+        # Tuesday 08:00-16:00 and Friday 18:00 to Saturday 02:00
+        self.assertEqual(self.clinic.open_intervals, [[1920, 2400], [6840, 7320]])
+
+    def test_values_that_do_not_fit_are_dropped(self):
+        result = FakePlacesHandler.results["place-1"]
+        result.update(name="N" * 300, website="https://example.com/" + "a" * 200, rating=7)
+        result["reviews"].append({"author_name": "E", "rating": 9, "text": "Off the scale"})
+        report = refresh.refresh_stale_clinics()
+        self.assertEqual(report["failed"], 0)
+
+        self.clinic.refresh_from_db()
+        self.assertEqual(self.clinic.name, "N" * 255)
+        self.assertIsNone(self.clinic.website)
+        self.assertIsNone(self.clinic.rating)
+        self.assertEqual(sorted(self.clinic.reviews.values_list("author_name", flat=True)), ["A", "B", "D"])
+
+    def test_a_clinic_the_database_rejects_does_not_block_the_batch(self):
+        other = create_clinic(10.01, 10.0)
+        DentalClinic.objects.filter(pk=other.pk).update(place_id="place-2")
+        FakePlacesHandler.results["place-2"] = {"name": "Other Renamed"}
+        diff_business_hours = DentalClinicSerializer.diff_business_hours
+
+        def conflicting_diff(clinic, hours):
+            to_create, to_update, to_delete = diff_business_hours(clinic, hours)
+            if clinic.pk == self.clinic.pk:
+                # A day added by someone else since the hours were read
+                to_create.append(BusinessHours(clinic=clinic, day=0, is_closed=True))
+            return to_create, to_update, to_delete
+
+        with mock.patch.object(DentalClinicSerializer, "diff_business_hours", conflicting_diff):
+            report = refresh.refresh_stale_clinics()
+        self.assertEqual((report["refreshed"], report["changed"], report["failed"]), (2, 1, 1))
+        self.assertEqual(DentalClinic.objects.get(pk=other.pk).name, "Other Renamed")
+        self.assertEqual(DentalClinic.objects.get(pk=self.clinic.pk).name, "Clinic")
+        # Both move to the back of the queue
+        self.assertEqual(DentalClinic.objects.filter(refreshed_at__isnull=True).count(), 0)
+
+    def test_overlapping_runs_are_skipped(self):
+        cache.add(refresh.LOCK_KEY, "other run")
+        self.assertIsNone(refresh.refresh_stale_clinics())
+        self.assertEqual(FakePlacesHandler.requests_seen, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OpenHoursTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def open_on(self, clinic, day, opening, closing):
+        hours = clinic.business_hours.get(day=day)
+        hours.opening_time, hours.closing_time, hours.is_closed = dt_time(*opening), dt_time(*closing), False
+        hours.save()
+
+    def test_overnight_hours_wrap_around_the_week(self):
+        self.assertEqual(
+            weekly_intervals([(6, dt_time(22), dt_time(2), False), (0, dt_time(9), dt_time(17), False)]),
+            [[0, 120], [540, 1020], [9960, 10080]],
+        )
+        self.assertEqual(weekly_intervals([(2, dt_time(0), dt_time(23, 59), False)]), [[2880, 4320]])
+
+    def clinic_in(self, tz, latitude):
+        clinic = create_clinic(latitude, 10.0)
+        clinic.timezone = tz
+        clinic.save()
+        return clinic
+
+    def test_nearby_filters_on_open_at(self):
+        day_clinic = self.clinic_in("UTC", 10.0)
+        self.open_on(day_clinic, 0, (9,), (17,))
+        new_york_clinic = self.clinic_in("America/New_York", 10.01)
+        self.open_on(new_york_clinic, 0, (9,), (17,))
+        night_clinic = self.clinic_in("UTC", 10.02)
+        self.open_on(night_clinic, 6, (22,), (2,))
+        self.assertEqual(DentalClinic.objects.get(pk=night_clinic.pk).open_intervals, [[0, 120], [9960, 10080]])
+        open_hours_index.rebuild()
+
+        expected = {
+            "2025-01-06T10:00:00Z": [day_clinic.pk],
+            "2025-01-06T15:30:00+00:00": [day_clinic.pk, new_york_clinic.pk],
+            "2025-01-06T01:00:00Z": [night_clinic.pk],
+            "2025-01-05T23:00:00": [night_clinic.pk],
+        }
+        for backend in ("sql", "grid", "numpy"):
+            with self.settings(NEARBY_SEARCH_BACKEND=backend):
+                if backend != "sql":
+                    get_nearby_backend().rebuild()
+                for open_at, ids in expected.items():
+                    response = APIClient().get(
+                        "/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "radius": 20, "open_at": open_at}
+                    )
+                    self.assertEqual([clinic["id"] for clinic in response.json()], ids, (backend, open_at))
+
+        response = APIClient().get("/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "open_at": "soon"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_clinics_without_a_timezone_use_the_default(self):
+        clinic = create_clinic(10.0, 10.0)
+        self.open_on(clinic, 0, (0,), (23, 59))
+        monday_noon = datetime(2025, 1, 6, 12, tzinfo=dt_timezone.utc)
+        monday_night = datetime(2025, 1, 6, 23, 30, tzinfo=dt_timezone.utc)
+        # While unset, TIME_ZONE
+        with self.settings(OPEN_HOURS_DEFAULT_TIMEZONE="", TIME_ZONE="Asia/Tokyo"):
+            open_hours_index.rebuild()
+            self.assertEqual(open_hours_index.open_at(monday_night), frozenset())
+
+        with self.settings(OPEN_HOURS_DEFAULT_TIMEZONE="Asia/Tokyo"):
+            open_hours_index.rebuild()
+            self.assertEqual(open_hours_index.open_at(monday_noon), {clinic.pk})
+            # Already Tuesday in Tokyo
+            self.assertEqual(open_hours_index.open_at(monday_night), frozenset())
+
+        clinic.timezone = "UTC"
+        with self.captureOnCommitCallbacks(execute=True):
+            clinic.save()
+        self.assertEqual(open_hours_index.open_at(monday_night), {clinic.pk})
+
+
+class ClinicSearchTests(TestCase):
+    def setUp(self):
+        self.smile = DentalClinic.objects.create(
+            name="Bright Smile Dental", address="1 Main St", latitude=10.0, longitude=10.0
+        )
+        self.far_smile = DentalClinic.objects.create(
+            name="Smile Studio", address="9 Harbour Rd", latitude=11.0, longitude=10.0
+        )
+        self.family = DentalClinic.objects.create(
+            name="Family Dentistry", address="5 Oak Ave", latitude=10.01, longitude=10.0
+        )
+        Review.objects.create(clinic=self.family, author_name="A", rating=5, text="Gentle with nervous patients")
+
+    def search(self, **params):
+        response = APIClient().get("/api/admin/clinics/search/", params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_search_matches_names_and_review_texts(self):
+        self.assertEqual({clinic["id"] for clinic in self.search(q="smile")["results"]}, {self.smile.pk, self.far_smile.pk})
+        self.assertEqual([clinic["id"] for clinic in self.search(q="nervous")["results"]], [self.family.pk])
+
+        # Reviews written later are searchable too
+        Review.objects.create(clinic=self.smile, author_name="B", rating=4, text="Very nervous but fine")
+        self.assertEqual({clinic["id"] for clinic in self.search(q="nervous")["results"]}, {self.smile.pk, self.family.pk})
+
+    def test_search_near_a_point(self):
+        page = self.search(q="smile", lat=10.0, lng=10.0, radius=50)
+        self.assertEqual([clinic["id"] for clinic in page["results"]], [self.smile.pk])
+        self.assertEqual(page["results"][0]["distance"], 0)
+
+        page = self.search(q="smile", lat=10.9, lng=10.0, radius=500)
+        self.assertEqual([clinic["id"] for clinic in page["results"]], [self.far_smile.pk, self.smile.pk])
+
+    def test_search_pages(self):
+        first = self.search(q="smile", limit=1)
+        second = APIClient().get(first["next"]).json()
+        self.assertEqual(len(first["results"]), 1)
+        self.assertIsNone(second["next"])
+        self.assertEqual(
+            {clinic["id"] for clinic in first["results"] + second["results"]}, {self.smile.pk, self.far_smile.pk}
+        )
+
+        invalid = (
+            {},
+            {"q": "smile", "lat": 10.0},
+            {"q": "smile", "limit": 0},
+            {"q": "smile", "offset": 100000},
+            {"q": "smile", "lat": "nan", "lng": 10.0},
+            {"q": "smile", "lat": 1000, "lng": 10.0},
+            {"q": "smile", "lat": 10.0, "lng": 10.0, "radius": "inf"},
+            {"q": "smile", "lat": 10.0, "lng": 10.0, "radius": 1e9},
+        )
+        for params in invalid:
+            response = APIClient().get("/api/admin/clinics/search/", params)
+            self.assertEqual(response.status_code, 400, params)
+
+    @skipUnless(connection.vendor == "postgresql", "full-text ranking needs PostgreSQL")
+    def test_name_matches_rank_above_review_matches(self):
+        Review.objects.create(clinic=self.family, author_name="B", rating=5, text="Left with a big smile")
+        results = self.search(q="smile")["results"]
+        self.assertEqual(results[-1]["id"], self.family.pk)
+
+    def test_autocomplete(self):
+        response = APIClient().get("/api/admin/clinics/autocomplete/", {"q": "smi"})
+        self.assertEqual(
+            {row["name"] for row in response.json()}, {"Bright Smile Dental", "Smile Studio"}
+        )
+
+
+class ClinicExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        admin = User.objects.create(username="admin", email="admin@example.com", is_staff=True, is_superuser=True)
+        self.client.force_authenticate(admin)
+
+    def export(self, **params):
+        response = self.client.get("/api/admin/clinics/export/", params)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_ndjson_export_is_incremental(self):
+        first = create_clinic(10.0, 10.0)
+        second = create_clinic(10.01, 10.0)
+        DentalClinic.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+        response, body = self.export(output="ndjson")
+        records = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([record["id"] for record in records], [first.pk, second.pk])
+        self.assertEqual(len(records[0]["business_hours"]), 7)
+        self.assertEqual([review["text"] for review in records[0]["reviews"]], ["Good", "Great"])
+
+        # The watermark trails the export, so the next one overlaps it
+        watermark = response["X-Export-Watermark"]
+        self.assertLessEqual(datetime.fromisoformat(watermark), timezone.now() - timedelta(minutes=5))
+        # A new review counts as a change to its clinic
+        Review.objects.create(clinic=first, author_name="C", rating=2, text="Slow")
+        _, body = self.export(since=watermark)
+        self.assertEqual([json.loads(line)["id"] for line in body.splitlines()], [first.pk])
+
+    def test_csv_export(self):
+        clinic = create_clinic(10.0, 10.0)
+        BusinessHours.objects.filter(clinic=clinic, day=0).update(
+            opening_time=dt_time(9), closing_time=dt_time(17), is_closed=False
+        )
+        # Hours missing their closing time read as closed rather than failing the export
+        BusinessHours.objects.filter(clinic=clinic, day=2).update(
+            opening_time=dt_time(9), closing_time=None, is_closed=False
+        )
+        response, body = self.export(output="csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        header, row = body.splitlines()
+        self.assertTrue(header.startswith("id,name,"))
+        self.assertIn("Mon 09:00-17:00; Tue closed; Wed closed", row)
+        self.assertIn("https://example.com/a.jpg", row)
+
+        self.assertEqual(self.client.get("/api/admin/clinics/export/", {"since": "yesterday"}).status_code, 400)
+
+
+class ClinicImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(self.settings(MEDIA_ROOT=media_root.name))
+        cache.clear()
+
+    def upload(self, clinic, content):
+        image = ClinicImage(clinic=clinic, is_primary=True)
+        image.image_file.save("photo.jpg", ContentFile(content), save=False)
+        image.save()
+        return image
+
+    def photo(self):
+        exif = Image.Exif()
+        exif[0x010F] = "CameraMaker"
+        buffer = io.BytesIO()
+        Image.new("RGB", (2000, 1000), (200, 30, 30)).save(buffer, "JPEG", exif=exif)
+        return buffer.getvalue()
+
+    def test_variants_are_resized_stripped_and_deduplicated(self):
+        clinic = create_clinic(10.0, 10.0)
+        ClinicImage.objects.filter(clinic=clinic).delete()
+        first = self.upload(clinic, self.photo())
+        images.process_image(first.pk)
+        first.refresh_from_db()
+
+        self.assertEqual(first.variants["thumb"]["width"], 160)
+        self.assertEqual(first.variants["large"]["height"], 800)
+        with first.image_file.storage.open(first.variants["large"]["jpeg"]) as f, Image.open(f) as large:
+            self.assertEqual(large.size, (1600, 800))
+            self.assertEqual(len(large.getexif()), 0)
+        with first.image_file.storage.open(first.variants["small"]["webp"]) as f, Image.open(f) as small:
+            self.assertEqual(small.format, "WEBP")
+
+        # The same photo uploaded again shares the stored files
+        second = self.upload(clinic, self.photo())
+        self.assertNotEqual(second.image_file.name, first.image_file.name)
+        images.process_image(second.pk)
+        second.refresh_from_db()
+        self.assertEqual(second.image_file.name, first.image_file.name)
+        self.assertEqual(second.variants, first.variants)
+        self.assertEqual(images.process_pending(), 0)
+
+        clinic_data = APIClient().get(
+            "/api/admin/clinics/nearby/", {"lat": 10.0, "lng": 10.0, "radius": 5, "fields": "id,primary_image"}
+        ).json()
+        self.assertTrue(clinic_data[0]["primary_image"].endswith("/small.webp"))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.client = APIClient()
+        admin = User.objects.create(username="admin", email="admin@example.com", is_staff=True, is_superuser=True)
+        self.client.force_authenticate(admin)
+        create_clinic(10.0, 10.0)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_requests_are_measured(self):
+        response = self.client.get("/api/admin/clinics/")
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="3 queries", serialize;dur=[\d.]+, ')
+
+        metrics = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret").content.decode()
+        self.assertIn('opencare_requests_total{method="GET",view="dentalclinic-list",status="200"} 1', metrics)
+        self.assertIn('opencare_request_db_queries_bucket{method="GET",view="dentalclinic-list",le="2"} 0', metrics)
+        self.assertIn('opencare_request_db_queries_bucket{method="GET",view="dentalclinic-list",le="3"} 1', metrics)
+        self.assertIn('opencare_request_serialize_seconds_count{method="GET",view="dentalclinic-list"} 1', metrics)
+
+    def test_metrics_token(self):
+        # Closed until a token is configured, even to admins
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        with self.settings(METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer other").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.assertLogs("OpenCare.metrics", "WARNING") as logs:
+            self.client.get("/api/admin/clinics/")
+        self.assertIn("Slow request GET /api/admin/clinics/ (dentalclinic-list)", logs.output[0])
+        self.assertIn('FROM "admin_app_dentalclinic"', logs.output[0])
+
+
+class StructuredLoggingTests(SimpleTestCase):
+    def test_request_ids(self):
+        response = self.client.get("/metrics")
+        self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+        self.assertEqual(self.client.get("/metrics", HTTP_X_REQUEST_ID="edge-42")["X-Request-ID"], "edge-42")
+        self.assertNotEqual(self.client.get("/metrics", HTTP_X_REQUEST_ID="a b\n")["X-Request-ID"], "a b\n")
+
+    def test_records_are_written_as_json_by_the_listener(self):
+        handler = log.QueueLogHandler()
+        handler.addFilter(log.RequestIDFilter())
+        stream = io.StringIO()
+        handler.target.setStream(stream)
+        logger = logging.getLogger("opencare.test")
+        logger.propagate = False
+        logger.addHandler(handler)
+        token = log.request_id.set("req-1")
+        try:
+            logger.warning("Clinic %s failed", 7, extra={"clinic": 7})
+        finally:
+            log.request_id.reset(token)
+            logger.removeHandler(handler)
+            handler.close()
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry["message"], "Clinic 7 failed")
+        self.assertEqual(entry["request_id"], "req-1")
+        self.assertEqual(entry["clinic"], 7)
+
+    @override_settings(LOG_PAYLOAD_MAX_ITEMS=3, LOG_PAYLOAD_MAX_STRING=10)
+    def test_payloads_are_redacted_and_capped(self):
+        data = QueryDict(mutable=True)
+        data.update({"name": "A" * 50, "password": "hunter2", "reviews": json.dumps([{"text": "Good"}] * 5)})
+        data["image"] = SimpleUploadedFile("a.jpg", b"x" * 100)
+        self.assertEqual(log.redact(data), {
+            "name": "AAAAAAAAAA...<50 chars>",
+            "password": "[redacted]",
+            "reviews": '[{"text": ...<90 chars>',
+            "...": "1 more keys",
+        })
+        self.assertEqual(log.redact({"answers": {"email": "a@example.com", "tags": list(range(5))}}), {
+            "answers": {"email": "[redacted]", "tags": [0, 1, 2, "... 2 more items"]},
+        })
+        self.assertEqual(log.redact({"image": data["image"]}), {"image": {"file": "a.jpg", "size": 100}})
+
+    def test_payload_logging_is_sampled(self):
+        logger = logging.getLogger("admin_app.views")
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=0), self.assertNoLogs(logger):
+            log.log_payload(logger, "Visited email answers", {"email": "a@example.com"})
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=1), self.assertLogs(logger) as logs:
+            log.log_payload(logger, "Visited email answers", {"email": "a@example.com"})
+        self.assertEqual(logs.records[0].payload, {"email": "[redacted]"})
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DentalClinicViewSet, get_place_details, VisitedEmailView
+from .views import DentalClinicViewSet, get_place_details, VisitedEmailView, webhook_outbox_stats
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'clinics', DentalClinicViewSet)
@@ -9,5 +10,10 @@ urlpatterns = [
     path('', include(router.urls)),
     path("place-details/", get_place_details, name="place-details"),
     path("add-email/", VisitedEmailView.as_view(), name="add-email"),
+    path("add-email/stats/", webhook_outbox_stats, name="add-email-stats"),
+    # Async variants for ASGI deployments
+    path("async/clinics/nearby/", async_views.nearby_clinics, name="async-nearby"),
+    path("async/place-details/", async_views.get_place_details, name="async-place-details"),
+    path("async/add-email/", async_views.add_email, name="async-add-email"),
     
 ]       
\ No newline at end of file
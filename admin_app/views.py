@@ -1,20 +1,34 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
-from rest_framework.decorators import action, parser_classes
+from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from .models import DentalClinic, ClinicImage
-from .serializers import DentalClinicSerializer
+from .models import DentalClinic
+from .serializers import ClinicSummarySerializer, DentalClinicSerializer, ReviewSerializer
+from .pagination import ReviewPagination
+from .spatial import get_nearby_backend
+from .importers import ClinicImporter
+from . import export, nearby, nearby_cache, outbox
+from .search import ClinicSearch, SearchQueryError, autocomplete
+from .places import PlaceDetailsError, place_details
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
-from rest_framework.decorators import api_view, permission_classes
-import math
-import requests
-from django.http import JsonResponse
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from authentication.authentication import StatelessJWTAuthentication
 from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.views import APIView
-from authentication.models import VisitedUserData
+import codecs
+import logging
+from datetime import timedelta
+
+from OpenCare.log import log_payload
+
+logger = logging.getLogger(__name__)
 
 
 @api_view(['GET'])
+@authentication_classes([StatelessJWTAuthentication])
 @permission_classes([IsAuthenticated, IsAdminUser])
 def get_place_details(request):
     place_id = request.GET.get("place_id")
@@ -22,25 +36,99 @@ def get_place_details(request):
     if not place_id:
         return JsonResponse({"error": "Missing place_id"}, status=400)
 
-    url = "https://maps.googleapis.com/maps/api/place/details/json"
-    params = {
-        "place_id": place_id,
-        "key": settings.GOOGLE_MAPS_API_KEY
-    }
-    response = requests.get(url, params=params)
-    data = response.json()
+    try:
+        data = place_details.get(place_id)
+    except PlaceDetailsError as e:
+        return JsonResponse({"error": "Failed to fetch place details", "details": str(e)}, status=502)
 
     return JsonResponse(data)
 
-class DentalClinicViewSet(viewsets.ModelViewSet):
+class NearbySearchMixin:
+    """
+    Adds the `nearby` action to a clinic viewset. Candidates come from the
+    backend selected by settings.NEARBY_SEARCH_BACKEND.
+    """
+    nearby_default_radius = 50
+
+    def get_nearby_clinics(self, hits):
+        """Load the hits as fully prefetched model instances for DentalClinicSerializer."""
+        clinics = self.get_queryset().with_details().in_bulk([clinic_id for _, clinic_id in hits])
+        return nearby.order_clinics(hits, clinics)
+
+    def render_nearby(self, query, hits):
+        """
+        Serialize the hits in the query's view. Returns the (id, latitude,
+        longitude) of each rendered clinic and the serialized data, in order.
+        """
+        if query.view == 'summary':
+            clinics, images, hours = nearby.summary_querysets(hits, query.fields)
+            rows = nearby.summary_rows(hits, clinics, images, hours, self.request.build_absolute_uri)
+            points = [(row['id'], row['latitude'], row['longitude']) for row in rows]
+            return points, ClinicSummarySerializer(rows, many=True, fields=query.fields).data
+        clinics = self.get_nearby_clinics(hits)
+        points = [(clinic.pk, clinic.latitude, clinic.longitude) for clinic in clinics]
+        return points, self.get_serializer(clinics, many=True).data
+
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """
+        Find clinics within a given radius of the provided coordinates. See
+        nearby.NearbyQuery for the query parameters.
+
+        While NEARBY_CACHE_TIMEOUT is set, searches with a radius are answered
+        from a cached bucket: every clinic within a circle around the center
+        of the caller's geohash cell that covers the requested one (see
+        nearby_cache.quantize). Each request then picks its own clinics,
+        distances and `next` link from the bucket. Buckets holding more than
+        NEARBY_CACHE_MAX_ROWS clinics are searched directly (X-Cache: BYPASS).
+        """
+        try:
+            query = nearby.NearbyQuery(request.query_params, self.nearby_default_radius)
+        except nearby.NearbyQueryError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_key = query.cache_key(request.build_absolute_uri(request.path))
+        entry = headers = None
+        if cache_key is not None:
+            entry = nearby_cache.lookup(cache_key)
+            headers = {'X-Cache': 'HIT' if entry is not None else 'MISS'}
+            if entry is None:
+                args, kwargs = query.bucket_search_args(query.open_candidates())
+                bucket_hits = get_nearby_backend().search(*args, **kwargs)
+                rows = None
+                if query.fits_cache(bucket_hits):
+                    rows = query.cache_rows(*self.render_nearby(query, bucket_hits))
+                entry = {'rows': rows}
+                nearby_cache.store(cache_key, entry)
+
+        if entry is not None and entry['rows'] is not None:
+            hits, data, has_next = query.select(entry['rows'])
+        else:
+            if entry is not None:
+                headers['X-Cache'] = 'BYPASS'
+            args, kwargs = query.search_args(query.open_candidates())
+            hits, has_next = query.paginate(get_nearby_backend().search(*args, **kwargs))
+            data = self.render_nearby(query, hits)[1]
+        return Response(query.payload(data, hits, has_next, request.build_absolute_uri()), headers=headers)
+
+
+class DentalClinicViewSet(NearbySearchMixin, viewsets.ModelViewSet):
     queryset = DentalClinic.objects.all()
     serializer_class = DentalClinicSerializer
+    # Admin checks use the token's claims, without a user query per request
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [IsAuthenticated, IsAdminUser]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.with_details()
+        return queryset
+
     def get_permissions(self):
-        # Allow unauthenticated access only to the 'nearby' action
-        if self.action == 'nearby':
+        # Allow unauthenticated access only to the public lookups
+        if self.action in ('nearby', 'search', 'autocomplete', 'reviews'):
             return [AllowAny()]
         return [IsAuthenticated(), IsAdminUser()]
 
@@ -52,7 +140,7 @@ class DentalClinicViewSet(viewsets.ModelViewSet):
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
-        print('request structure in views.py ==== ', request.data)
+        log_payload(logger, "Clinic create request", request.data)
         if serializer.is_valid():
             self.perform_create(serializer)
             headers = self.get_success_headers(serializer.data)
@@ -67,193 +155,158 @@ class DentalClinicViewSet(viewsets.ModelViewSet):
             self.perform_update(serializer)
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    
+
+    @action(detail=True, methods=['get'])
+    def reviews(self, request, pk=None):
+        """The clinic's reviews, newest first, one cursor-paginated page at a time."""
+        clinic = self.get_object()
+        paginator = ReviewPagination()
+        page = paginator.paginate_queryset(clinic.reviews.all(), request, view=self)
+        return paginator.get_paginated_response(ReviewSerializer(page, many=True).data)
+
     @action(detail=False, methods=['get'])
-    def nearby(self, request):
+    def search(self, request):
         """
-        Find clinics within a given radius (default: 10km) of the provided coordinates.
-        
-        Query parameters:
-        - lat: user's latitude (required)
-        - lng: user's longitude (required)
-        - radius: search radius in kilometers (optional, default: 10)
+        Search clinic names, addresses, descriptions and review texts, best
+        match first, as a page of {"next", "results"}. See search.ClinicSearch
+        for the query parameters; with lat/lng the results are restricted to a
+        radius and nearer clinics rank higher.
         """
-        latitude = request.query_params.get('lat')
-        longitude = request.query_params.get('lng')
-        radius = request.query_params.get('radius', 50)
-        
-        if not latitude or not longitude:
-            return Response(
-                {"error": "Latitude and longitude parameters are required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         try:
-            latitude = float(latitude)
-            longitude = float(longitude)
-            radius = float(radius)
-        except ValueError:
-            return Response(
-                {"error": "Invalid latitude, longitude, or radius value"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Calculate nearby clinics using the Haversine formula
-        clinics = self.get_queryset()
-        
-        # Add distance to each clinic
-        nearby_clinics = []
-        for clinic in clinics:
-            distance = self.haversine_distance(
-                latitude, longitude, 
-                clinic.latitude, clinic.longitude
-            )
-            
-            # Check if clinic is within the radius
-            if distance <= radius:
-                clinic.distance = distance
-                nearby_clinics.append(clinic)
-        
-        # Sort by distance
-        nearby_clinics.sort(key=lambda x: x.distance)
-        
-        serializer = self.get_serializer(nearby_clinics, many=True)
-        return Response(serializer.data)
-    
-    @staticmethod
-    def haversine_distance(lat1, lon1, lat2, lon2):
-        """
-        Calculate the great circle distance between two points 
-        on the earth (specified in decimal degrees)
-        Returns distance in kilometers
-        """
-        # Convert decimal degrees to radians
-        lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-        
-        # Haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        r = 6371  # Radius of earth in kilometers
-        
-        return c * r
-
-
-class DentalNearmeView(viewsets.ModelViewSet):
-    queryset = DentalClinic.objects.all()
-    serializer_class = DentalClinicSerializer
-    permission_classes = [AllowAny]
-    # parser_classes = [MultiPartParser, FormParser, JSONParser]
+            query = ClinicSearch(request.query_params, self.nearby_default_radius)
+        except SearchQueryError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        hits, has_next = query.hits()
+        data = self.get_serializer(self.get_nearby_clinics(hits), many=True).data
+        return Response(query.payload(data, has_next, request.build_absolute_uri()))
 
     @action(detail=False, methods=['get'])
-    def nearby(self, request):
+    def autocomplete(self, request):
         """
-        Find clinics within a given radius (default: 10km) of the provided coordinates.
-        
-        Query parameters:
-        - lat: user's latitude (required)
-        - lng: user's longitude (required)
-        - radius: search radius in kilometers (optional, default: 10)
+        Suggest clinics whose name matches the partly typed `q`, as up to
+        `limit` (default CLINIC_AUTOCOMPLETE_LIMIT) {id, name, address} rows.
         """
-        latitude = request.query_params.get('lat')
-        longitude = request.query_params.get('lng')
-        radius = request.query_params.get('radius', 10)  # Default radius: 10km
-        
-        if not latitude or not longitude:
-            return Response(
-                {"error": "Latitude and longitude parameters are required"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({"error": "The q parameter is required"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            latitude = float(latitude)
-            longitude = float(longitude)
-            radius = float(radius)
+            limit = int(request.query_params.get('limit', settings.CLINIC_AUTOCOMPLETE_LIMIT))
         except ValueError:
+            return Response({"error": "Invalid limit value"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= limit <= settings.NEARBY_MAX_PAGE_SIZE:
             return Response(
-                {"error": "Invalid latitude, longitude, or radius value"},
-                status=status.HTTP_400_BAD_REQUEST
+                {"error": f"limit must be between 1 and {settings.NEARBY_MAX_PAGE_SIZE}"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-        
-        # Calculate nearby clinics using the Haversine formula
-        clinics = self.get_queryset()
-        
-        # Add distance to each clinic
-        nearby_clinics = []
-        for clinic in clinics:
-            distance = self.haversine_distance(
-                latitude, longitude, 
-                clinic.latitude, clinic.longitude
-            )
-            
-            # Check if clinic is within the radius
-            if distance <= radius:
-                clinic.distance = distance
-                nearby_clinics.append(clinic)
-        
-        # Sort by distance
-        nearby_clinics.sort(key=lambda x: x.distance)
-        
-        serializer = self.get_serializer(nearby_clinics, many=True)
-        return Response(serializer.data)
-    
-    @staticmethod
-    def haversine_distance(lat1, lon1, lat2, lon2):
+        return Response(autocomplete(text, limit))
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
         """
-        Calculate the great circle distance between two points 
-        on the earth (specified in decimal degrees)
-        Returns distance in kilometers
+        Stream the whole directory, or with `since` only the clinics updated
+        after that ISO 8601 datetime, oldest change first.
+
+        `output` is 'ndjson' (default; one clinic per line with its hours,
+        images and reviews) or 'csv' (flat rows without reviews). Pass the
+        X-Export-Watermark header as `since` next time to fetch only what
+        changed in between. It lags the time the export was taken at by
+        CLINIC_EXPORT_WATERMARK_LAG seconds: a write's updated_at is set before
+        it commits, so successive exports overlap to pick up changes that
+        were not committed yet, and a clinic may be exported twice. Deleted
+        clinics do not show up in incremental exports.
         """
-        # Convert decimal degrees to radians
-        lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-        
-        # Haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        r = 6371  # Radius of earth in kilometers
-        
-        return c * r
+        output = request.query_params.get('output', 'ndjson')
+        if output not in export.CONTENT_TYPES:
+            return Response({"error": "output must be 'ndjson' or 'csv'"}, status=status.HTTP_400_BAD_REQUEST)
+
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None:
+                return Response({"error": "Invalid since value"}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        else:
+            since = None
+
+        until = timezone.now()
+        watermark = until - timedelta(seconds=settings.CLINIC_EXPORT_WATERMARK_LAG)
+        response = StreamingHttpResponse(
+            export.stream(output, since, until, request.build_absolute_uri),
+            content_type=export.CONTENT_TYPES[output],
+        )
+        response['Content-Disposition'] = f'attachment; filename="clinics.{output}"'
+        response['X-Export-Watermark'] = watermark.isoformat()
+        return response
+
+    @action(detail=False, methods=['get'], url_path='nearby-cache-stats')
+    def nearby_cache_stats(self, request):
+        """Hit/miss counters and current generation of the nearby response cache."""
+        return Response(nearby_cache.stats())
+
+    @action(detail=False, methods=['post'], url_path='bulk-import')
+    def bulk_import(self, request):
+        """
+        Import many clinics from one uploaded file.
+
+        Form fields:
+        - file: JSONL or CSV file, one clinic per line/row (required)
+        - file_format: 'jsonl' or 'csv' (optional, guessed from the file name)
+        - start_after: skip rows up to and including this row number, e.g. the
+          `last_row` of an interrupted import (optional)
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "A file is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        file_format = request.data.get('file_format') or ('csv' if upload.name.lower().endswith('.csv') else 'jsonl')
+        if file_format not in ('jsonl', 'csv'):
+            return Response({"error": "file_format must be 'jsonl' or 'csv'"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            start_after = int(request.data.get('start_after', 0))
+        except ValueError:
+            return Response({"error": "Invalid start_after value"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Decode line by line so the upload is never read into memory at once
+        lines = codecs.iterdecode(upload, 'utf-8')
+        report = ClinicImporter().run(lines, file_format, start_after)
+        return Response(report.as_dict())
+
+
+class DentalNearmeView(NearbySearchMixin, viewsets.ModelViewSet):
+    queryset = DentalClinic.objects.all()
+    serializer_class = DentalClinicSerializer
+    permission_classes = [AllowAny]
+    nearby_default_radius = 10
+    # parser_classes = [MultiPartParser, FormParser, JSONParser]
 
 
 
 
 
 class VisitedEmailView(APIView):
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [AllowAny]
 
     def post(self, request):
             answers = request.data.get("answers")
-            print("answers: ", answers)
+            log_payload(logger, "Visited email answers", answers)
 
             if not answers or "email" not in answers:
                 return Response({"error": "Email is required"}, status=400)
 
-            email = answers["email"]
-
-            # Save or update to DB
-            obj, created = VisitedUserData.objects.update_or_create(
-                email=email,
-                defaults={
-                    "emergency": answers.get("emergency", ""),
-                    "factors": answers.get("factors", []),
-                    "lastVisit": answers.get("lastVisit", ""),
-                    "anxiety": answers.get("anxiety", ""),
-                    "timePreference": answers.get("timePreference", []),
-                    "hasInsurance": answers.get("hasInsurance", ""),
-                    "insuranceProvider": answers.get("insuranceProvider", ""),
-                    "paymentOption": answers.get("paymentOption", ""),
-                }
-            )
+            # The webhook is forwarded by a worker once this commits
+            outbox.record_submission(answers)
+
+            return Response({"message": "Data saved and queued for forwarding"})
 
-            # Forward to external webhook
-            try:
-                webhook_url = "https://services.leadconnectorhq.com/hooks/4y5GUDosyK73YqjbTlg1/webhook-trigger/a9182ada-9332-440d-92a9-4dfd675ddb0a"
-                response = requests.post(webhook_url, json=answers)
-                response.raise_for_status()
-            except requests.RequestException as e:
-                return Response({"error": "Failed to send data to webhook", "details": str(e)}, status=500)
 
-            return Response({"message": "Data saved and forwarded successfully"})
\ No newline at end of file
+@api_view(['GET'])
+@authentication_classes([StatelessJWTAuthentication])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def webhook_outbox_stats(request):
+    return Response(outbox.stats())
\ No newline at end of file
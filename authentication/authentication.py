@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+
+# Claims generate_tokens adds so permission checks need no user query
+USER_CLAIMS = ('email', 'is_staff', 'is_superuser')
+
+
+def add_user_claims(token, user):
+    for claim in USER_CLAIMS:
+        token[claim] = getattr(user, claim)
+
+
+class UserCache:
+    """
+    In-process LRU cache of User rows by id, kept for `ttl` seconds, for
+    views behind StatelessJWTAuthentication that need the model itself.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def get(self, user_id):
+        """The User with this id, or None if there is none."""
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(user_id)
+                return entry[1]
+
+        user = get_user_model().objects.filter(pk=user_id).first()
+        with self._lock:
+            self._cache[user_id] = (time.monotonic() + self.ttl, user)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return user
+
+
+user_cache = UserCache(ttl=settings.JWT_USER_CACHE_TTL, max_entries=settings.JWT_USER_CACHE_SIZE)
+
+
+class ClaimsUser(TokenUser):
+    """
+    A user built from the access token's claims. `is_staff` and
+    `is_superuser` come from the token; `user` loads the User row through
+    user_cache for the views that need it.
+    """
+
+    @cached_property
+    def email(self):
+        return self.token.get('email', '')
+
+    @cached_property
+    def user(self):
+        return user_cache.get(self.id)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    Opt-in JWTAuthentication that trusts the admin flags in the access token
+    instead of loading the user on every request. A user whose flags change
+    or who is deactivated keeps the old access for the rest of the access
+    token's lifetime (ACCESS_TOKEN_LIFETIME); refreshing re-reads them.
+    Tokens issued without the claims are still checked against the database.
+    """
+
+    def get_user(self, validated_token):
+        if any(claim not in validated_token for claim in USER_CLAIMS):
+            return super().get_user(validated_token)
+        return ClaimsUser(validated_token)
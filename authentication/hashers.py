@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    """
+    Argon2id with its cost taken from ARGON2_TIME_COST, ARGON2_MEMORY_COST
+    (KiB) and ARGON2_PARALLELISM instead of Django's defaults (100 MiB over 8
+    lanes), which cost far more CPU per login. Hashes made with other
+    parameters, or by another hasher, still verify and are rehashed with
+    these at the next successful login. See the benchmark_login command.
+    """
+
+    @property
+    def time_cost(self):
+        return settings.ARGON2_TIME_COST
+
+    @property
+    def memory_cost(self):
+        return settings.ARGON2_MEMORY_COST
+
+    @property
+    def parallelism(self):
+        return settings.ARGON2_PARALLELISM
@@ -5,9 +5,14 @@ from django.core.validators import validate_email, RegexValidator
 from .validators import validate_strong_password
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import authenticate
+from django.db import IntegrityError, transaction
+from .utils import is_unknown_email, remember_unknown_email
 
 User = get_user_model()
 
+# Everything the login view and token generation read from the user
+LOGIN_FIELDS = ('id', 'password', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser')
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     """Serializer for user registration with validation."""
 
@@ -35,13 +40,6 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         model = User
         fields = ('id', 'email', 'first_name', 'last_name', 'password')
 
-    def validate_email(self, value):
-        """Check if email is already in use."""
-
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
-    
     def create(self, validated_data):
         """Create and return a new user instance."""
 
@@ -55,7 +53,13 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         )
 
         user.set_password(validated_data['password'])
-        user.save()
+        # The unique constraint decides whether the email is taken, which
+        # saves a lookup and cannot race with a concurrent registration
+        try:
+            with transaction.atomic():
+                user.save()
+        except IntegrityError:
+            raise serializers.ValidationError({"email": ["A user with this email already exists."]})
         return user
 
 
@@ -75,9 +79,16 @@ class LoginSerializer(serializers.ModelSerializer):
         password = attrs.get('password')
         
         if email and password:
-            # Try to get the user directly by email first
+            # Unknown emails are cached so repeated guesses skip the database.
+            # Registration already tells whether an email exists, so answering
+            # them faster than a password check gives nothing away
+            if is_unknown_email(email):
+                raise serializers.ValidationError(
+                    {"error": "invalid_credentials", "message": "Invalid email or password"},
+                    code='authorization'
+                )
             try:
-                user = User.objects.get(email=email)
+                user = User.objects.only(*LOGIN_FIELDS).get(email=email)
                 if user.check_password(password):
                     # Manually authenticate the user
                     if not user.is_active:
@@ -98,6 +109,7 @@ class LoginSerializer(serializers.ModelSerializer):
                         code='authorization'
                     )
             except User.DoesNotExist:
+                remember_unknown_email(email)
                 raise serializers.ValidationError(
                     {"error": "invalid_credentials", "message": "Invalid email or password"},
                     code='authorization'
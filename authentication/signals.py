@@ -0,0 +1,13 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .utils import forget_unknown_email
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def clear_unknown_email(sender, instance, **kwargs):
+    """An email that was cached as unknown to login may belong to this user now."""
+    forget_unknown_email(instance.email)
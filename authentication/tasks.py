@@ -0,0 +1,37 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def purge_expired_tokens(batch_size=None):
+    """
+    Delete expired outstanding tokens, and their blacklist entries, in
+    batches of batch_size so no statement holds locks for long.
+
+    Tokens are issued in id order with a fixed lifetime, so the expired ones
+    are the lowest ids: each batch walks the primary key from where the last
+    one stopped. Returns the number of tokens deleted.
+    """
+    batch_size = batch_size or settings.TOKEN_PURGE_BATCH_SIZE
+    now = timezone.now()
+    deleted = 0
+    last_id = 0
+    while True:
+        ids = list(
+            OutstandingToken.objects.filter(pk__gt=last_id, expires_at__lt=now)
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        # Cascades to BlacklistedToken
+        OutstandingToken.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            break
+        last_id = ids[-1]
+    logger.info("Purged %s expired tokens", deleted)
+    return deleted
@@ -1,3 +1,163 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework.throttling import ScopedRateThrottle
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from .authentication import user_cache
+from .tasks import purge_expired_tokens
+from .tokens import CachedRefreshToken
+from .utils import generate_tokens
+
+User = get_user_model()
+
+PASSWORD = "Sturdy-Password-42"
+
+
+class LoginTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def login(self, email, password=PASSWORD):
+        return self.client.post("/api/auth/login/", {"email": email, "password": password}, format="json")
+
+    def register(self, email):
+        return self.client.post(
+            "/api/auth/register/",
+            {"email": email, "first_name": "Ann", "last_name": "Lee", "password": PASSWORD},
+            format="json",
+        )
+
+    def test_unknown_emails_are_cached_until_registered(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.login("new@example.com").status_code, 400)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.login("new@example.com").status_code, 400)
+
+        self.assertEqual(self.register("new@example.com").status_code, 201)
+        response = self.login("new@example.com")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["email"], "new@example.com")
+
+    def test_duplicate_registration_is_rejected(self):
+        self.assertEqual(self.register("ann@example.com").status_code, 201)
+        response = self.register("ann@example.com")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("email", response.json())
+
+    def test_old_hashes_are_upgraded_at_login(self):
+        user = User.objects.create(
+            username="old@example.com", email="old@example.com", is_superuser=True,
+            password=make_password(PASSWORD, hasher="pbkdf2_sha256"),
+        )
+        self.assertEqual(self.login("old@example.com").status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith("argon2$argon2id$v=19$m=19456,t=2,p=1$"))
+
+    def test_login_loads_the_user_once(self):
+        User.objects.create(
+            username="ann@example.com", email="ann@example.com", is_superuser=True, password=make_password(PASSWORD),
+        )
+        # The user, then the refresh token's OutstandingToken row
+        with self.assertNumQueries(2):
+            self.assertEqual(self.login("ann@example.com").status_code, 200)
+
+    def test_logins_are_throttled(self):
+        # The throttle reads its rates once, at import
+        with mock.patch.object(ScopedRateThrottle, "THROTTLE_RATES", {"login": "2/min"}):
+            self.login("a@example.com")
+            self.login("b@example.com")
+            self.assertEqual(self.login("c@example.com").status_code, 429)
+
+
+class RefreshTokenTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(
+            username="ann@example.com", email="ann@example.com", is_superuser=True, password=make_password(PASSWORD)
+        )
+
+    def refresh(self, token):
+        return self.client.post("/api/token/refresh/", {}, format="json", HTTP_X_REFRESH_TOKEN=token)
+
+    def test_blacklist_check_is_cached(self):
+        token = str(CachedRefreshToken.for_user(self.user))
+        # blacklist lookup + user
+        with self.assertNumQueries(2):
+            self.assertEqual(self.refresh(token).status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.refresh(token).status_code, 200)
+
+        CachedRefreshToken(token).blacklist()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.refresh(token).status_code, 401)
+
+        # The database stays the source of truth
+        cache.clear()
+        self.assertEqual(self.refresh(token).status_code, 401)
+
+    def test_purge_deletes_only_expired_tokens(self):
+        now = timezone.now()
+        for days in (-3, -2, -1, 1):
+            token = OutstandingToken.objects.create(
+                user=self.user, jti=f"jti{days}", token="x", expires_at=now + timedelta(days=days)
+            )
+            BlacklistedToken.objects.create(token=token)
+
+        self.assertEqual(purge_expired_tokens(batch_size=2), 3)
+        self.assertEqual(list(OutstandingToken.objects.values_list("jti", flat=True)), ["jti1"])
+        self.assertEqual(BlacklistedToken.objects.count(), 1)
+
+
+class StatelessAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        self.client = APIClient()
+        self.admin = User.objects.create(
+            username="admin@example.com", email="admin@example.com", is_staff=True, is_superuser=True
+        )
+
+    def list_clinics(self, access):
+        return self.client.get("/api/admin/clinics/", HTTP_AUTHORIZATION=f"Bearer {access}")
+
+    def test_admin_checks_need_no_user_query(self):
+        access = generate_tokens(self.admin)["access"]
+        # Only the (empty) clinic page
+        with self.assertNumQueries(1):
+            self.assertEqual(self.list_clinics(access).status_code, 200)
+
+    def test_tokens_without_claims_load_the_user(self):
+        access = str(CachedRefreshToken.for_user(self.admin).access_token)
+        # user + clinic page
+        with self.assertNumQueries(2):
+            self.assertEqual(self.list_clinics(access).status_code, 200)
+
+        User.objects.filter(pk=self.admin.pk).update(is_staff=False)
+        self.assertEqual(self.list_clinics(access).status_code, 403)
+
+    def test_refresh_reads_the_current_flags(self):
+        tokens = generate_tokens(self.admin)
+        User.objects.filter(pk=self.admin.pk).update(is_staff=False)
+        # Until it expires, the old access token still carries is_staff
+        self.assertEqual(self.list_clinics(tokens["access"]).status_code, 200)
+
+        response = self.client.post("/api/token/refresh/", {}, format="json", HTTP_X_REFRESH_TOKEN=tokens["refresh"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.list_clinics(response.json()["access"]).status_code, 403)
 
-# Create your tests here.
+        User.objects.filter(pk=self.admin.pk).update(is_active=False)
+        with self.assertNoLogs("authentication.views", level="ERROR"):
+            response = self.client.post(
+                "/api/token/refresh/", {}, format="json", HTTP_X_REFRESH_TOKEN=tokens["refresh"]
+            )
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("detail", response.json())
@@ -0,0 +1,84 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .authentication import add_user_claims
+
+BLACKLISTED = 1
+NOT_BLACKLISTED = 0
+
+
+def blacklist_key(jti):
+    return f"jwt:blacklist:{jti}"
+
+
+class CachedRefreshToken(RefreshToken):
+    """
+    A refresh token whose blacklist check is answered from the cache.
+
+    The token_blacklist tables stay the source of truth. A token found
+    blacklisted is cached until it expires, and blacklist() writes through to
+    the cache. A token found not blacklisted is cached for at most
+    TOKEN_BLACKLIST_CACHE_TIMEOUT seconds, which bounds how long a blacklisting
+    whose cache write was lost can go unnoticed.
+    """
+
+    def remaining_lifetime(self):
+        expires = datetime.fromtimestamp(self.payload['exp'], tz=timezone.utc)
+        return max(int((expires - self.current_time).total_seconds()), 1)
+
+    def check_blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        state = cache.get(blacklist_key(jti))
+        if state is None:
+            if BlacklistedToken.objects.filter(token__jti=jti).exists():
+                state, timeout = BLACKLISTED, self.remaining_lifetime()
+            else:
+                state = NOT_BLACKLISTED
+                timeout = min(settings.TOKEN_BLACKLIST_CACHE_TIMEOUT, self.remaining_lifetime())
+            cache.set(blacklist_key(jti), state, timeout=timeout)
+        if state == BLACKLISTED:
+            raise TokenError("Token is blacklisted")
+
+    def blacklist(self):
+        result = super().blacklist()
+        cache.set(blacklist_key(self.payload[api_settings.JTI_CLAIM]), BLACKLISTED, timeout=self.remaining_lifetime())
+        return result
+
+
+class CachedTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = CachedRefreshToken
+
+    def validate(self, attrs):
+        """
+        TokenRefreshSerializer.validate, except that the user claims of the
+        new access token are read from the database rather than copied from
+        the refresh token, so flag changes apply from the next refresh.
+        """
+        refresh = self.token_class(attrs['refresh'])
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+        if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        add_user_claims(refresh, user)
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+
+        return data
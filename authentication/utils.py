@@ -1,9 +1,35 @@
-from rest_framework_simplejwt.tokens import RefreshToken
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .authentication import add_user_claims
+from .tokens import CachedRefreshToken
 
 def generate_tokens(user):
-    refresh = RefreshToken.for_user(user)
+    refresh = CachedRefreshToken.for_user(user)
+    # Copied into the access token, see StatelessJWTAuthentication
+    add_user_claims(refresh, user)
     return {
         'refresh':str(refresh),
         'access':str(refresh.access_token),
 
-    }
\ No newline at end of file
+    }
+
+
+def unknown_email_key(email):
+    # Emails are matched exactly at login, so the key is not case folded
+    return f"login:unknown:{hashlib.sha256(email.encode()).hexdigest()}"
+
+
+def is_unknown_email(email):
+    """Whether a recent login already found no user with this email."""
+    return cache.get(unknown_email_key(email)) is not None
+
+
+def remember_unknown_email(email):
+    cache.set(unknown_email_key(email), 1, timeout=settings.LOGIN_UNKNOWN_EMAIL_CACHE_TIMEOUT)
+
+
+def forget_unknown_email(email):
+    cache.delete(unknown_email_key(email))
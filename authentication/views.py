@@ -3,13 +3,15 @@ from django.shortcuts import render
 from django.contrib.auth import get_user_model, logout
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.throttling import ScopedRateThrottle
 from .serializers import UserRegistrationSerializer, LoginSerializer
 from .utils import generate_tokens
 from django.middleware import csrf
 from django.conf import settings
-from rest_framework_simplejwt.tokens import RefreshToken
+from .tokens import CachedRefreshToken
 from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.views import TokenRefreshView
 
@@ -51,6 +53,8 @@ class LoginViewSet(viewsets.ViewSet):
     """API endpoint for user Login."""
 
     permission_classes = [AllowAny]
+    throttle_classes = [ScopedRateThrottle]
+    throttle_scope = 'login'
     refresh_expiry = int(settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME'].total_seconds())
 
     def create(self, request):
@@ -109,7 +113,7 @@ class AuthViewSet(viewsets.ViewSet):
             refresh_token = request.COOKIES.get('refresh_token')
             if refresh_token:
                 try:
-                    token = RefreshToken(refresh_token)
+                    token = CachedRefreshToken(refresh_token)
                     token.blacklist()
                     logger.info(f"Refresh token successfully blacklisted for user {request.user}")
                 except TokenError as e:
@@ -143,14 +147,14 @@ class CustomTokenRefreshView(TokenRefreshView):
         """Validates the refresh token, issues a new access token, and updates the refresh token cookie."""
         
         refresh_token = request.headers.get('X-Refresh-Token') or request.COOKIES.get('refresh_token')
-        logger.debug(f"Received refresh token: {refresh_token}")
+        logger.debug("Refresh token received from the %s", 'header' if request.headers.get('X-Refresh-Token') else 'cookie')
 
         if not refresh_token:
             logger.warning("Refresh token is missing in the request")
             return Response({'error': 'Refresh Token is missing'}, status=status.HTTP_401_UNAUTHORIZED)
         
         try:
-            refresh = RefreshToken(refresh_token)
+            refresh = CachedRefreshToken(refresh_token)
 
             if refresh.payload.get('token_type') != 'refresh':
                 logger.warning("Invalid token type detected in refresh token")
@@ -176,6 +180,9 @@ class CustomTokenRefreshView(TokenRefreshView):
         except TokenError as e:
             logger.error(f"Token error occurred: {str(e)}")
             return Response({"error": str(e)}, status=status.HTTP_401_UNAUTHORIZED)
+        except APIException:
+            # Client errors such as AuthenticationFailed, answered by DRF's handler
+            raise
         except Exception as e:
             logger.exception("An unexpected error occurred during token refresh")
             return Response({"error": "Invalid refresh token"}, status=status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file